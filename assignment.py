@@ -0,0 +1,127 @@
+"""
+assignment.py | Balanced assignment of participants to experiment configs.
+
+Every config in the catalog is a slot (experiment_id, condition, batch, shuffle) with a count of
+in-flight and completed participants. A new participant gets the least-filled slot that matches the
+requested experiment/condition, so a burst of arrivals is spread evenly across conditions. Slots held
+by sessions that never finish are reclaimed after ASSIGNMENT_TIMEOUT_SECONDS.
+
+State lives in a SQLite file (ASSIGNMENT_DB_PATH) so that every server process shares the same counts;
+each assignment is a single transaction using the (active, fill) indexes.
+"""
+import os
+import time
+
+import local_sqlite
+from local_sqlite import transaction
+
+DEFAULT_DB_PATH = 'assignments.db'
+DEFAULT_TIMEOUT_SECONDS = 2 * 60 * 60
+RECLAIM_EVERY_SECONDS = 60
+
+IN_FLIGHT = 'in_flight'
+COMPLETED = 'completed'
+ABANDONED = 'abandoned'
+
+SLOT_COLUMNS = ('experiment_id', 'condition', 'batch', 'shuffle')
+SLOT_MATCH = ' AND '.join(f'{column} = ?' for column in SLOT_COLUMNS)
+
+class AssignmentScheduler(object):
+    def __init__(self, path=DEFAULT_DB_PATH, timeout=DEFAULT_TIMEOUT_SECONDS):
+        self.path = path
+        self.timeout = timeout
+        self.connection = local_sqlite.ThreadLocalConnection(path).get
+        self.synced_keys = None
+        self.reclaimed_at = 0
+        self.connection().executescript('''
+            CREATE TABLE IF NOT EXISTS slots (
+                experiment_id TEXT NOT NULL, condition TEXT NOT NULL, batch INTEGER NOT NULL, shuffle INTEGER NOT NULL,
+                active INTEGER NOT NULL DEFAULT 1,
+                in_flight INTEGER NOT NULL DEFAULT 0,
+                completed INTEGER NOT NULL DEFAULT 0,
+                fill INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (experiment_id, condition, batch, shuffle));
+            CREATE INDEX IF NOT EXISTS slots_fill ON slots (active, fill);
+            CREATE INDEX IF NOT EXISTS slots_experiment_fill ON slots (experiment_id, active, fill);
+            CREATE INDEX IF NOT EXISTS slots_condition_fill ON slots (condition, active, fill);
+            CREATE TABLE IF NOT EXISTS assignments (
+                participant_id TEXT PRIMARY KEY,
+                experiment_id TEXT NOT NULL, condition TEXT NOT NULL, batch INTEGER NOT NULL, shuffle INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                assigned_at REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS assignments_state ON assignments (state, assigned_at);
+        ''')
+
+    def sync_slots(self, keys):
+        """Makes the slot table match the catalog keys. Cheap to call on every request."""
+        if keys is self.synced_keys:
+            return
+        with transaction(self.connection()) as conn:
+            conn.execute('UPDATE slots SET active = 0')
+            conn.executemany('INSERT OR IGNORE INTO slots (experiment_id, condition, batch, shuffle) VALUES (?, ?, ?, ?)', keys)
+            conn.executemany(f'UPDATE slots SET active = 1 WHERE {SLOT_MATCH}', keys)
+        self.synced_keys = keys
+
+    def assign(self, participant_id, experiment_id=None, condition=None):
+        """Returns the slot key for a participant, assigning the least-filled matching slot if needed."""
+        self.maybe_reclaim()
+        with transaction(self.connection()) as conn:
+            row = conn.execute('SELECT experiment_id, condition, batch, shuffle, state FROM assignments WHERE participant_id = ?',
+                               (participant_id,)).fetchone()
+            if row and row[4] != ABANDONED and (not experiment_id or row[0] == experiment_id) and (not condition or row[1] == condition):
+                return tuple(row[:4])
+
+            filters, params = ['active = 1'], []
+            if experiment_id:
+                filters.append('experiment_id = ?')
+                params.append(experiment_id)
+            if condition:
+                filters.append('condition = ?')
+                params.append(condition)
+            slot = conn.execute(f'SELECT experiment_id, condition, batch, shuffle FROM slots WHERE {" AND ".join(filters)} ORDER BY fill LIMIT 1',
+                                params).fetchone()
+            if slot is None:
+                return None
+            if row and row[4] == IN_FLIGHT:
+                # The participant asked for a different experiment or condition: release the old slot.
+                conn.execute(f'UPDATE slots SET in_flight = in_flight - 1, fill = fill - 1 WHERE {SLOT_MATCH}', row[:4])
+            conn.execute(f'UPDATE slots SET in_flight = in_flight + 1, fill = fill + 1 WHERE {SLOT_MATCH}', slot)
+            conn.execute('INSERT OR REPLACE INTO assignments VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (participant_id,) + tuple(slot) + (IN_FLIGHT, time.time()))
+            return tuple(slot)
+
+    def complete(self, participant_id):
+        """Moves a participant's slot from in-flight to completed. Safe to call more than once."""
+        with transaction(self.connection()) as conn:
+            row = conn.execute('SELECT experiment_id, condition, batch, shuffle, state FROM assignments WHERE participant_id = ?',
+                               (participant_id,)).fetchone()
+            if row and row[4] == IN_FLIGHT:
+                conn.execute(f'UPDATE slots SET in_flight = in_flight - 1, completed = completed + 1 WHERE {SLOT_MATCH}', row[:4])
+            elif row and row[4] == ABANDONED:
+                # Finished after the slot was reclaimed: count it again.
+                conn.execute(f'UPDATE slots SET completed = completed + 1, fill = fill + 1 WHERE {SLOT_MATCH}', row[:4])
+            if row:
+                conn.execute('UPDATE assignments SET state = ? WHERE participant_id = ?', (COMPLETED, participant_id))
+
+    def maybe_reclaim(self):
+        if time.time() - self.reclaimed_at > RECLAIM_EVERY_SECONDS:
+            self.reclaim()
+
+    def reclaim(self):
+        """Releases the slots of in-flight participants older than the timeout."""
+        self.reclaimed_at = time.time()
+        with transaction(self.connection()) as conn:
+            expired = conn.execute('SELECT participant_id, experiment_id, condition, batch, shuffle FROM assignments WHERE state = ? AND assigned_at < ?',
+                                   (IN_FLIGHT, time.time() - self.timeout)).fetchall()
+            for row in expired:
+                conn.execute(f'UPDATE slots SET in_flight = in_flight - 1, fill = fill - 1 WHERE {SLOT_MATCH}', row[1:])
+            conn.executemany('UPDATE assignments SET state = ? WHERE participant_id = ?', [(ABANDONED, row[0]) for row in expired])
+        return len(expired)
+
+    def quota_table(self):
+        rows = self.connection().execute('SELECT experiment_id, condition, batch, shuffle, in_flight, completed FROM slots WHERE active = 1 ORDER BY experiment_id, condition, batch, shuffle')
+        return [dict(zip(SLOT_COLUMNS + (IN_FLIGHT, COMPLETED), row)) for row in rows]
+
+def scheduler_from_env():
+    return AssignmentScheduler(os.environ.get('ASSIGNMENT_DB_PATH', DEFAULT_DB_PATH),
+                               float(os.environ.get('ASSIGNMENT_TIMEOUT_SECONDS', DEFAULT_TIMEOUT_SECONDS)))
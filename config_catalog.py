@@ -0,0 +1,214 @@
+"""
+config_catalog.py | In-memory catalog of the experiment configs under static/configs.
+
+Configs are read once and indexed by (experiment_id, condition, batch, shuffle), so choosing a config
+for a participant is a dictionary lookup rather than a directory walk. The metadata list served by
+/experiment_types is precomputed as JSON bytes.
+
+The catalog reloads itself when a config file is added, removed or rewritten (checked at most every
+CONFIG_RELOAD_SECONDS, default 10; 0 disables the check), or on SIGHUP.
+
+scripts/experiment_setup/gen_experiment_configs.py also compiles the directory into configs.bundle: every
+config plus an index and the precomputed metadata in one file. When it exists the catalog is loaded from it
+with a single read, and the reload check only looks at the bundle. Otherwise, when the directory has a
+manifest.json, only the configs it lists are loaded and the check only looks at the manifest; both are
+rewritten by the generator whenever a config changes.
+"""
+import os
+import re
+import json
+import signal
+import threading
+import time
+
+CONFIG_DIR = 'static/configs'
+MANIFEST_FILE = 'manifest.json'
+BUNDLE_FILE = 'configs.bundle'
+BUNDLE_MAGIC = b'drawgood-configs-bundle 1\n'
+CONFIG_NAME_RE = re.compile(r'^batch_(\d+)_shuffle_(\d+)\.json$')
+RELOAD_CHECK_SECONDS = float(os.environ.get('CONFIG_RELOAD_SECONDS', 10))
+
+_lock = threading.Lock()
+_catalog = None
+_checked_at = 0
+_reload_requested = False
+
+def config_key(experiment_id, condition, batch=0, shuffle=0):
+    return (experiment_id, condition, int(batch), int(shuffle))
+
+def parse_config_path(relative_path):
+    """Parses {experiment_id}/{condition}/batch_{N}_shuffle_{N}.json into a catalog key, or None."""
+    parts = relative_path.replace(os.sep, '/').split('/')
+    if len(parts) != 3:
+        return None
+    match = CONFIG_NAME_RE.match(parts[2])
+    if not match:
+        return None
+    return config_key(parts[0], parts[1], match.group(1), match.group(2))
+
+def load_manifest(config_dir):
+    """Returns {relative_path: content hash} from the directory's manifest, or None if it has none."""
+    try:
+        with open(os.path.join(config_dir, MANIFEST_FILE), 'rb') as f:
+            return json.load(f)['configs']
+    except FileNotFoundError:
+        return None
+
+def config_files(config_dir):
+    """Yields (relative_path, full_path) for every config file under config_dir (or listed in its manifest)."""
+    manifest = load_manifest(config_dir)
+    if manifest is not None:
+        for relative_path in manifest:
+            yield relative_path, os.path.join(config_dir, relative_path)
+        return
+    for root, dirs, files in os.walk(config_dir):
+        for name in files:
+            full_path = os.path.join(root, name)
+            yield os.path.relpath(full_path, config_dir), full_path
+
+def directory_signature(config_dir):
+    """Cheap change detector: the number of config files and their newest mtime."""
+    for name in (BUNDLE_FILE, MANIFEST_FILE):
+        path = os.path.join(config_dir, name)
+        if os.path.exists(path):
+            return 1, os.stat(path).st_mtime
+    n_files, latest_mtime = 0, 0
+    for _, full_path in config_files(config_dir):
+        n_files += 1
+        latest_mtime = max(latest_mtime, os.stat(full_path).st_mtime)
+    return n_files, latest_mtime
+
+def write_bundle(config_dir, relative_paths):
+    """Compiles the given configs into config_dir/configs.bundle: BUNDLE_MAGIC, a one-line JSON header with
+    each config's key and byte range and the /experiment_types metadata, then the raw configs back to back."""
+    raw_configs = {}
+    for relative_path in relative_paths:
+        key = parse_config_path(relative_path)
+        if key is None:
+            continue
+        with open(os.path.join(config_dir, relative_path), 'rb') as f:
+            raw_configs[key] = f.read()
+    index, metadata, offset = [], [], 0
+    for key in sorted(raw_configs):
+        index.append([list(key), offset, len(raw_configs[key])])
+        metadata.append(json.loads(raw_configs[key])['metadata'])
+        offset += len(raw_configs[key])
+    header = json.dumps({'configs': index, 'metadata': metadata}).encode('utf-8')
+    bundle_path = os.path.join(config_dir, BUNDLE_FILE)
+    with open(bundle_path + '.tmp', 'wb') as f:
+        f.write(BUNDLE_MAGIC + header + b'\n')
+        for key in sorted(raw_configs):
+            f.write(raw_configs[key])
+    os.replace(bundle_path + '.tmp', bundle_path)
+    return bundle_path
+
+def load_bundle(config_dir):
+    """Builds the catalog snapshot from config_dir/configs.bundle with one read."""
+    with open(os.path.join(config_dir, BUNDLE_FILE), 'rb') as f:
+        mtime = os.fstat(f.fileno()).st_mtime
+        data = f.read()
+    if not data.startswith(BUNDLE_MAGIC):
+        raise ValueError(f'Not a config bundle: {os.path.join(config_dir, BUNDLE_FILE)}')
+    header_end = data.index(b'\n', len(BUNDLE_MAGIC))
+    header = json.loads(data[len(BUNDLE_MAGIC):header_end])
+    body = memoryview(data)[header_end + 1:]
+    raw_configs = {config_key(*key): bytes(body[offset:offset + length]) for key, offset, length in header['configs']}
+    return index_configs(raw_configs, config_dir, (1, mtime), metadata=header['metadata'])
+
+def build_catalog(config_dir=CONFIG_DIR):
+    if os.path.exists(os.path.join(config_dir, BUNDLE_FILE)):
+        return load_bundle(config_dir)
+    raw_configs = {}
+    for relative_path, full_path in config_files(config_dir):
+        key = parse_config_path(relative_path)
+        if key is None:
+            continue
+        with open(full_path, 'rb') as f:
+            raw_configs[key] = f.read()
+    return index_configs(raw_configs, config_dir, directory_signature(config_dir))
+
+def index_configs(raw_configs, source, signature, metadata=None):
+    """Builds the catalog snapshot from {key: raw JSON bytes}, and the configs' metadata in key order if known."""
+    keys = sorted(raw_configs)
+    by_experiment, by_condition, by_experiment_condition = {}, {}, {}
+    parse_metadata = metadata is None
+    metadata = [] if parse_metadata else metadata
+    for key in keys:
+        experiment_id, condition, _, _ = key
+        by_experiment.setdefault(experiment_id, []).append(key)
+        by_condition.setdefault(condition, []).append(key)
+        by_experiment_condition.setdefault((experiment_id, condition), []).append(key)
+        if parse_metadata:
+            metadata.append(json.loads(raw_configs[key])['metadata'])
+    return {
+        'source': source,
+        'signature': signature,
+        'keys': keys,
+        'raw_configs': raw_configs,
+        'by_experiment': by_experiment,
+        'by_condition': by_condition,
+        'by_experiment_condition': by_experiment_condition,
+        'experiment_types_json': json.dumps(metadata).encode('utf-8'),
+        # Values computed from a config by get_derived, dropped with the snapshot on reload.
+        'derived': {},
+    }
+
+def reload(config_dir=CONFIG_DIR):
+    global _catalog, _checked_at, _reload_requested
+    catalog = build_catalog(config_dir)
+    with _lock:
+        _catalog = catalog
+        _checked_at = time.time()
+        _reload_requested = False
+    return catalog
+
+def get_catalog():
+    """Returns the current catalog, loading or reloading it if needed."""
+    global _checked_at
+    catalog = _catalog
+    if catalog is None or _reload_requested:
+        return reload()
+    if RELOAD_CHECK_SECONDS > 0 and time.time() - _checked_at > RELOAD_CHECK_SECONDS:
+        _checked_at = time.time()
+        if directory_signature(catalog['source']) != catalog['signature']:
+            return reload(catalog['source'])
+    return catalog
+
+def request_reload(*args):
+    global _reload_requested
+    _reload_requested = True
+
+def install_reload_signal():
+    """Reloads the catalog on SIGHUP. Only possible from the main thread."""
+    try:
+        signal.signal(signal.SIGHUP, request_reload)
+    except (AttributeError, ValueError):
+        pass
+
+def experiment_types_json():
+    return get_catalog()['experiment_types_json']
+
+def find_keys(experiment_id=None, condition=None):
+    catalog = get_catalog()
+    if experiment_id and condition:
+        return catalog['by_experiment_condition'].get((experiment_id, condition), [])
+    elif experiment_id:
+        return catalog['by_experiment'].get(experiment_id, [])
+    elif condition:
+        return catalog['by_condition'].get(condition, [])
+    return catalog['keys']
+
+def has_config(key):
+    return key in get_catalog()['raw_configs']
+
+def get_config(key):
+    """Returns a fresh copy of the config for key, safe for the caller to modify."""
+    return json.loads(get_catalog()['raw_configs'][key])
+
+def get_derived(key, name, compute):
+    """Returns compute(config) for the config at key, computed once per catalog snapshot and cached under name."""
+    catalog = get_catalog()
+    derived = catalog['derived']
+    if (name, key) not in derived:
+        derived[(name, key)] = compute(json.loads(catalog['raw_configs'][key]))
+    return derived[(name, key)]
@@ -1,36 +1,124 @@
 import pymongo
 import certs # Local file containing certificates.
 import json
+import logging
+import argparse
+import threading
+from datetime import datetime
+from collections import OrderedDict
+import mongo_pool
+import storage
+import metrics
+
+logger = logging.getLogger(__name__)
 
 DATABASE = 'laps'
+# One document per participant, keyed by user_id: {_id: user_id, experiment_ids: [...], first_seen: ...}
+PARTICIPANTS_COLLECTION = 'participants'
+USER_ID_INDEX = 'metadata.user_id'
+# Set on every write, so that downloads can fetch only the records that changed since the last sync.
+UPDATED_AT = 'updated_at'
 UNAME = certs.mongo_uname
 PASSWORD = certs.mongo_pwd
+CONN_STR = "mongodb+srv://%s:%s@cluster0.aqpv0.mongodb.net/%s?retryWrites=true&w=majority" % (UNAME, PASSWORD, DATABASE)
 
 def open_connection():
-    conn_str = "mongodb+srv://%s:%s@cluster0.aqpv0.mongodb.net/%s?retryWrites=true&w=majority" % (UNAME, PASSWORD, DATABASE)
-    client = pymongo.MongoClient(conn_str)
-    db = client[DATABASE]
-    return db
+    # Reuses the process-wide pooled client rather than connecting on every call.
+    with metrics.timed('connect'):
+        return mongo_pool.get_database(CONN_STR, DATABASE)
+
+def health_check():
+    return mongo_pool.health_check(CONN_STR)
+
+def connection_stats():
+    return mongo_pool.connection_stats()
+
+# Collections / participants recently handled by this process, so we only pay for these writes once.
+# Both are LRUs of at most MAX_REMEMBERED keys: one that falls out is simply written again (the writes are idempotent).
+MAX_REMEMBERED = 10000
+_indexed_collections = OrderedDict()
+_registered_participants = OrderedDict()
+_remembered_lock = threading.Lock()
+
+def seen_recently(remembered, key):
+    with _remembered_lock:
+        if key not in remembered:
+            return False
+        remembered.move_to_end(key)
+        return True
 
-def all_experiment_records(experiment_id):
+def remember(remembered, key):
+    with _remembered_lock:
+        remembered[key] = True
+        remembered.move_to_end(key)
+        while len(remembered) > MAX_REMEMBERED:
+            remembered.popitem(last=False)
+
+def experiment_collection(db, experiment_id):
+    """Returns the collection for an experiment, making sure it is indexed on metadata.user_id and updated_at."""
+    collection = db[experiment_id]
+    if not seen_recently(_indexed_collections, experiment_id):
+        with metrics.timed('create_index'):
+            collection.create_index(USER_ID_INDEX)
+            collection.create_index(UPDATED_AT)
+        remember(_indexed_collections, experiment_id)
+    return collection
+
+def register_participant(db, user_id, experiment_id):
+    key = (user_id, experiment_id)
+    if seen_recently(_registered_participants, key):
+        return
+    with metrics.timed('update_one'):
+        db[PARTICIPANTS_COLLECTION].update_one(
+            {'_id': user_id},
+            {'$addToSet': {'experiment_ids': experiment_id}, '$setOnInsert': {'first_seen': datetime.utcnow()}},
+            upsert=True)
+    remember(_registered_participants, key)
+
+def touched(fields):
+    """Adds the updated_at timestamp to a record or a $set."""
+    return dict(fields, **{UPDATED_AT: datetime.utcnow()})
+
+def all_experiment_records(experiment_id, projection=None, updated_since=None):
     db = open_connection()
     collection = db[experiment_id]
-    for record in collection.find({}):
+    query = {UPDATED_AT: {'$gt': updated_since}} if updated_since else {}
+    for record in collection.find(query, projection):
         yield record
 
 def repeat_user(user_id):
+    # We don't care about completion - if the user id was recorded for any experiment it's a repeat.
+    # Participants recorded before the registry existed only show up after backfill_participants().
     db = open_connection()
-    collections = db.list_collection_names()
-    for table_name in collections:
-        collection = db[table_name]
-        # We don't care about completion - if the user id appears anywhere else it's a repeat
-        if collection.find_one({'metadata.user_id':  user_id}):
-            return True
+    with metrics.timed('find_one'):
+        return db[PARTICIPANTS_COLLECTION].find_one({'_id': user_id}, {'_id': 1}) is not None
 
-    return False
+def backfill_participants():
+    """Builds the participants registry (and user_id indexes) from every existing experiment collection."""
+    db = open_connection()
+    participants = db[PARTICIPANTS_COLLECTION]
+    n_participants = 0
+    for experiment_id in db.list_collection_names():
+        if experiment_id == PARTICIPANTS_COLLECTION or experiment_id.startswith('system.'):
+            continue
+        collection = experiment_collection(db, experiment_id)
+        updates = []
+        for user_id in collection.distinct(USER_ID_INDEX):
+            if not user_id:
+                continue
+            updates.append(pymongo.UpdateOne(
+                {'_id': user_id},
+                {'$addToSet': {'experiment_ids': experiment_id}, '$setOnInsert': {'first_seen': datetime.utcnow()}},
+                upsert=True))
+        if updates:
+            participants.bulk_write(updates, ordered=False)
+        n_participants += len(updates)
+        print(f"Backfilled {len(updates)} participants from: {experiment_id}")
+    return n_participants
 
 def record_exists(collection, user_id):
-    result = collection.find_one({'metadata.user_id': user_id})
+    with metrics.timed('find_one'):
+        result = collection.find_one({'metadata.user_id': user_id})
     if not result:
         return False
 
@@ -45,28 +133,83 @@ def record(data):
         experiment_id = 'test'
 
     db = open_connection()
-    collection = db[experiment_id]
+    collection = experiment_collection(db, experiment_id)
 
     if record_exists(collection, user_id) and user_id != 'admin':
         return {'success': False, 'message': 'User already completed experiment'}
 
-    result = collection.replace_one({'metadata.user_id': user_id}, data, upsert=True)
+    with metrics.timed('replace_one'):
+        result = collection.replace_one({'metadata.user_id': user_id}, touched(data), upsert=True)
+    register_participant(db, user_id, experiment_id)
 
-    print(result)
+    logger.debug('replace_one', extra={'event': 'db_write', 'experiment_id': experiment_id, 'user_id': user_id,
+                                       'matched': result.matched_count, 'modified': result.modified_count})
 
     if result:
         return {'success': True, 'message': 'Successfully updated record'}
     else:
         return {'sucess': False, 'message': 'Error updating record'}
 
+def trial_update(user_id, phase, trial_index, strokes, user_description, completed=False):
+    """Query and update that append one trial, matching only if trial_index is the next slot in the phase."""
+    strokes_field = f'{phase}.strokes'
+    query = {'metadata.user_id': user_id, f'{strokes_field}.{trial_index}': {'$exists': False}}
+    if trial_index > 0:
+        query[f'{strokes_field}.{trial_index - 1}'] = {'$exists': True}
+    if user_id != 'admin':
+        query['metadata.completed'] = {'$ne': True}
+    update = {'$push': {strokes_field: strokes, f'{phase}.user_descriptions': user_description}}
+    update['$set'] = touched({'metadata.completed': True} if completed else {})
+    return query, update
+
+def record_trial(user_id, experiment_id, phase, trial_index, strokes, user_description, completed=False):
+    """Appends a single trial to an existing record.
+
+    The write only applies when trial_index is the next slot in the phase, so client retries of
+    the same trial are no-ops. If the server copy is missing or behind, we ask the client to
+    resend the full record through record().
+    """
+    if user_id == 'admin':
+        experiment_id = 'test'
+    if not storage.valid_trial(phase, trial_index):
+        return {'success': False, 'message': 'Invalid trial'}
+
+    db = open_connection()
+    collection = experiment_collection(db, experiment_id)
+    strokes_field = f'{phase}.strokes'
+    query, update = trial_update(user_id, phase, trial_index, strokes, user_description, completed)
+
+    with metrics.timed('update_one'):
+        result = collection.update_one(query, update)
+    if result.modified_count:
+        return {'success': True, 'message': 'Successfully recorded trial'}
+
+    # Nothing was written: work out whether this is a retry, a finished experiment or a gap.
+    with metrics.timed('find_one'):
+        existing = collection.find_one({'metadata.user_id': user_id}, {'metadata.completed': 1})
+    if not existing:
+        return {'success': False, 'resend_record': True, 'message': 'No record for user'}
+    with metrics.timed('find_one'):
+        already_recorded = collection.find_one({'_id': existing['_id'], f'{strokes_field}.{trial_index}': {'$exists': True}}, {'_id': 1})
+    if already_recorded:
+        if completed:
+            with metrics.timed('update_one'):
+                collection.update_one({'metadata.user_id': user_id}, {'$set': touched({'metadata.completed': True})})
+        return {'success': True, 'message': 'Trial already recorded'}
+    if existing['metadata'].get('completed') and user_id != 'admin':
+        return {'success': False, 'message': 'User already completed experiment'}
+    return {'success': False, 'resend_record': True, 'message': 'Record is missing earlier trials'}
+
 def update_record(user_id, experiment_id, data):
     db = open_connection()
-    collection = db[experiment_id]
+    collection = experiment_collection(db, experiment_id)
     query = {'metadata.user_id': user_id}
-    update = {'$set': data}
-    result = collection.update_one(query, update)
+    update = {'$set': touched(data)}
+    with metrics.timed('update_one'):
+        result = collection.update_one(query, update)
     
-    print(result)
+    logger.debug('update_one', extra={'event': 'db_write', 'experiment_id': experiment_id, 'user_id': user_id,
+                                      'matched': result.matched_count, 'modified': result.modified_count})
 
     if result:
         return {'success': True, 'message': 'Successfully updated record'}
@@ -75,10 +218,20 @@ def update_record(user_id, experiment_id, data):
 
 def get_record(user_id, experiment_id):
     db = open_connection()
-    collection = db[experiment_id]
-    res = collection.find_one({'metadata.user_id': user_id})
+    collection = experiment_collection(db, experiment_id)
+    with metrics.timed('find_one'):
+        res = collection.find_one({'metadata.user_id': user_id})
     return res
 
 if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backfill_participants',
+                        action='store_true',
+                        help="Build the participants registry from all existing experiment collections.")
+    args = parser.parse_args()
+    if args.backfill_participants:
+        print(f"Registered {backfill_participants()} participant/experiment pairs.")
+        exit(0)
+
     data = {"metadata":{"experiment_id":"TIAN_REPLICATION_0","group_type":"vertical","session_id":None,"study_id":None,"user_id":"admin"},"phases":["train","test"],"test":{"images":["S12_13_test_1.png","S12_13_test_2.png","S12_13_test_4.png","S12_13_test_5.png","S12_13_test_6.png","S12_13_test_7.png","S12_13_test_8.png","S12_13_test_9.png","S12_13_test_10.png","S12_13_test_11.png","S12_13_test_12.png"],"ui_components":["images","draw"]},"train":{"images":["S12_20.png","S12_39.png","S12_57.png","S12_79.png","S12_113.png","S12_124.png","S12_126.png","S12_133.png","S12_147.png","S12_155.png","S12_163.png","S12_200.png","S12_214.png"],"ui_components":["images","draw"],"strokes":[None],"user_descriptions":[""]}}
     record(data)
@@ -0,0 +1,35 @@
+"""
+local_sqlite.py | Shared helpers for the SQLite files the server keeps on local disk
+(sessions, assignment quotas, local participant storage).
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+class ThreadLocalConnection(object):
+    """One sqlite3 connection per thread and per process; connections must not cross a fork."""
+    def __init__(self, path, pragmas=('journal_mode=WAL', 'synchronous=NORMAL')):
+        self.path = path
+        self.pragmas = pragmas
+        self.local = threading.local()
+
+    def get(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            for pragma in self.pragmas:
+                conn.execute(f'PRAGMA {pragma}')
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+@contextmanager
+def transaction(conn):
+    """Write transaction that takes the database lock up front, so read-modify-write is atomic across processes."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
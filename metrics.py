@@ -0,0 +1,191 @@
+"""
+metrics.py | Request latency, response size and database timing metrics for the server.
+
+install(app) wraps the app in a WSGI middleware that records, per route (the URL rule, so /instructions?index=3
+and /instructions?index=4 are one route) and method:
+    drawgood_request_duration_seconds : histogram of the time spent handling the request.
+    drawgood_request_size_bytes       : histogram of request bodies.
+    drawgood_response_size_bytes      : histogram of response bodies, as sent (after compression).
+    drawgood_requests_total           : counter, also by status code.
+Database calls made through db_utils (and sqlite_storage, and write_behind's flushes) are timed separately with
+timed(operation), by operation (connect, find_one, replace_one, update_one, ...):
+    drawgood_db_operation_duration_seconds : histogram, including calls that raised.
+    drawgood_db_operation_errors_total     : counter of calls that raised.
+render() returns everything in the Prometheus text format (served by /metrics). Metrics are kept per process, so
+with several FastCGI workers each scrape only sees the worker that answered it.
+
+Requests slower than METRICS_SLOW_REQUEST_SECONDS are also logged as slow_request warnings (see
+structured_logging.py), with the route, status, sizes and how much of the time was spent in the database.
+Off when unset.
+
+Configured from the environment:
+    METRICS_ENABLED (1), METRICS_SLOW_REQUEST_SECONDS (unset)
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+import contextlib
+
+from flask import request, has_request_context
+
+import structured_logging
+
+ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+SLOW_REQUEST_SECONDS = float(os.environ.get('METRICS_SLOW_REQUEST_SECONDS') or 0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+UNMATCHED_ROUTE = 'unmatched'
+ROUTE_KEY = 'drawgood.route'
+DB_SECONDS_KEY = 'drawgood.db_seconds'
+DB_CALLS_KEY = 'drawgood.db_calls'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(label_names, labels, extra=()):
+    pairs = list(zip(label_names, labels)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(object):
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.series.items()):
+                lines.append(f'{self.name}{format_labels(self.label_names, labels)} {format_value(value)}')
+        return lines
+
+class Histogram(object):
+    """Per label set: a count per bucket (the last one for values above every bound), the sum and the count."""
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, (bucket_counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), bucket_counts):
+                    cumulative += bucket_count
+                    le = bound if bound == '+Inf' else format_value(bound)
+                    lines.append(f'{self.name}_bucket{format_labels(self.label_names, labels, [("le", le)])} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {format_value(total)}')
+                lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {count}')
+        return lines
+
+request_duration = Histogram('drawgood_request_duration_seconds', 'Time spent handling requests.',
+                             ('route', 'method'), LATENCY_BUCKETS)
+request_size = Histogram('drawgood_request_size_bytes', 'Size of request bodies.', ('route', 'method'), SIZE_BUCKETS)
+response_size = Histogram('drawgood_response_size_bytes', 'Size of response bodies as sent.', ('route', 'method'), SIZE_BUCKETS)
+requests_total = Counter('drawgood_requests_total', 'Requests handled.', ('route', 'method', 'status'))
+db_duration = Histogram('drawgood_db_operation_duration_seconds', 'Time spent in database calls.', ('operation',), LATENCY_BUCKETS)
+db_errors = Counter('drawgood_db_operation_errors_total', 'Database calls that raised.', ('operation',))
+ALL_METRICS = [request_duration, request_size, response_size, requests_total, db_duration, db_errors]
+
+logger = logging.getLogger(__name__)
+
+@contextlib.contextmanager
+def timed(operation):
+    """Times a database call. Within a request, its time is also added to the request's database time."""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        db_errors.inc((operation,))
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        db_duration.observe((operation,), duration)
+        if has_request_context():
+            environ = request.environ
+            environ[DB_SECONDS_KEY] = environ.get(DB_SECONDS_KEY, 0.0) + duration
+            environ[DB_CALLS_KEY] = environ.get(DB_CALLS_KEY, 0) + 1
+
+def tag_route():
+    # Only Flask knows which rule matched, so it is passed back to the middleware through the WSGI environ.
+    request.environ[ROUTE_KEY] = request.url_rule.rule if request.url_rule else UNMATCHED_ROUTE
+
+class MetricsMiddleware(object):
+    """Times the whole request, including loading and saving the session, which Flask's own hooks do not cover."""
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        response_info = {}
+        def recording_start_response(status, headers, exc_info=None):
+            response_info['status'] = status.split(' ', 1)[0]
+            response_info['headers'] = headers
+            return start_response(status, headers, exc_info)
+        # Flask has finished with the request (and set Content-Length) by the time it returns the body.
+        body = self.wsgi_app(environ, recording_start_response)
+        record_request(environ, response_info, time.perf_counter() - start)
+        return body
+
+def record_request(environ, response_info, duration):
+    route = environ.get(ROUTE_KEY, UNMATCHED_ROUTE)
+    labels = (route, environ.get('REQUEST_METHOD', ''))
+    status = response_info.get('status', '')
+    n_request_bytes = int(environ.get('CONTENT_LENGTH') or 0)
+    n_response_bytes = next((int(value) for name, value in response_info.get('headers', [])
+                             if name.lower() == 'content-length'), 0)
+    request_duration.observe(labels, duration)
+    request_size.observe(labels, n_request_bytes)
+    response_size.observe(labels, n_response_bytes)
+    requests_total.inc(labels + (status,))
+    if SLOW_REQUEST_SECONDS and duration >= SLOW_REQUEST_SECONDS:
+        # Flask has already finished with the request, so its context is passed explicitly.
+        query = environ.get('QUERY_STRING')
+        logger.warning('Slow request', extra={
+            'event': 'slow_request', 'request_id': environ.get(structured_logging.REQUEST_ID_KEY),
+            'route': route, 'method': labels[1], 'path': environ.get('PATH_INFO', '') + ('?' + query if query else ''),
+            'status': status, 'seconds': duration, 'db_seconds': environ.get(DB_SECONDS_KEY, 0.0),
+            'db_calls': environ.get(DB_CALLS_KEY, 0), 'request_bytes': n_request_bytes, 'response_bytes': n_response_bytes})
+
+def install(app):
+    if not ENABLED:
+        return
+    app.before_request(tag_route)
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+def render():
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,118 @@
+"""
+mongo_pool.py | Process-wide pooled MongoDB client.
+
+pymongo.MongoClient is thread-safe and keeps its own connection pool, so each process only needs one.
+The client is built lazily on first use and shared by every db_utils call. It is rebuilt after a fork,
+since pymongo clients must not be shared between a parent and its forked children (eg. FastCGI workers).
+
+Pool size and timeouts are read from the environment:
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS,
+    MONGO_CONNECT_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS, MONGO_SERVER_SELECTION_TIMEOUT_MS
+"""
+import os
+import threading
+
+import pymongo
+from pymongo import monitoring
+
+DEFAULT_MAX_POOL_SIZE = 50
+DEFAULT_MIN_POOL_SIZE = 0
+DEFAULT_MAX_IDLE_TIME_MS = 5 * 60 * 1000
+DEFAULT_CONNECT_TIMEOUT_MS = 5000
+DEFAULT_SOCKET_TIMEOUT_MS = 20000
+DEFAULT_SERVER_SELECTION_TIMEOUT_MS = 5000
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+
+# Counters so we can check that connections are actually being reused under load.
+_stats = {
+    'clients_created': 0,
+    'connections_created': 0,
+    'connections_closed': 0,
+    'connections_checked_out': 0,
+}
+
+class _ConnectionCounter(monitoring.ConnectionPoolListener):
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): pass
+    def connection_checked_in(self, event): pass
+
+    def connection_created(self, event):
+        _stats['connections_created'] += 1
+
+    def connection_closed(self, event):
+        _stats['connections_closed'] += 1
+
+    def connection_checked_out(self, event):
+        _stats['connections_checked_out'] += 1
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def client_options():
+    """Pool size and timeout options passed to every MongoClient we build."""
+    return {
+        'maxPoolSize': _env_int('MONGO_MAX_POOL_SIZE', DEFAULT_MAX_POOL_SIZE),
+        'minPoolSize': _env_int('MONGO_MIN_POOL_SIZE', DEFAULT_MIN_POOL_SIZE),
+        'maxIdleTimeMS': _env_int('MONGO_MAX_IDLE_TIME_MS', DEFAULT_MAX_IDLE_TIME_MS),
+        'connectTimeoutMS': _env_int('MONGO_CONNECT_TIMEOUT_MS', DEFAULT_CONNECT_TIMEOUT_MS),
+        'socketTimeoutMS': _env_int('MONGO_SOCKET_TIMEOUT_MS', DEFAULT_SOCKET_TIMEOUT_MS),
+        'serverSelectionTimeoutMS': _env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS', DEFAULT_SERVER_SELECTION_TIMEOUT_MS),
+    }
+
+def get_client(conn_str):
+    """Returns the shared client for this process, creating it on first use."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _lock:
+        if _client is None or _client_pid != pid:
+            # A client inherited across a fork is unusable; drop it without closing the parent's sockets.
+            _client = pymongo.MongoClient(conn_str, event_listeners=[_ConnectionCounter()], **client_options())
+            _client_pid = pid
+            _stats['clients_created'] += 1
+    return _client
+
+def get_database(conn_str, database):
+    return get_client(conn_str)[database]
+
+def health_check(conn_str):
+    """Pings the cluster through the shared client. Returns True if the server answered."""
+    try:
+        get_client(conn_str).admin.command('ping')
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
+
+def connection_stats():
+    stats = dict(_stats)
+    stats['pid'] = os.getpid()
+    stats['client_initialised'] = _client is not None and _client_pid == os.getpid()
+    return stats
+
+def close_client():
+    global _client, _client_pid
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+def _reset_after_fork():
+    global _lock, _client, _client_pid
+    _lock = threading.Lock()
+    _client = None
+    _client_pid = None
+    for key in _stats:
+        _stats[key] = 0
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
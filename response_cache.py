@@ -0,0 +1,115 @@
+"""
+response_cache.py | Compression, ETags and cached rendering for the server's responses.
+
+install(app) adds an after_request hook that, for successful GET responses with a text or JSON body:
+    - sets an ETag from a hash of the body and answers a matching If-None-Match with 304 Not Modified, so
+      reloads and revisits (eg. /experiment_config on every page load) do not resend the body;
+    - compresses the body with brotli (only if the brotli package is installed) or gzip, whichever the client
+      accepts, in that order. Compressed bodies are kept in an LRU keyed by ETag, so identical responses (the
+      same page or config served to many participants) are only compressed once.
+render_static(template) renders a template without arguments once per process. Templates edited on disk are
+only picked up after a restart.
+
+Configured from the environment:
+    RESPONSE_COMPRESSION (1), RESPONSE_MIN_COMPRESS_BYTES (500), RESPONSE_CACHE_ENTRIES (512),
+    RESPONSE_GZIP_LEVEL (6), RESPONSE_BROTLI_QUALITY (5)
+"""
+import os
+import gzip
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+
+from flask import request, render_template
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION = os.environ.get('RESPONSE_COMPRESSION', '1') == '1'
+MIN_COMPRESS_BYTES = int(os.environ.get('RESPONSE_MIN_COMPRESS_BYTES', 500))
+CACHE_ENTRIES = int(os.environ.get('RESPONSE_CACHE_ENTRIES', 512))
+GZIP_LEVEL = int(os.environ.get('RESPONSE_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('RESPONSE_BROTLI_QUALITY', 5))
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/javascript',
+                          'application/javascript', 'application/json'}
+
+class CompressedBodies(object):
+    """LRU of ETag -> compressed body."""
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, etag):
+        with self.lock:
+            body = self.entries.get(etag)
+            if body is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(etag)
+            self.hits += 1
+            return body
+
+    def put(self, etag, body):
+        with self.lock:
+            self.entries[etag] = body
+            self.entries.move_to_end(etag)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+compressed_bodies = CompressedBodies()
+
+def choose_encoding():
+    """The best encoding the current request accepts, or None."""
+    if brotli is not None and request.accept_encodings.quality('br') > 0:
+        return 'br'
+    if request.accept_encodings.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+def process_response(response):
+    if (request.method not in ('GET', 'HEAD') or response.status_code != 200 or response.direct_passthrough
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers):
+        return response
+    body = response.get_data()
+    encoding = choose_encoding() if COMPRESSION and len(body) >= MIN_COMPRESS_BYTES else None
+    if COMPRESSION:
+        response.vary.add('Accept-Encoding')
+    # Each encoding of a body is a different representation, so it gets its own ETag.
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest() + (f'-{encoding}' if encoding else '')
+    response.set_etag(etag)
+    # Browsers keep the response but check back with the ETag before reusing it.
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.make_conditional(request)
+    if response.status_code != 200 or not encoding:
+        return response
+    compressed = compressed_bodies.get(etag)
+    if compressed is None:
+        compressed = compress(body, encoding)
+        compressed_bodies.put(etag, compressed)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def install(app):
+    app.after_request(process_response)
+
+@functools.lru_cache(maxsize=None)
+def render_static(template_name):
+    """Renders a template that takes no arguments, once."""
+    return render_template(template_name)
+
+def stats():
+    return {'compressed_bodies': len(compressed_bodies.entries), 'hits': compressed_bodies.hits,
+            'misses': compressed_bodies.misses, 'brotli': brotli is not None}
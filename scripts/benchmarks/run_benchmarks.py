@@ -0,0 +1,294 @@
+"""
+run_benchmarks.py | Times the data-processing hot paths on synthetic data and flags regressions against stored baselines.
+
+Every benchmark is run at each of --scales, a number of trials (synthetic_data.py generates the data):
+    process_stroke_data                : decodes every trial (utils.process_stroke_data).
+    plotstimwrapper                    : plots every trial onto one reused axis (utils.plotstimwrapper).
+    saveDrawing                        : writes every trial as a PNG (utils.saveDrawing).
+    save_stroke_gif                    : writes every trial as a stroke-by-stroke GIF (utils.save_stroke_gif).
+    get_all_experiment_data            : downloads records of TRIALS_PER_RECORD trials from a local SQLite copy
+                                         (get_experiment_db_data.get_all_experiment_data, STORAGE_BACKEND=sqlite).
+    exclude_duplicated_users           : one user per TRIALS_PER_RECORD trials, spread over four experiments
+                                         (get_experiment_db_data.exclude_duplicated_users).
+    generate_batched_train_test_configs: a stimuli set of that many images, in batches of --config_batch_size
+                                         (gen_experiment_configs.generate_batched_train_test_configs).
+The rendering benchmarks take long enough per trial that they only run up to a smaller scale (RENDER_MAX_SCALE, and
+ANIMATION_MAX_SCALE for save_stroke_gif); larger scales are reported as skipped. get_all_experiment_data needs the
+scripts' db_utils to import (pymongo, and certs.py on the Python path); without them it is skipped too, with the
+import error printed.
+
+For each benchmark and scale we report the best time of --repeats runs, and the peak memory (tracemalloc) allocated
+while running it once, on top of its input data. Results are compared to baselines.json next to this file: a
+benchmark regresses when its time or peak memory is more than --threshold (relative) above the baseline, ignoring
+differences under --min_seconds and --min_bytes. The script exits with status 1 if anything regressed. Baselines are only
+comparable on the same machine: --update_baselines rewrites them from this run, with the machine and commit.
+
+Usage:
+    run_benchmarks.py
+    run_benchmarks.py --benchmarks process_stroke_data saveDrawing --scales 10 1000
+    run_benchmarks.py --update_baselines
+"""
+DEFAULT_SCALES = [10, 1000, 100000]
+DEFAULT_REPEATS = 3
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_MIN_SECONDS = 0.005
+DEFAULT_MIN_BYTES = 64 * 1024
+DEFAULT_CONFIG_BATCH_SIZE = 10
+DEFAULT_SEED = 0
+BASELINES_FILE = "baselines.json"
+RENDER_MAX_SCALE = 1000
+ANIMATION_MAX_SCALE = 10
+
+import os, sys, gc, json, time, random, argparse, platform, subprocess, tempfile, tracemalloc
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(BENCHMARKS_DIR, os.pardir)
+sys.path.append(SCRIPTS_DIR)
+sys.path.append(os.path.join(SCRIPTS_DIR, "data_analysis"))
+sys.path.append(os.path.join(SCRIPTS_DIR, "experiment_setup"))
+from drawgoodlib import utils
+from benchmarks import synthetic_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--benchmarks',
+                    nargs="+",
+                    default=None,
+                    help="Which benchmarks to run. Defaults to all of them.")
+parser.add_argument('--scales',
+                    nargs="+",
+                    default=DEFAULT_SCALES,
+                    type=int,
+                    help="Numbers of trials to run each benchmark on.")
+parser.add_argument('--repeats',
+                    default=DEFAULT_REPEATS,
+                    type=int,
+                    help="Time each benchmark this many times and keep the fastest.")
+parser.add_argument('--stroke_format',
+                    default=synthetic_data.COMPACT_FORMAT,
+                    choices=synthetic_data.STROKE_FORMATS,
+                    help="Format of the synthetic strokes.")
+parser.add_argument('--config_batch_size',
+                    default=DEFAULT_CONFIG_BATCH_SIZE,
+                    type=int,
+                    help="Train and test batch size for generate_batched_train_test_configs.")
+parser.add_argument('--threshold',
+                    default=DEFAULT_THRESHOLD,
+                    type=float,
+                    help="Relative increase over the baseline that counts as a regression.")
+parser.add_argument('--min_seconds',
+                    default=DEFAULT_MIN_SECONDS,
+                    type=float,
+                    help="Time differences smaller than this are never regressions.")
+parser.add_argument('--min_bytes',
+                    default=DEFAULT_MIN_BYTES,
+                    type=int,
+                    help="Peak memory differences smaller than this are never regressions.")
+parser.add_argument('--baselines',
+                    default=os.path.join(BENCHMARKS_DIR, BASELINES_FILE),
+                    help="Baseline results to compare to.")
+parser.add_argument('--update_baselines',
+                    action='store_true',
+                    help="Write this run's results as the new baselines instead of comparing.")
+parser.add_argument('--output',
+                    default=None,
+                    help="Also write this run's results (JSON) here.")
+parser.add_argument('--seed',
+                    default=DEFAULT_SEED,
+                    type=int)
+
+# Each benchmark is a setup function (args, scale, rng, tmp_dir) -> zero-argument function to measure.
+# Only the returned function is timed; setting up its input is not.
+BENCHMARK_REGISTRY = {}
+def register_benchmark(name, max_scale=None):
+    def wrapper(f):
+        BENCHMARK_REGISTRY[name] = (f, max_scale)
+        return f
+    return wrapper
+
+def synthetic_drawings(args, scale, rng):
+    return [utils.process_stroke_data(trial) for trial in synthetic_data.synthetic_trials(scale, rng, args.stroke_format)]
+
+@register_benchmark("process_stroke_data")
+def benchmark_process_stroke_data(args, scale, rng, tmp_dir):
+    trials = synthetic_data.synthetic_trials(scale, rng, args.stroke_format)
+    def run():
+        # Results are dropped as we go, as when streaming a download, so peak memory does not grow with the scale.
+        for trial in trials:
+            utils.process_stroke_data(trial)
+    return run
+
+@register_benchmark("plotstimwrapper", max_scale=RENDER_MAX_SCALE)
+def benchmark_plotstimwrapper(args, scale, rng, tmp_dir):
+    drawings = synthetic_drawings(args, scale, rng)
+    def run():
+        figure = plt.figure()
+        ax = plt.axes()
+        for drawing in drawings:
+            ax.clear()
+            utils.plotstimwrapper(ax, drawing["trialstrokes"], drawing["trialprimitives"], drawing["trialcircleparams"],
+                                  [], False, False, False)
+        plt.close(figure)
+    return run
+
+@register_benchmark("saveDrawing", max_scale=RENDER_MAX_SCALE)
+def benchmark_save_drawing(args, scale, rng, tmp_dir):
+    drawings = synthetic_drawings(args, scale, rng)
+    return lambda: [utils.saveDrawing(drawing, os.path.join(tmp_dir, f"{idx}.png")) for idx, drawing in enumerate(drawings)]
+
+@register_benchmark("save_stroke_gif", max_scale=ANIMATION_MAX_SCALE)
+def benchmark_save_stroke_gif(args, scale, rng, tmp_dir):
+    drawings = synthetic_drawings(args, scale, rng)
+    return lambda: [utils.save_stroke_gif(drawing, os.path.join(tmp_dir, f"{idx}.gif")) for idx, drawing in enumerate(drawings)]
+
+@register_benchmark("get_all_experiment_data")
+def benchmark_get_all_experiment_data(args, scale, rng, tmp_dir):
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    import get_experiment_db_data
+    import sqlite_storage
+    os.environ["STORAGE_SQLITE_PATH"] = os.path.join(tmp_dir, f"laps_{scale}.db")
+    for record in synthetic_data.synthetic_records(scale, rng, stroke_format=args.stroke_format):
+        sqlite_storage.record(record)
+    return lambda: get_experiment_db_data.get_all_experiment_data(synthetic_data.EXPERIMENT_ID, filters={})
+
+@register_benchmark("exclude_duplicated_users")
+def benchmark_exclude_duplicated_users(args, scale, rng, tmp_dir):
+    from get_experiment_db_data import exclude_duplicated_users
+    experiment_data = synthetic_data.synthetic_experiment_data(max(1, scale // synthetic_data.TRIALS_PER_RECORD), rng)
+    return lambda: exclude_duplicated_users(experiment_data)
+
+@register_benchmark("generate_batched_train_test_configs")
+def benchmark_generate_batched_train_test_configs(args, scale, rng, tmp_dir):
+    import gen_experiment_configs
+    stimuli_set = synthetic_data.synthetic_stimuli_set(scale)
+    config_args = gen_experiment_configs.parser.parse_args(["--experiments", synthetic_data.EXPERIMENT_ID])
+    config_args.train_batch_size_per_phase = config_args.test_batch_size = args.config_batch_size
+    def run():
+        random.seed(args.seed)
+        return list(gen_experiment_configs.generate_1_no_provided_language(config_args, synthetic_data.EXPERIMENT_ID, stimuli_set))
+    return run
+
+### Measurement.
+def measure(run, repeats):
+    """Returns (best time in seconds, peak bytes allocated while running). The traced run also warms up caches."""
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times = []
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times), peak_bytes
+
+def run_benchmarks(args):
+    """Returns {benchmark : {scale : {seconds, peak_bytes} or {skipped}}}, with scales as strings (JSON keys)."""
+    benchmarks = args.benchmarks or list(BENCHMARK_REGISTRY)
+    for benchmark in benchmarks:
+        if benchmark not in BENCHMARK_REGISTRY:
+            print(f"Benchmark not found: {benchmark}")
+            assert False
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for benchmark in benchmarks:
+            setup_fn, max_scale = BENCHMARK_REGISTRY[benchmark]
+            results[benchmark] = {}
+            for scale in args.scales:
+                if max_scale is not None and scale > max_scale:
+                    results[benchmark][str(scale)] = {"skipped": f"only run up to {max_scale} trials"}
+                    continue
+                try:
+                    run = setup_fn(args, scale, random.Random(f"{args.seed}_{benchmark}_{scale}"), tmp_dir)
+                except ImportError as e:
+                    results[benchmark][str(scale)] = {"skipped": f"cannot import: {e}"}
+                    print(f"{benchmark:<38}{scale:>8} trials  skipped, cannot import: {e}")
+                    continue
+                seconds, peak_bytes = measure(run, args.repeats)
+                results[benchmark][str(scale)] = {"seconds": seconds, "peak_bytes": peak_bytes}
+                print(f"{benchmark:<38}{scale:>8} trials{seconds:>12.4f}s{peak_bytes / 2**20:>10.1f} MiB")
+    return results
+
+### Baselines.
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCHMARKS_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def environment():
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+def settings(args):
+    return {"repeats": args.repeats, "stroke_format": args.stroke_format, "config_batch_size": args.config_batch_size,
+            "seed": args.seed, "pool_size": synthetic_data.DEFAULT_POOL_SIZE}
+
+def load_baselines(args):
+    if not os.path.exists(args.baselines):
+        return None
+    with open(args.baselines) as f:
+        return json.load(f)
+
+def write_baselines(args, results):
+    baselines = load_baselines(args) or {"results": {}}
+    for benchmark, scales in results.items():
+        baselines["results"].setdefault(benchmark, {}).update(scales)
+    baselines.update(environment=environment(), settings=settings(args))
+    with open(args.baselines, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+    print(f"Wrote baselines to: {args.baselines}")
+
+def find_regressions(args, results, baselines):
+    """Returns [(benchmark, scale, metric, baseline, current)] for everything above the threshold."""
+    regressions = []
+    for benchmark, scales in results.items():
+        for scale, result in scales.items():
+            baseline = baselines["results"].get(benchmark, {}).get(scale)
+            if "skipped" in result or not baseline or "skipped" in baseline:
+                continue
+            if result["seconds"] > baseline["seconds"] * (1 + args.threshold) and result["seconds"] - baseline["seconds"] > args.min_seconds:
+                regressions.append((benchmark, scale, "seconds", baseline["seconds"], result["seconds"]))
+            if result["peak_bytes"] > baseline["peak_bytes"] * (1 + args.threshold) and result["peak_bytes"] - baseline["peak_bytes"] > args.min_bytes:
+                regressions.append((benchmark, scale, "peak_bytes", baseline["peak_bytes"], result["peak_bytes"]))
+    return regressions
+
+def compare_to_baselines(args, results):
+    baselines = load_baselines(args)
+    if baselines is None:
+        print(f"No baselines found at {args.baselines}; run with --update_baselines to create them.")
+        return []
+    if baselines.get("settings") != settings(args):
+        print(f"Warning: baselines were measured with different settings: {baselines.get('settings')}")
+    if baselines.get("environment", {}).get("platform") != platform.platform():
+        print(f"Warning: baselines were measured on another machine: {baselines.get('environment')}")
+    regressions = find_regressions(args, results, baselines)
+    for benchmark, scale, metric, baseline, current in regressions:
+        print(f"REGRESSION {benchmark} at {scale} trials: {metric} {baseline:.4g} -> {current:.4g} ({current / baseline:.2f}x)")
+    print(f"{len(regressions)} regressions (threshold {args.threshold:.0%}).")
+    return regressions
+
+def main(args):
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "settings": settings(args), "results": results}, f, indent=2, sort_keys=True)
+    if args.update_baselines:
+        write_baselines(args, results)
+        return
+    if compare_to_baselines(args, results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
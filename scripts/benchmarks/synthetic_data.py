@@ -0,0 +1,89 @@
+"""
+synthetic_data.py | Synthetic participant data for benchmarks and load tests.
+
+Generators for:
+    strokes        : drawings in the sketchpad.json() format, with stroke and point counts like the recorded ones,
+                     or in the compact format of drawgoodlib/stroke_codec.py.
+    records        : experiment records as stored by the server (db_utils / sqlite_storage).
+    experiment data: the per experiment {conditions : {condition : [users]}} of a download (get_experiment_db_data.py).
+    stimuli sets   : stimuli sets as read by gen_experiment_configs.py.
+Everything is drawn from a random.Random, so the same seed gives the same data.
+"""
+import os, sys, json
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from drawgoodlib import stroke_codec
+
+SKETCHPAD_FORMAT, COMPACT_FORMAT = "sketchpad", "compact"
+STROKE_FORMATS = [COMPACT_FORMAT, SKETCHPAD_FORMAT]
+# Larger sets of trials repeat a pool of distinct drawings, so that 100k trials do not need 100k drawings in memory.
+DEFAULT_POOL_SIZE = 1000
+TRIALS_PER_RECORD = 10
+EXPERIMENT_ID = "1_no_provided_language__train-images__test-images-draw-describe-sample"
+
+def synthetic_sketchpad_strokes(rng):
+    """A drawing as sketchpad.json() writes it."""
+    strokes = []
+    t = 1.6e12 + rng.random() * 1e9
+    for _ in range(rng.randint(2, 8)):
+        n_points = rng.randint(10, 60)
+        x, y = rng.uniform(50, 450), rng.uniform(50, 450)
+        points, times = [], []
+        for _ in range(n_points):
+            x, y = x + rng.uniform(-8, 8), y + rng.uniform(-8, 8)
+            points.append([round(x, 2), round(y, 2)])
+            times.append(int(t))
+            t += rng.uniform(10, 20)
+        t += rng.uniform(200, 800)
+        path_nostring = [["M" if idx == 0 else "L"] + point for idx, point in enumerate(points)]
+        strokes.append(dict(stroke_codec.DEFAULT_ATTRIBUTES,
+                            path=stroke_codec.svg_path_string(path_nostring),
+                            times=times, pathorig=points, primitive="line", path_nostring=path_nostring, circle=[]))
+    return json.dumps(strokes)
+
+def synthetic_strokes(rng, stroke_format=COMPACT_FORMAT):
+    """A drawing as the server stores it, in either stroke format."""
+    raw_strokes = synthetic_sketchpad_strokes(rng)
+    return stroke_codec.encode_strokes(raw_strokes) if stroke_format == COMPACT_FORMAT else raw_strokes
+
+def synthetic_trials(n_trials, rng, stroke_format=COMPACT_FORMAT, pool_size=DEFAULT_POOL_SIZE):
+    pool = [synthetic_strokes(rng, stroke_format) for _ in range(min(n_trials, pool_size))]
+    return [pool[idx % len(pool)] for idx in range(n_trials)]
+
+def synthetic_records(n_trials, rng, experiment_id=EXPERIMENT_ID, stroke_format=COMPACT_FORMAT, pool_size=DEFAULT_POOL_SIZE):
+    """Yields completed records of TRIALS_PER_RECORD trials each (the last one shorter), n_trials in total."""
+    trials = synthetic_trials(n_trials, rng, stroke_format, pool_size)
+    for record_idx, start in enumerate(range(0, n_trials, TRIALS_PER_RECORD)):
+        strokes = trials[start:start + TRIALS_PER_RECORD]
+        yield {
+            "metadata": {"experiment_id": experiment_id, "user_id": f"user_{record_idx}",
+                         "condition": f"condition_S1{record_idx % 2 + 2}", "completed": True},
+            "phases": ["phase_1"],
+            "phase_1": {"images": [f"S12/S12_{idx}.png" for idx in range(len(strokes))], "ui_components": ["images", "draw"],
+                        "strokes": strokes, "user_descriptions": ["a shape"] * len(strokes)},
+        }
+
+def synthetic_experiment_data(n_users, rng, n_experiments=4, n_conditions=2, duplicated_fraction=0.05):
+    """Downloaded experiment data for exclude_duplicated_users: n_users spread over experiments and conditions,
+    with duplicated_fraction of them also taking part in a second experiment."""
+    experiments = {f"experiment_{idx}": {"conditions": {f"condition_{c}": [] for c in range(n_conditions)}}
+                   for idx in range(n_experiments)}
+    experiment_ids = list(experiments)
+    for user_idx in range(n_users):
+        user = f"user_{user_idx}"
+        n_taken = 2 if rng.random() < duplicated_fraction and n_experiments > 1 else 1
+        for experiment_id in rng.sample(experiment_ids, n_taken):
+            experiments[experiment_id]["conditions"][f"condition_{rng.randrange(n_conditions)}"].append(user)
+    return {"metadata": {}, "experiment_ids": experiments}
+
+def synthetic_stimuli_set(n_stimuli, n_conditions=2, n_train_phases=2):
+    """A stimuli set of about n_stimuli images, split evenly between the train phases of every condition and one test phase."""
+    n_phases = n_conditions * n_train_phases + 1
+    per_phase = max(1, n_stimuli // n_phases)
+    images = iter(f"S{12 + idx % 2}/S{12 + idx % 2}_{idx}.png" for idx in range(per_phase * n_phases))
+    return {
+        "metadata": {"name": "synthetic", "description": f"{n_stimuli} synthetic stimuli"},
+        "train": {f"condition_S{12 + c}": [[next(images) for _ in range(per_phase)] for _ in range(n_train_phases)]
+                  for c in range(n_conditions)},
+        "test": {"all": [[next(images) for _ in range(per_phase)]]},
+    }
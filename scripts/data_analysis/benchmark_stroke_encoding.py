@@ -0,0 +1,85 @@
+"""
+benchmark_stroke_encoding.py | Compares the size and decode speed of the stroke encodings of drawgoodlib/stroke_codec.py.
+
+Reads the trials of a downloaded experiment group (either output format, see build_stroke_dataset.py) and, for
+the sketchpad JSON they were recorded in and the compact encoding with and without --binary packing, reports:
+    bytes, gzip bytes   : total size of every trial's stroke string, as stored and as sent compressed.
+    process_stroke_data : seconds to decode every trial with utils.process_stroke_data.
+    parse_stroke_batch  : seconds to parse every trial with stroke_batch.parse_stroke_batch.
+Decode times are the best of --repeats runs.
+
+Usage:
+    benchmark_stroke_encoding.py --experiment_group 0.1
+"""
+DEFAULT_TOP_LEVEL_OUTPUT_DIR = "data_experiment"
+DEFAULT_EXPERIMENT_DIR = "laps_{}/raw"
+DEFAULT_REPEATS = 3
+
+import os, sys, gzip, time, argparse
+
+from experiment_constants import *
+from build_stroke_dataset import iter_export_records
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from drawgoodlib import stroke_codec, stroke_batch, utils
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--experiment_group",
+                    required=True,
+                    help="Which downloaded experiment group to benchmark on.")
+parser.add_argument('--output_dir',
+                    default=DEFAULT_TOP_LEVEL_OUTPUT_DIR,
+                    help="Top level directory containing the experiment data.")
+parser.add_argument('--repeats',
+                    default=DEFAULT_REPEATS,
+                    type=int,
+                    help="Decode each encoding this many times and keep the fastest.")
+
+def load_sketchpad_trials(raw_dir):
+    """The non-empty trials of a download, in the sketchpad format."""
+    trials = []
+    for _, user_record in iter_export_records(raw_dir):
+        if user_record is None:
+            continue
+        for raw_strokes in user_record[STROKES]:
+            if raw_strokes and isinstance(raw_strokes, str) and not stroke_codec.is_encoded(raw_strokes):
+                trials.append(raw_strokes)
+    return trials
+
+def best_time(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def benchmark_encoding(args, trials):
+    n_bytes = sum(len(trial.encode("utf-8")) for trial in trials)
+    n_gzip_bytes = sum(len(gzip.compress(trial.encode("utf-8"))) for trial in trials)
+    process_time = best_time(lambda: [utils.process_stroke_data(trial) for trial in trials], args.repeats)
+    batch_time = best_time(lambda: stroke_batch.parse_stroke_batch(trials), args.repeats)
+    return n_bytes, n_gzip_bytes, process_time, batch_time
+
+def benchmark_stroke_encoding(args):
+    raw_dir = os.path.join(args.output_dir, DEFAULT_EXPERIMENT_DIR.format(args.experiment_group))
+    sketchpad_trials = load_sketchpad_trials(raw_dir)
+    encodings = {
+        "sketchpad json": sketchpad_trials,
+        "compact": [stroke_codec.encode_strokes(trial) for trial in sketchpad_trials],
+        "compact binary": [stroke_codec.encode_strokes(trial, binary=True) for trial in sketchpad_trials],
+    }
+    print(f"{len(sketchpad_trials)} trials")
+    print(f"{'encoding':<16}{'bytes':>12}{'gzip bytes':>12}{'ratio':>8}{'process_stroke_data s':>24}{'parse_stroke_batch s':>22}")
+    baseline_bytes = None
+    for name, trials in encodings.items():
+        n_bytes, n_gzip_bytes, process_time, batch_time = benchmark_encoding(args, trials)
+        baseline_bytes = baseline_bytes or n_bytes
+        print(f"{name:<16}{n_bytes:>12}{n_gzip_bytes:>12}{baseline_bytes / max(n_bytes, 1):>7.1f}x{process_time:>24.4f}{batch_time:>22.4f}")
+
+def main(args):
+    benchmark_stroke_encoding(args)
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
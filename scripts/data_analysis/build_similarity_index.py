@@ -0,0 +1,133 @@
+"""
+build_similarity_index.py | Builds drawgoodlib/similarity.py indexes for a downloaded experiment group.
+
+Reads the output of get_experiment_db_data.py (either output format, see build_stroke_dataset.py) and writes:
+    data_experiment/laps_X/similarity/drawings
+        One descriptor per non-empty trial, with ids "<experiment_id>/<user_id>/<trial_number>".
+    data_experiment/laps_X/similarity/stimuli
+        One descriptor per distinct stimulus image the trials refer to, with the image path as id. Images are
+        looked up relative to --images_root (static/images/stim, as the experiment pages do); images that are not
+        on disk are skipped, and the script stops if none of them are.
+With --nearest_stimuli, also writes data_experiment/laps_X/similarity/nearest_stimuli.csv: the --k stimuli most
+similar to each drawing (e.g. which training images a sample from a sampling phase resembles).
+
+Usage:
+    build_similarity_index.py --experiment_group 0.1 --n_lists 64 --nearest_stimuli
+
+Loading:
+    from drawgoodlib.similarity import SimilarityIndex
+    index = SimilarityIndex.load("data_experiment/laps_0.1/similarity/drawings")
+    scores, neighbours = index.search(index.vectors[:10], k=5)
+"""
+DEFAULT_TOP_LEVEL_OUTPUT_DIR = "data_experiment"
+DEFAULT_EXPERIMENT_DIR = "laps_{}/raw"
+DEFAULT_SIMILARITY_DIR = "laps_{}/similarity"
+DEFAULT_DRAWINGS_INDEX = "drawings"
+DEFAULT_STIMULI_INDEX = "stimuli"
+DEFAULT_NEAREST_STIMULI_FILE = "nearest_stimuli.csv"
+DEFAULT_IMAGES_ROOT = "static/images/stim"
+
+import os, sys, csv, argparse
+import pathlib
+import numpy as np
+
+from experiment_constants import *
+from build_stroke_dataset import iter_export_records
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from drawgoodlib import similarity
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--experiment_group",
+                    required=True,
+                    help="Which downloaded experiment group to index.")
+parser.add_argument('--output_dir',
+                    default=DEFAULT_TOP_LEVEL_OUTPUT_DIR,
+                    help="Top level directory containing the experiment data.")
+parser.add_argument('--images_root',
+                    default=DEFAULT_IMAGES_ROOT,
+                    help="Directory the stimulus image paths in the trials are relative to.")
+parser.add_argument('--n_lists',
+                    default=0,
+                    type=int,
+                    help="Coarse quantiser lists for the drawings index. 0 searches exhaustively.")
+parser.add_argument('--n_processes',
+                    default=None,
+                    type=int,
+                    help="Compute drawing descriptors across this many processes.")
+parser.add_argument('--nearest_stimuli',
+                    action='store_true',
+                    help="Also write the k nearest stimuli of every drawing.")
+parser.add_argument('--k',
+                    default=similarity.DEFAULT_K,
+                    type=int,
+                    help="Neighbours per drawing for --nearest_stimuli.")
+
+def iter_drawings(raw_dir):
+    """Yields (drawing id, stimulus image, raw strokes) for every non-empty trial in a download."""
+    for _, user_record in iter_export_records(raw_dir):
+        if user_record is None:
+            continue
+        images = user_record[IMAGES]
+        for trial_number, raw_strokes in enumerate(user_record[STROKES]):
+            if not raw_strokes:
+                continue
+            drawing_id = f"{user_record[EXPERIMENT_ID]}/{user_record[USER_ID]}/{trial_number}"
+            yield drawing_id, images[trial_number] if trial_number < len(images) else None, raw_strokes
+
+def build_stimuli_index(args, stimulus_images):
+    ids, descriptors = [], []
+    for image in sorted(stimulus_images):
+        image_path = os.path.join(args.images_root, image)
+        if os.path.exists(image_path):
+            ids.append(image)
+            descriptors.append(similarity.image_descriptor(image_path))
+    if stimulus_images and not ids:
+        sys.exit(f"None of the {len(stimulus_images)} stimulus images were found under: {args.images_root}. "
+                 "Set --images_root to the directory the trial image paths are relative to.")
+    if len(ids) < len(stimulus_images):
+        print(f"Skipped {len(stimulus_images) - len(ids)} stimulus images not found under: {args.images_root}")
+    return similarity.SimilarityIndex.build(np.array(descriptors).reshape(len(ids), -1), ids)
+
+def write_nearest_stimuli(args, drawings_index, stimuli_index, output_path):
+    scores, neighbours = stimuli_index.search(drawings_index.vectors, k=args.k)
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["drawing_id", "rank", "stimulus", "similarity"])
+        for drawing_id, drawing_scores, drawing_neighbours in zip(drawings_index.ids, scores, neighbours):
+            for rank, (score, neighbour) in enumerate(zip(drawing_scores, drawing_neighbours)):
+                if neighbour >= 0:
+                    writer.writerow([drawing_id, rank, stimuli_index.ids[neighbour], f"{score:.4f}"])
+
+def build_similarity_index(args):
+    raw_dir = os.path.join(args.output_dir, DEFAULT_EXPERIMENT_DIR.format(args.experiment_group))
+    similarity_dir = os.path.join(args.output_dir, DEFAULT_SIMILARITY_DIR.format(args.experiment_group))
+    pathlib.Path(similarity_dir).mkdir(parents=True, exist_ok=True)
+
+    drawing_ids, raw_strokes, stimulus_images = [], [], set()
+    for drawing_id, image, raw in iter_drawings(raw_dir):
+        drawing_ids.append(drawing_id)
+        raw_strokes.append(raw)
+        if image:
+            stimulus_images.add(image)
+    if not stimulus_images:
+        sys.exit(f"No trials with stimulus images found in: {raw_dir}")
+    # Stimuli first: they are quick to check, and the script stops there if the images are missing.
+    stimuli_index = build_stimuli_index(args, stimulus_images)
+    drawings_index = similarity.SimilarityIndex.build(similarity.drawing_descriptors(raw_strokes, args.n_processes),
+                                                      drawing_ids, n_lists=args.n_lists)
+    drawings_index.save(os.path.join(similarity_dir, DEFAULT_DRAWINGS_INDEX))
+    stimuli_index.save(os.path.join(similarity_dir, DEFAULT_STIMULI_INDEX))
+    print(f"Indexed {len(drawings_index)} drawings and {len(stimuli_index)} stimuli in: {similarity_dir}")
+
+    if args.nearest_stimuli:
+        nearest_stimuli_path = os.path.join(similarity_dir, DEFAULT_NEAREST_STIMULI_FILE)
+        write_nearest_stimuli(args, drawings_index, stimuli_index, nearest_stimuli_path)
+        print(f"Wrote the {args.k} nearest stimuli of each drawing to: {nearest_stimuli_path}")
+
+def main(args):
+    build_similarity_index(args)
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
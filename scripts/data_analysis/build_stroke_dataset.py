@@ -0,0 +1,85 @@
+"""
+build_stroke_dataset.py | Converts a downloaded experiment group into the columnar stroke format (drawgoodlib/stroke_dataset.py).
+
+Reads the output of get_experiment_db_data.py from data_experiment/laps_X/raw: experiment_records.jsonl if it
+exists (streamed, so memory stays constant), otherwise raw_experiment_data.json. Writes:
+    data_experiment/laps_X/stroke_dataset/
+The group's exclusion_users are stored in the dataset metadata.
+
+Usage:
+    build_stroke_dataset.py --experiment_group 0.1
+
+Loading:
+    from drawgoodlib.stroke_dataset import StrokeDataset
+    dataset = StrokeDataset("data_experiment/laps_0.1/stroke_dataset")
+    x, y, t, stroke_offsets = dataset.trial_points(0)
+"""
+DEFAULT_TOP_LEVEL_OUTPUT_DIR = "data_experiment"
+DEFAULT_EXPERIMENT_DIR = "laps_{}/raw"
+DEFAULT_STROKE_DATASET_DIR = "laps_{}/stroke_dataset"
+DEFAULT_OUTPUT_DATA_FILE = "raw_experiment_data.json"
+DEFAULT_OUTPUT_RECORDS_FILE = "experiment_records.jsonl"
+DEFAULT_OUTPUT_SUMMARY_FILE = "experiment_summary.json"
+
+import os, sys, json, argparse
+
+from experiment_constants import *
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from drawgoodlib.stroke_dataset import StrokeDatasetWriter, StrokeDataset
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--experiment_group",
+                    required=True,
+                    help="Which downloaded experiment group to convert.")
+parser.add_argument('--output_dir',
+                    default=DEFAULT_TOP_LEVEL_OUTPUT_DIR,
+                    help="Top level directory containing the experiment data.")
+
+def iter_export_records(raw_dir):
+    """Yields (group metadata, None) first, then the flattened per-user records of a download in either format."""
+    records_path = os.path.join(raw_dir, DEFAULT_OUTPUT_RECORDS_FILE)
+    if os.path.exists(records_path):
+        with open(os.path.join(raw_dir, DEFAULT_OUTPUT_SUMMARY_FILE)) as f:
+            yield json.load(f)[METADATA], None
+        with open(records_path) as f:
+            for line in f:
+                yield None, json.loads(line)
+        return
+    with open(os.path.join(raw_dir, DEFAULT_OUTPUT_DATA_FILE)) as f:
+        experiment_data = json.load(f)
+    yield experiment_data[METADATA], None
+    for experiment_id, experiment in experiment_data[EXPERIMENT_IDS].items():
+        for condition, users in experiment[CONDITIONS].items():
+            for user_id in users:
+                yield None, {
+                    EXPERIMENT_ID : experiment_id,
+                    USER_ID : user_id,
+                    CONDITION : condition,
+                    IMAGES : experiment[IMAGES][user_id],
+                    STROKES : experiment[STROKES][user_id],
+                    TRIAL_PHASES : experiment.get(TRIAL_PHASES, {}).get(user_id, []),
+                }
+
+def build_stroke_dataset(args):
+    raw_dir = os.path.join(args.output_dir, DEFAULT_EXPERIMENT_DIR.format(args.experiment_group))
+    dataset_dir = os.path.join(args.output_dir, DEFAULT_STROKE_DATASET_DIR.format(args.experiment_group))
+    writer = StrokeDatasetWriter(dataset_dir)
+    for group_metadata, user_record in iter_export_records(raw_dir):
+        if group_metadata is not None:
+            writer.metadata = {EXPERIMENT_GROUP : args.experiment_group,
+                               TIMESTAMP : group_metadata.get(TIMESTAMP),
+                               EXCLUSION_USERS : group_metadata.get(EXCLUSION_USERS, [])}
+            continue
+        writer.add_user_record(user_record)
+    writer.close()
+    dataset = StrokeDataset(dataset_dir)
+    print(f"Wrote {len(dataset)} trials, {dataset.index['n_strokes']} strokes, {dataset.index['n_points']} points to: {dataset_dir}")
+    return dataset
+
+def main(args):
+    build_stroke_dataset(args)
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
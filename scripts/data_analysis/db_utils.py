@@ -1,23 +1,48 @@
+import os, sys
 import pymongo
 import certs # Local file containing certificates.
 import json
+from datetime import datetime
+
+# The pooled client and the storage backends live at the top level of the repository, next to the server's db_utils.
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+if REPO_ROOT not in sys.path:
+    sys.path.append(REPO_ROOT)
+import mongo_pool
+import storage
 
 DATABASE = 'laps'
 UNAME = certs.mongo_uname
 PASSWORD = certs.mongo_pwd
+CONN_STR = "mongodb+srv://%s:%s@cluster0.aqpv0.mongodb.net/%s?retryWrites=true&w=majority" % (UNAME, PASSWORD, DATABASE)
 
 def open_connection():
-    conn_str = "mongodb+srv://%s:%s@cluster0.aqpv0.mongodb.net/%s?retryWrites=true&w=majority" % (UNAME, PASSWORD, DATABASE)
-    client = pymongo.MongoClient(conn_str)
-    db = client[DATABASE]
-    return db
+    return mongo_pool.get_database(CONN_STR, DATABASE)
+
+def connection_stats():
+    return mongo_pool.connection_stats()
 
-def all_experiment_records(experiment_id):
+def all_experiment_records(experiment_id, projection=None, updated_since=None):
+    """Yields the records of an experiment, or only those written after updated_since (a UTC datetime)."""
+    if storage.backend_name() != 'mongo':
+        # eg. STORAGE_BACKEND=sqlite to download from a local copy instead of the cluster.
+        yield from storage.get_backend().all_experiment_records(experiment_id, projection, updated_since)
+        return
     db = open_connection()
     collection = db[experiment_id]
-    for record in collection.find({}):
+    query = {'updated_at': {'$gt': updated_since}} if updated_since else {}
+    for record in collection.find(query, projection):
         yield record
 
+def experiment_phases(experiment_id, updated_since=None):
+    """The phase names listed by the records of an experiment (or by those written after updated_since)."""
+    if storage.backend_name() != 'mongo':
+        # Other backends return whole records and ignore projections.
+        return []
+    db = open_connection()
+    query = {'updated_at': {'$gt': updated_since}} if updated_since else {}
+    return db[experiment_id].distinct('phases', query)
+
 def record_exists(collection, data):
     user_id = data['metadata']['user_id']
     result = collection.find_one({'metadata.user_id': user_id})
@@ -40,7 +65,7 @@ def record(data):
     if record_exists(collection, data):
         return {'success': False, 'message': 'User already completed experiment'}
 
-    result = collection.replace_one({'metadata.user_id': user_id}, data, upsert=True)
+    result = collection.replace_one({'metadata.user_id': user_id}, dict(data, updated_at=datetime.utcnow()), upsert=True)
 
     print(result)
 
@@ -50,10 +75,12 @@ def record(data):
         return {'sucess': False, 'message': 'Error updating record'}
 
 def update_record(user_id, experiment_id, data):
+    if storage.backend_name() != 'mongo':
+        return storage.get_backend().update_record(user_id, experiment_id, data)
     db = open_connection()
     collection = db[experiment_id]
     query = {'metadata.user_id': user_id}
-    update = {'$set': data}
+    update = {'$set': dict(data, updated_at=datetime.utcnow())}
     result = collection.update_one(query, update)
     
     print(result)
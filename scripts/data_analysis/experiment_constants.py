@@ -17,6 +17,7 @@ DESCRIPTION = "description"
 DESCRIPTIONS = "descriptions"
 LANGUAGE = "language"
 TIMESTAMP = "timestamp"
+UPDATED_AT = "updated_at"
 LANGUAGE_SET = "language_set"
 STIMULI_SET = "stimuli_set"
 TRAIN = "train"
@@ -34,6 +35,7 @@ EXPERIMENT_PHASE = "phase"
 UI_COMPONENTS = "ui_components"
 IMAGES = "images"
 STROKES = "strokes"
+TRIAL_PHASES = "trial_phases"
 
 SUMMARY = "summary"
 TOTAL_USERS = "total_users"
@@ -0,0 +1,88 @@
+"""
+extract_stroke_features.py | Writes the drawgoodlib/features.py feature table for a downloaded experiment group.
+
+Reads the output of get_experiment_db_data.py (either output format, see build_stroke_dataset.py) and writes:
+    data_experiment/laps_X/features/trial_features.csv
+        One row per trial: experiment_id, user_id, condition, trial_number, image, phase, then features.FEATURES.
+    data_experiment/laps_X/features/feature_cache.npz
+        Features keyed by a hash of each trial's raw strokes: re-running after an --incremental download only
+        computes the trials that are new or changed.
+
+Usage:
+    extract_stroke_features.py --experiment_group 0.1
+"""
+DEFAULT_TOP_LEVEL_OUTPUT_DIR = "data_experiment"
+DEFAULT_EXPERIMENT_DIR = "laps_{}/raw"
+DEFAULT_FEATURES_DIR = "laps_{}/features"
+DEFAULT_FEATURES_FILE = "trial_features.csv"
+DEFAULT_FEATURE_CACHE_FILE = "feature_cache.npz"
+TRIALS_PER_BATCH = 5000
+
+import os, sys, csv, argparse
+import pathlib
+
+from experiment_constants import *
+from build_stroke_dataset import iter_export_records
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from drawgoodlib import features
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--experiment_group",
+                    required=True,
+                    help="Which downloaded experiment group to extract features for.")
+parser.add_argument('--output_dir',
+                    default=DEFAULT_TOP_LEVEL_OUTPUT_DIR,
+                    help="Top level directory containing the experiment data.")
+parser.add_argument('--n_processes',
+                    default=None,
+                    type=int,
+                    help="Parse strokes across this many processes.")
+
+TRIAL_COLUMNS = [EXPERIMENT_ID, USER_ID, CONDITION, "trial_number", "image", "phase"]
+
+def iter_trials(raw_dir):
+    """Yields (trial columns, raw strokes) for every trial in a download."""
+    for _, user_record in iter_export_records(raw_dir):
+        if user_record is None:
+            continue
+        images, trial_phases = user_record[IMAGES], user_record.get(TRIAL_PHASES) or []
+        for trial_number, raw_strokes in enumerate(user_record[STROKES]):
+            yield [user_record[EXPERIMENT_ID], user_record[USER_ID], user_record[CONDITION], trial_number,
+                   images[trial_number] if trial_number < len(images) else "",
+                   trial_phases[trial_number] if trial_number < len(trial_phases) else ""], raw_strokes
+
+def extract_stroke_features(args):
+    raw_dir = os.path.join(args.output_dir, DEFAULT_EXPERIMENT_DIR.format(args.experiment_group))
+    features_dir = os.path.join(args.output_dir, DEFAULT_FEATURES_DIR.format(args.experiment_group))
+    pathlib.Path(features_dir).mkdir(parents=True, exist_ok=True)
+    cache = features.FeatureCache(os.path.join(features_dir, DEFAULT_FEATURE_CACHE_FILE))
+    n_cached = len(cache)
+
+    features_path = os.path.join(features_dir, DEFAULT_FEATURES_FILE)
+    n_trials = 0
+    with open(features_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(TRIAL_COLUMNS + features.FEATURES)
+        def write_batch(trial_columns, raw_strokes):
+            table = features.extract_features(raw_strokes, cache=cache, n_processes=args.n_processes)
+            writer.writerows(columns + row.tolist() for columns, row in zip(trial_columns, table))
+        trial_columns, raw_strokes = [], []
+        for columns, raw in iter_trials(raw_dir):
+            trial_columns.append(columns)
+            raw_strokes.append(raw)
+            n_trials += 1
+            if len(raw_strokes) == TRIALS_PER_BATCH:
+                write_batch(trial_columns, raw_strokes)
+                trial_columns, raw_strokes = [], []
+        if raw_strokes:
+            write_batch(trial_columns, raw_strokes)
+    cache.save()
+    print(f"Wrote features for {n_trials} trials ({len(cache) - n_cached} newly computed) to: {features_path}")
+
+def main(args):
+    extract_stroke_features(args)
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
@@ -3,7 +3,7 @@ get_experiment_db_data.py | Author : Catherine Wong.
 Utility functions to download data from the MongoDB experiment server for various experiment groups.
 This file is oriented towards experiment replication: it contains fine-grained rules for determining what to download from the server for each experiment group (eg. drawlang_X.X), and creates metadata files about each experiment group.
 
-This writes out data to:
+With --output_format json (default), this writes out data to:
     data_experiment/drawlang_X.X/raw/raw_experiment_data.json
 We currently group all of the experiments (and their conditions) into one file.
         metadata: metadata about the experiment group
@@ -14,19 +14,43 @@ We currently group all of the experiments (and their conditions) into one file.
                 images: {user : [ordered list of image paths seen by a user, or SAMPLE_X for samples]}
                 metadata : {user: experiment metadata}
                 strokes: {user : [ordered list of [stroke arrays] corresponding to images]}
+                trial_phases: {user : [phase of each entry in strokes]}
                 descriptions : {user : [ordered list of descriptions corresponding to images]}
 
+With --output_format jsonl, records are streamed to disk as they are downloaded, so memory stays constant
+regardless of group size:
+    data_experiment/drawlang_X.X/raw/experiment_records.jsonl
+        One line per user: {experiment_id, user_id, condition, updated_at, metadata, images, strokes, trial_phases, descriptions}
+        (trial_phases is the phase of each entry in strokes)
+    data_experiment/drawlang_X.X/raw/experiment_summary.json
+        raw_experiment_data.json without the per-user data: metadata, and per experiment its summary and conditions.
+
+Experiments in a group are downloaded concurrently (--n_download_threads), fetching only the fields we use.
+
+With --incremental, only records written since the last download are fetched and merged into the existing files
+(see sync_state_<output_format>.json in the same directory); summary counts and excluded users are recomputed from the merged data.
+
 Usage:
     get_experiment_db_data.py --experiment_group 0.0
+    get_experiment_db_data.py --experiment_group 0.0 --incremental
 """
 DEFAULT_TOP_LEVEL_OUTPUT_DIR = "data_experiment"
 DEFAULT_EXPERIMENT_DIR = "laps_{}/raw"
 DEFAULT_OUTPUT_DATA_FILE = "raw_experiment_data.json"
+DEFAULT_OUTPUT_RECORDS_FILE = "experiment_records.jsonl"
+DEFAULT_OUTPUT_SUMMARY_FILE = "experiment_summary.json"
+DEFAULT_SYNC_STATE_FILE = "sync_state_{}.json"
+DEFAULT_N_DOWNLOAD_THREADS = 4
+SYNC_OVERLAP_SECONDS = 5 * 60
+SYNC_EPOCH = "1970-01-01T00:00:00.000000"
+JSON_FORMAT, JSONL_FORMAT = "json", "jsonl"
 
 import os, json, argparse, random, copy
 import pathlib
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import db_utils
 from experiment_constants import *
@@ -38,6 +62,17 @@ parser.add_argument("--experiment_group",
 parser.add_argument('--output_dir', 
                     default=DEFAULT_TOP_LEVEL_OUTPUT_DIR,
                     help="Top level directory under which we will write out the experiment data.")
+parser.add_argument('--output_format',
+                    default=JSON_FORMAT,
+                    choices=[JSON_FORMAT, JSONL_FORMAT],
+                    help="json: one raw_experiment_data.json file. jsonl: stream per-user records plus a summary file.")
+parser.add_argument('--n_download_threads',
+                    default=DEFAULT_N_DOWNLOAD_THREADS,
+                    type=int,
+                    help="How many experiments to download concurrently.")
+parser.add_argument('--incremental',
+                    action='store_true',
+                    help="Only download records that are new or changed since the last download, and merge them into it.")
 
 # Registered experiments groups. Each one of these determines which experiment_ids we cluster together, exclusions on the user_ids, etc.
 EXPERIMENT_GROUP_REGISTRY = {}
@@ -82,20 +117,116 @@ def download_data_0_0(args, experiment_group):
     return get_experiment_group_data(args, experiment_group, description, experiment_ids, filters)
 
 ### Utility functions for getting data.``
+def record_projection(experiment_id, updated_since=None):
+    """Only the fields the download uses, for every phase the experiment's records list: phase_1...phase_N
+    (see gen_experiment_configs.py), however many there are, or the names of older experiments."""
+    projection = {"_id": 0, METADATA: 1, EXPERIMENT_PHASES: 1, UPDATED_AT: 1}
+    for phase in db_utils.experiment_phases(experiment_id, updated_since):
+        for field in (IMAGES, STROKES, USER_DESCRIPTIONS):
+            projection[f"{phase}.{field}"] = 1
+    return projection
+
 def get_experiment_group_data(args, experiment_group, description, experiment_ids, filters):
+    if args.output_format == JSONL_FORMAT:
+        return stream_experiment_group_data(args, experiment_group, description, experiment_ids, filters)
+    output_dir = get_output_dir(args, experiment_group)
+    sync_state = load_sync_state(args, output_dir, DEFAULT_OUTPUT_DATA_FILE)
+    previous_experiments = {}
+    if sync_state[EXPERIMENT_IDS]:
+        with open(os.path.join(output_dir, DEFAULT_OUTPUT_DATA_FILE)) as f:
+            previous_experiments = json.load(f)[EXPERIMENT_IDS]
+    
     experiment_data = {}
     # Generate base metadata.
     metadata = generate_base_metadata(args, experiment_group, description, experiment_ids)
     experiment_data[METADATA] = metadata
     
-    # Download data for each experiment.
-    experiment_data[EXPERIMENT_IDS] = {
-        experiment_id : get_all_experiment_data(experiment_id, filters) for experiment_id in experiment_ids 
-    }
+    # Download data for each experiment, merging it into the previous download if there is one.
+    def sync_experiment(experiment_id):
+        return get_all_experiment_data(experiment_id, filters, sync_state, previous_experiments.get(experiment_id))
+    with ThreadPoolExecutor(args.n_download_threads) as executor:
+        all_experiment_data = executor.map(sync_experiment, experiment_ids)
+    experiment_data[EXPERIMENT_IDS] = dict(zip(experiment_ids, all_experiment_data))
     # Exclude any participants who appear multiple times in the data
     exclude_duplicated_users(experiment_data)
+    write_sync_state(args, output_dir, sync_state)
     return experiment_data
 
+def stream_experiment_group_data(args, experiment_group, description, experiment_ids, filters):
+    """Writes one line per user record as it arrives, then a summary file. Returns the summary.
+
+    With --incremental, new and changed records are streamed to a separate file and then merged with the
+    records that did not change."""
+    experiment_summary = {
+        METADATA : generate_base_metadata(args, experiment_group, description, experiment_ids)
+    }
+    output_dir = get_output_dir(args, experiment_group)
+    records_path = os.path.join(output_dir, DEFAULT_OUTPUT_RECORDS_FILE)
+    summary_path = os.path.join(output_dir, DEFAULT_OUTPUT_SUMMARY_FILE)
+    sync_state = load_sync_state(args, output_dir, DEFAULT_OUTPUT_RECORDS_FILE)
+    merge_with_previous = bool(sync_state[EXPERIMENT_IDS])
+    previous_experiments = {}
+    if merge_with_previous:
+        with open(summary_path) as f:
+            previous_experiments = json.load(f)[EXPERIMENT_IDS]
+    
+    updated_records_path = records_path + ".updated"
+    print(f"Streaming experiment group records to: {updated_records_path}")
+    write_lock = threading.Lock()
+    updated_users = set()
+    with open(updated_records_path, 'w') as f:
+        def stream_experiment(experiment_id):
+            previous_experiment = previous_experiments.get(experiment_id, {})
+            conditions = previous_experiment.get(CONDITIONS, {})
+            updated_conditions = {}
+            for user_record in iter_user_records(experiment_id, filters, sync_state):
+                updated_conditions[user_record[USER_ID]] = user_record[CONDITION]
+                line = json.dumps(user_record) + "\n"
+                with write_lock:
+                    f.write(line)
+                    updated_users.add((experiment_id, user_record[USER_ID]))
+            conditions = merge_conditions(conditions, updated_conditions)
+            return {
+                SUMMARY : {TOTAL_USERS : sum([len(users) for users in conditions.values()])},
+                CONDITIONS : conditions
+            }
+        with ThreadPoolExecutor(args.n_download_threads) as executor:
+            experiment_summary[EXPERIMENT_IDS] = dict(zip(experiment_ids, executor.map(stream_experiment, experiment_ids)))
+    exclude_duplicated_users(experiment_summary)
+    
+    # Keep the unchanged records from the last download, then add the updated ones.
+    merged_records_path = records_path + ".merged"
+    print(f"Merging {len(updated_users)} new or updated records into: {records_path}")
+    with open(merged_records_path, 'w') as merged_file:
+        if merge_with_previous:
+            with open(records_path) as f:
+                for line in f:
+                    user_record = json.loads(line)
+                    if user_record[EXPERIMENT_ID] in experiment_ids and (user_record[EXPERIMENT_ID], user_record[USER_ID]) not in updated_users:
+                        merged_file.write(line)
+        with open(updated_records_path) as f:
+            for line in f:
+                merged_file.write(line)
+    os.replace(merged_records_path, records_path)
+    os.remove(updated_records_path)
+
+    print(f"Writing out experiment group summary to: {summary_path}")
+    with open(summary_path, 'w') as f:
+        json.dump(experiment_summary, f)
+    write_sync_state(args, output_dir, sync_state)
+    return experiment_summary
+
+def merge_conditions(conditions, updated_conditions):
+    """Moves each updated user into their current condition: {condition : [users]} with users in download order."""
+    merged = {}
+    for condition, users in conditions.items():
+        users = [user for user in users if user not in updated_conditions]
+        if users:
+            merged[condition] = users
+    for user, condition in updated_conditions.items():
+        merged.setdefault(condition, []).append(user)
+    return merged
+
 def exclude_duplicated_users(experiment_data):
     users_to_counts = defaultdict(int)
     for experiment_id in experiment_data[EXPERIMENT_IDS]:
@@ -105,41 +236,102 @@ def exclude_duplicated_users(experiment_data):
                 users_to_counts[user] += 1
     duplicated_users = [u for u in users_to_counts if users_to_counts[u] > 1]
     experiment_data[METADATA][EXCLUSION_USERS] = duplicated_users
-    
-            
-    
 
-def get_all_experiment_data(experiment_id, filters):
-    # Update the experiment metadata
-    experiment_dict = {
-        SUMMARY : None,
-        METADATA : defaultdict(list),
-        CONDITIONS : defaultdict(list),
-        IMAGES : defaultdict(list),
-        STROKES : defaultdict(list),
-        DESCRIPTIONS : defaultdict(list)
-    }
-    for record in db_utils.all_experiment_records(experiment_id):
+### Incremental sync.
+# The sync state records, per experiment, the latest updated_at seen in the last download (a high-water mark).
+# The next --incremental run only asks the database for records updated after it, less an overlap window
+# that covers writes still in flight when the last download ran. Records deleted from the database are not
+# removed from the local dataset.
+def load_sync_state(args, output_dir, output_file):
+    """Returns the state of the last download in this output format, or an empty state if we need to download everything."""
+    sync_state = {EXPERIMENT_IDS : {}}
+    sync_state_path = os.path.join(output_dir, DEFAULT_SYNC_STATE_FILE.format(args.output_format))
+    if not args.incremental:
+        return sync_state
+    if not (os.path.exists(sync_state_path) and os.path.exists(os.path.join(output_dir, output_file))):
+        print(f"No previous {args.output_format} download found in {output_dir}, downloading everything.")
+        return sync_state
+    with open(sync_state_path) as f:
+        return json.load(f)
+
+def write_sync_state(args, output_dir, sync_state):
+    sync_state_path = os.path.join(output_dir, DEFAULT_SYNC_STATE_FILE.format(args.output_format))
+    with open(sync_state_path, 'w') as f:
+        json.dump(sync_state, f)
+
+def updated_since(sync_state, experiment_id):
+    """Lower bound on updated_at for the records we still need, or None to download every record."""
+    high_water_mark = sync_state[EXPERIMENT_IDS].get(experiment_id)
+    if high_water_mark is None:
+        return None
+    return datetime.fromisoformat(high_water_mark) - timedelta(seconds=SYNC_OVERLAP_SECONDS)
+
+def iter_user_records(experiment_id, filters, sync_state=None):
+    """Yields one flattened record per (non-excluded) user in an experiment.
+    
+    With a sync state, only yields the records updated since its high-water mark for the experiment, and advances the mark."""
+    since = updated_since(sync_state, experiment_id) if sync_state else None
+    # Records written before updated_at existed never change, so a full download starts the mark at the epoch.
+    high_water_mark = sync_state[EXPERIMENT_IDS].get(experiment_id, SYNC_EPOCH) if sync_state else None
+    projection = record_projection(experiment_id, since)
+    for record in db_utils.all_experiment_records(experiment_id, projection=projection, updated_since=since):
         
         user_id = record[METADATA][USER_ID]
+        updated_at = record.get(UPDATED_AT)
+        if updated_at is not None:
+            updated_at = updated_at.isoformat(timespec='microseconds')
+            if sync_state:
+                high_water_mark = max(high_water_mark, updated_at)
         
         if EXCLUSION_USERS in filters:
             exclusion_user_fn = filters[EXCLUSION_USERS]
             if exclusion_user_fn(user_id): continue
-        experiment_dict[METADATA][user_id].append(record[METADATA])
         
-        condition = record[METADATA][CONDITION]
-        experiment_dict[CONDITIONS][condition].append(user_id)
-        
-        all_user_images, all_user_strokes, all_user_descriptions = [], [], []
+        all_user_images, all_user_strokes, all_user_descriptions, all_user_trial_phases = [], [], [], []
         for phase in record[EXPERIMENT_PHASES]:
-            if IMAGES in record[phase]:
-                all_user_images += record[phase][IMAGES]
-            if STROKES in record[phase]:
-                all_user_strokes += record[phase][STROKES]
-            if USER_DESCRIPTIONS in record[phase]:
-                all_user_descriptions += record[phase][USER_DESCRIPTIONS]
-        experiment_dict[IMAGES][user_id], experiment_dict[STROKES][user_id], experiment_dict[DESCRIPTIONS][user_id] = all_user_images, all_user_strokes, all_user_descriptions
+            # A listed phase the participant never reached has no fields (and is not returned by the projection).
+            phase_record = record.get(phase, {})
+            if IMAGES in phase_record:
+                all_user_images += phase_record[IMAGES]
+            if STROKES in phase_record:
+                all_user_strokes += phase_record[STROKES]
+                all_user_trial_phases += [phase] * len(phase_record[STROKES])
+            if USER_DESCRIPTIONS in phase_record:
+                all_user_descriptions += phase_record[USER_DESCRIPTIONS]
+        yield {
+            EXPERIMENT_ID : experiment_id,
+            USER_ID : user_id,
+            CONDITION : record[METADATA][CONDITION],
+            UPDATED_AT : updated_at,
+            METADATA : record[METADATA],
+            IMAGES : all_user_images,
+            STROKES : all_user_strokes,
+            TRIAL_PHASES : all_user_trial_phases,
+            DESCRIPTIONS : all_user_descriptions
+        }
+    if sync_state:
+        sync_state[EXPERIMENT_IDS][experiment_id] = high_water_mark
+
+def get_all_experiment_data(experiment_id, filters, sync_state=None, previous_experiment_dict=None):
+    """Downloads the data for an experiment. Updates previous_experiment_dict (from the last download) in place if given."""
+    experiment_dict = previous_experiment_dict or {
+        SUMMARY : None,
+        METADATA : {},
+        CONDITIONS : {},
+        IMAGES : {},
+        STROKES : {},
+        TRIAL_PHASES : {},
+        DESCRIPTIONS : {}
+    }
+    updated_conditions = {}
+    for user_record in iter_user_records(experiment_id, filters, sync_state):
+        user_id = user_record[USER_ID]
+        updated_conditions[user_id] = user_record[CONDITION]
+        experiment_dict[METADATA][user_id] = [user_record[METADATA]]
+        experiment_dict[IMAGES][user_id], experiment_dict[STROKES][user_id], experiment_dict[DESCRIPTIONS][user_id] = user_record[IMAGES], user_record[STROKES], user_record[DESCRIPTIONS]
+        experiment_dict.setdefault(TRIAL_PHASES, {})[user_id] = user_record[TRIAL_PHASES]
+    # Update the experiment metadata
+    experiment_dict[CONDITIONS] = merge_conditions(experiment_dict[CONDITIONS], updated_conditions)
     experiment_dict[SUMMARY] = {
         TOTAL_USERS : sum([len(users) for users in experiment_dict[CONDITIONS].values()])
     }
@@ -158,6 +350,11 @@ def generate_base_metadata(args, experiment_group, description, experiment_ids):
     }
 
     
+def get_output_dir(args, experiment_group):
+    output_dir = os.path.join(args.output_dir, DEFAULT_EXPERIMENT_DIR.format(experiment_group))
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    return output_dir
+    
 def download_data_for_experiments(args):
     """Downloads and writes out data for the experiment indicated in experiment_group."""
     experiment_group = args.experiment_group
@@ -167,9 +364,11 @@ def download_data_for_experiments(args):
     
     experiment_group_download_fn = EXPERIMENT_GROUP_REGISTRY[experiment_group]
     experiment_data = experiment_group_download_fn(args, experiment_group)
+    if args.output_format == JSONL_FORMAT:
+        # Already streamed to disk.
+        return
     
-    output_dir = os.path.join(args.output_dir, DEFAULT_EXPERIMENT_DIR.format(experiment_group))
-    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    output_dir = get_output_dir(args, experiment_group)
     output_path = os.path.join(output_dir, DEFAULT_OUTPUT_DATA_FILE)
     print(f"Writing out experiment group data to: {output_path}")
     with open(output_path, 'w') as f:
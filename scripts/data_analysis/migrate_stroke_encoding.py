@@ -0,0 +1,73 @@
+"""
+migrate_stroke_encoding.py | Re-encodes the strokes of existing records in the compact format of drawgoodlib/stroke_codec.py.
+
+Every trial still stored as sketchpad.json() is replaced by its compact encoding (--binary to also pack the
+arrays). Trials are updated one array slot at a time ({phase}.strokes.{N}), so trials that participants are
+appending while the migration runs are not overwritten, and already encoded trials are left alone, so the
+migration can be re-run. Coordinates are quantised to 1 / --scale pixel: the migration is not reversible.
+
+Reads and writes through db_utils, so STORAGE_BACKEND=sqlite migrates a local copy instead of the cluster.
+
+Usage:
+    migrate_stroke_encoding.py --experiment_ids 0_baselines_priors__train-none__test-default__neurips_2020 --dry_run
+"""
+import os, sys, json, argparse
+
+from experiment_constants import *
+import db_utils
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from drawgoodlib import stroke_codec
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--experiment_ids",
+                    nargs="+",
+                    required=True,
+                    help="Experiments (collections) to migrate.")
+parser.add_argument('--scale',
+                    default=stroke_codec.DEFAULT_SCALE,
+                    type=int,
+                    help="Coordinates are stored in units of 1 / scale pixel.")
+parser.add_argument('--binary',
+                    action='store_true',
+                    help="Pack the coordinate and time arrays as base64 varints.")
+parser.add_argument('--dry_run',
+                    action='store_true',
+                    help="Only report how much would be saved.")
+
+def encoded_trial_updates(args, record):
+    """Returns ({field: encoded strokes} for every trial still in the sketchpad format, bytes before, bytes after)."""
+    updates, n_bytes_before, n_bytes_after = {}, 0, 0
+    for phase in record.get(EXPERIMENT_PHASES, []):
+        for trial_index, raw_strokes in enumerate(record.get(phase, {}).get(STROKES) or []):
+            if not raw_strokes or stroke_codec.is_encoded(raw_strokes):
+                continue
+            encoded = stroke_codec.encode_strokes(raw_strokes, scale=args.scale, binary=args.binary)
+            updates[f"{phase}.{STROKES}.{trial_index}"] = encoded
+            n_bytes_before += len(raw_strokes if isinstance(raw_strokes, str) else json.dumps(raw_strokes))
+            n_bytes_after += len(encoded)
+    return updates, n_bytes_before, n_bytes_after
+
+def migrate_experiment(args, experiment_id):
+    n_records, n_trials, n_bytes_before, n_bytes_after = 0, 0, 0, 0
+    for record in db_utils.all_experiment_records(experiment_id):
+        updates, record_bytes_before, record_bytes_after = encoded_trial_updates(args, record)
+        if not updates:
+            continue
+        if not args.dry_run:
+            db_utils.update_record(record[METADATA][USER_ID], experiment_id, updates)
+        n_records += 1
+        n_trials += len(updates)
+        n_bytes_before += record_bytes_before
+        n_bytes_after += record_bytes_after
+    ratio = n_bytes_before / n_bytes_after if n_bytes_after else 0
+    print(f"{experiment_id}: {'would re-encode' if args.dry_run else 're-encoded'} {n_trials} trials in {n_records} records, "
+          f"{n_bytes_before} -> {n_bytes_after} bytes ({ratio:.1f}x)")
+
+def main(args):
+    for experiment_id in args.experiment_ids:
+        migrate_experiment(args, experiment_id)
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
@@ -0,0 +1,138 @@
+"""
+render_stroke_images.py | Renders every drawing of a downloaded experiment group to PNG, in parallel.
+
+Reads the output of get_experiment_db_data.py (either output format, see build_stroke_dataset.py) and writes
+one image per trial to the same place as the visualize_strokes notebook:
+    data_experiment/laps_X/strokes/<experiment_id>/<condition>/<user_id>_<image name>
+Existing images are skipped unless --overwrite is given.
+
+With --animations, each drawing is also animated (drawgoodlib/animate.py) to <image path>.gif (or .mp4 with
+--animation_format mp4), one frame per stroke or, with --time_frames, at the recorded point times.
+
+The default numpy backend uses drawgoodlib/rasterize.py and does not import matplotlib;
+--backend matplotlib renders with utils.saveDrawing as before.
+
+Usage:
+    render_stroke_images.py --experiment_group 0.1 --n_processes 8
+"""
+DEFAULT_TOP_LEVEL_OUTPUT_DIR = "data_experiment"
+DEFAULT_EXPERIMENT_DIR = "laps_{}/raw"
+DEFAULT_STROKES_DIR = "laps_{}/strokes"
+NUMPY_BACKEND, MATPLOTLIB_BACKEND = "numpy", "matplotlib"
+
+import os, sys, argparse
+import pathlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from experiment_constants import *
+from build_stroke_dataset import iter_export_records
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from drawgoodlib import rasterize, animate
+from drawgoodlib.stroke_dataset import parse_raw_strokes
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--experiment_group",
+                    required=True,
+                    help="Which downloaded experiment group to render.")
+parser.add_argument('--output_dir',
+                    default=DEFAULT_TOP_LEVEL_OUTPUT_DIR,
+                    help="Top level directory containing the experiment data.")
+parser.add_argument('--backend',
+                    default=NUMPY_BACKEND,
+                    choices=[NUMPY_BACKEND, MATPLOTLIB_BACKEND])
+parser.add_argument('--n_processes',
+                    default=os.cpu_count(),
+                    type=int,
+                    help="How many users to render concurrently.")
+parser.add_argument('--size',
+                    default=rasterize.DEFAULT_SIZE,
+                    type=int,
+                    help="Image width and height in pixels (numpy backend).")
+parser.add_argument('--line_width',
+                    default=rasterize.DEFAULT_LINE_WIDTH,
+                    type=float,
+                    help="Line width in pixels (numpy backend).")
+parser.add_argument('--color_by',
+                    default=rasterize.ORDER,
+                    choices=[c for c in rasterize.COLOR_BY if c],
+                    help="Colour points by their order, actual time, or stroke (numpy backend).")
+parser.add_argument('--animations',
+                    action='store_true',
+                    help="Also write an animation of each drawing being made.")
+parser.add_argument('--animation_format',
+                    default="gif",
+                    choices=["gif", "mp4"],
+                    help="mp4 needs the imageio-ffmpeg plugin.")
+parser.add_argument('--time_frames',
+                    action='store_true',
+                    help="Animate at the recorded point times instead of one frame per stroke.")
+parser.add_argument('--fps',
+                    default=animate.DEFAULT_FPS,
+                    type=int,
+                    help="Animation frame rate.")
+parser.add_argument('--overwrite',
+                    action='store_true',
+                    help="Re-render images that already exist.")
+
+def render_user_record(args, user_record):
+    """Renders one user's drawings. Returns the number of drawings rendered."""
+    stroke_img_dir = os.path.join(args.output_dir, DEFAULT_STROKES_DIR.format(args.experiment_group),
+                                  user_record[EXPERIMENT_ID], user_record[CONDITION])
+    n_written = 0
+    for img_idx, img in enumerate(user_record[IMAGES]):
+        if img is None or img_idx >= len(user_record[STROKES]) or not user_record[STROKES][img_idx]:
+            continue
+        full_stroke_img_path = os.path.join(stroke_img_dir, f"{user_record[USER_ID]}_{os.path.basename(img)}")
+        full_stroke_animation_path = f"{full_stroke_img_path}.{args.animation_format}"
+        write_image = args.overwrite or not os.path.exists(full_stroke_img_path)
+        write_animation = args.animations and (args.overwrite or not os.path.exists(full_stroke_animation_path))
+        if not (write_image or write_animation):
+            continue
+        pathlib.Path(stroke_img_dir).mkdir(parents=True, exist_ok=True)
+        if args.backend == MATPLOTLIB_BACKEND:
+            from drawgoodlib import utils
+            stroke_data = utils.process_stroke_data(user_record[STROKES][img_idx])
+            if write_image:
+                utils.saveDrawing(stroke_data, full_stroke_img_path)
+            strokes = stroke_data["trialstrokes"]
+        else:
+            strokes = parse_raw_strokes(user_record[STROKES][img_idx])
+            if write_image:
+                image = rasterize.rasterize_strokes(strokes, size=args.size, line_width=args.line_width, color_by=args.color_by)
+                rasterize.save_image(image, full_stroke_img_path)
+        if write_animation:
+            animate.save_stroke_animation(strokes, full_stroke_animation_path,
+                                          frames=animate.TIME_FRAMES if args.time_frames else animate.STROKE_FRAMES,
+                                          fps=args.fps, size=args.size, line_width=args.line_width, color_by=args.color_by)
+        n_written += 1
+    return n_written
+
+def iter_user_records(args):
+    raw_dir = os.path.join(args.output_dir, DEFAULT_EXPERIMENT_DIR.format(args.experiment_group))
+    for _, user_record in iter_export_records(raw_dir):
+        if user_record is not None:
+            yield user_record
+
+def render_stroke_images(args):
+    if args.n_processes > 1:
+        # Only a few users per process are in flight, so memory stays bounded for large exports.
+        n_written, futures = 0, deque()
+        with ProcessPoolExecutor(args.n_processes) as executor:
+            for user_record in iter_user_records(args):
+                futures.append(executor.submit(render_user_record, args, user_record))
+                if len(futures) >= 4 * args.n_processes:
+                    n_written += futures.popleft().result()
+            n_written += sum(future.result() for future in futures)
+    else:
+        n_written = sum(render_user_record(args, user_record) for user_record in iter_user_records(args))
+    print(f"Rendered {n_written} drawings to: {os.path.join(args.output_dir, DEFAULT_STROKES_DIR.format(args.experiment_group))}")
+    return n_written
+
+def main(args):
+    render_stroke_images(args)
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
@@ -0,0 +1,71 @@
+"""animate.py | drawgoodlib
+Animations of a drawing being made.
+
+Frames are drawn incrementally onto one rasterize.StrokeCanvas, so each frame only adds the new points, and the
+bounds are computed from all the strokes up front. Frames are produced lazily and streamed to the writer, so
+memory does not grow with the length of the animation.
+    stroke frames : one frame after each stroke, ending with the full drawing.
+    time frames   : frames at a fixed rate of the recorded point times (utils.process_stroke_data keeps them as
+                    the third value of each point), so the animation follows the participant's actual speed.
+
+Writing GIFs needs imageio; MP4 also needs the imageio-ffmpeg plugin.
+"""
+import numpy as np
+
+from drawgoodlib.rasterize import StrokeCanvas
+
+DEFAULT_FPS = 5
+STROKE_FRAMES, TIME_FRAMES = "stroke", "time"
+FRAME_MODES = [STROKE_FRAMES, TIME_FRAMES]
+
+def iter_stroke_frames(strokes, **canvas_kwargs):
+    """Yields the drawing after each stroke."""
+    canvas = StrokeCanvas(strokes, **canvas_kwargs)
+    if not canvas.strokes:
+        yield canvas.image()
+    for stroke_idx in range(len(canvas.strokes)):
+        canvas.draw_stroke(stroke_idx)
+        yield canvas.image()
+
+def iter_timed_frames(strokes, fps=DEFAULT_FPS, speedup=1.0, **canvas_kwargs):
+    """Yields the drawing as it was every 1 / fps seconds (divided by speedup) of recorded time, in ms."""
+    canvas = StrokeCanvas(strokes, **canvas_kwargs)
+    if any(len(stroke) < 3 for stroke in canvas.strokes):
+        raise ValueError("Time frames need the recorded time of every point.")
+    stroke_times = [np.asarray(stroke[2], dtype=np.float64) for stroke in canvas.strokes]
+    nonempty_times = [times for times in stroke_times if len(times)]
+    if not nonempty_times:
+        yield canvas.image()
+        return
+    start_time = min(times[0] for times in nonempty_times)
+    end_time = max(times[-1] for times in nonempty_times)
+    frame_interval = 1000.0 * speedup / fps
+    n_frames = int(np.floor((end_time - start_time) / frame_interval)) + 1
+    n_drawn = [0] * len(stroke_times)
+    for frame_idx in range(n_frames + 1):
+        # The extra last frame is always the full drawing.
+        frame_time = start_time + frame_idx * frame_interval if frame_idx < n_frames else np.inf
+        for stroke_idx, times in enumerate(stroke_times):
+            n_due = int(np.searchsorted(times, frame_time, side="right"))
+            if n_due > n_drawn[stroke_idx]:
+                canvas.draw_stroke(stroke_idx, n_drawn[stroke_idx], n_due)
+                n_drawn[stroke_idx] = n_due
+        yield canvas.image()
+
+def iter_frames(strokes, frames=STROKE_FRAMES, fps=DEFAULT_FPS, speedup=1.0, **canvas_kwargs):
+    if frames == TIME_FRAMES:
+        return iter_timed_frames(strokes, fps=fps, speedup=speedup, **canvas_kwargs)
+    return iter_stroke_frames(strokes, **canvas_kwargs)
+
+def write_frames(frames, output_path, fps=DEFAULT_FPS):
+    """Streams frames to a GIF / MP4 (any format imageio can write) one at a time. Returns the number of frames."""
+    import imageio
+    n_frames = 0
+    with imageio.get_writer(output_path, mode="I", fps=fps) as writer:
+        for frame in frames:
+            writer.append_data(frame)
+            n_frames += 1
+    return n_frames
+
+def save_stroke_animation(strokes, output_path, frames=STROKE_FRAMES, fps=DEFAULT_FPS, speedup=1.0, **canvas_kwargs):
+    return write_frames(iter_frames(strokes, frames=frames, fps=fps, speedup=speedup, **canvas_kwargs), output_path, fps=fps)
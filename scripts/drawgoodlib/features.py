@@ -0,0 +1,155 @@
+"""features.py | drawgoodlib
+Fixed table of stroke geometry features per trial, computed in vectorized form over a batch of trials and cached
+on disk by a hash of each trial's raw stroke data, so re-running only computes trials that are new or changed.
+
+FEATURES, one row per trial (lengths in sketchpad pixels, times in ms, y pointing up as in process_stroke_data):
+    n_strokes, n_points
+    ink_length              : total path length of all strokes.
+    mean_stroke_length
+    min_x, max_x, min_y, max_y, width, height : bounding box of all points.
+    drawing_time            : from the first to the last point.
+    stroke_time             : summed stroke durations (pen down).
+    total_pause, max_pause, mean_pause : gaps between the end of one stroke and the start of the next.
+    start_x, start_y, end_x, end_y : first and last points of the drawing.
+    n_primitive_strokes     : strokes the sketchpad snapped to a primitive.
+    n_circle_strokes        : strokes with fitted circle parameters.
+Trials without any strokes have n_strokes = 0 and NaN for everything that needs a point.
+
+Usage:
+    cache = FeatureCache("feature_cache.npz")
+    table = extract_features(raw_stroke_strings, cache=cache)   # (n_trials, len(FEATURES))
+    cache.save()
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+from drawgoodlib import stroke_batch
+
+# Bump when a feature definition changes, so cached rows are recomputed.
+FEATURES_VERSION = 1
+FEATURES = [
+    "n_strokes", "n_points",
+    "ink_length", "mean_stroke_length",
+    "min_x", "max_x", "min_y", "max_y", "width", "height",
+    "drawing_time", "stroke_time",
+    "total_pause", "max_pause", "mean_pause",
+    "start_x", "start_y", "end_x", "end_y",
+    "n_primitive_strokes", "n_circle_strokes",
+]
+
+def per_trial_sums(values, stroke_trial, n_trials):
+    return np.bincount(stroke_trial, weights=values, minlength=n_trials).astype(np.float64)
+
+def trial_features(batch):
+    """Feature columns for every trial of a stroke_batch batch, as {feature: array of n_trials}."""
+    stroke_offsets, trial_offsets = batch["stroke_offsets"], batch["trial_offsets"]
+    n_trials = len(trial_offsets) - 1
+    stroke_trial = stroke_batch.segment_ids(trial_offsets)
+    point_offsets = stroke_batch.trial_point_offsets(batch)
+    n_strokes = np.diff(trial_offsets)
+    n_points = np.diff(point_offsets)
+    has_points = n_points > 0
+    features = {"n_strokes": n_strokes.astype(np.float64), "n_points": n_points.astype(np.float64)}
+
+    lengths = stroke_batch.stroke_lengths(batch)
+    features["ink_length"] = per_trial_sums(lengths, stroke_trial, n_trials)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        features["mean_stroke_length"] = np.where(n_strokes > 0, features["ink_length"] / n_strokes, np.nan)
+
+    min_x, max_x, min_y, max_y = stroke_batch.trial_bounds(batch)
+    features.update(min_x=min_x, max_x=max_x, min_y=min_y, max_y=max_y, width=max_x - min_x, height=max_y - min_y)
+
+    x, y, t = (np.asarray(batch[name], dtype=np.float64) for name in ("x", "y", "t"))
+    first_point, last_point = point_offsets[:-1][has_points], point_offsets[1:][has_points] - 1
+    for name, values, points in (("start_x", x, first_point), ("start_y", y, first_point),
+                                 ("end_x", x, last_point), ("end_y", y, last_point)):
+        features[name] = np.full(n_trials, np.nan)
+        features[name][has_points] = values[points]
+    features["drawing_time"] = np.full(n_trials, np.nan)
+    features["drawing_time"][has_points] = t[last_point] - t[first_point]
+    features["stroke_time"] = per_trial_sums(stroke_batch.stroke_durations(batch), stroke_trial, n_trials)
+
+    # Pauses between consecutive non-empty strokes of the same trial.
+    starts, ends = stroke_offsets[:-1], stroke_offsets[1:]
+    nonempty = ends > starts
+    pause_trial = stroke_trial[nonempty]
+    stroke_start_times, stroke_end_times = t[starts[nonempty]], t[ends[nonempty] - 1]
+    same_trial = pause_trial[1:] == pause_trial[:-1]
+    pauses = (stroke_start_times[1:] - stroke_end_times[:-1])[same_trial]
+    pause_trial = pause_trial[1:][same_trial]
+    n_pauses = np.bincount(pause_trial, minlength=n_trials)
+    features["total_pause"] = per_trial_sums(pauses, pause_trial, n_trials)
+    features["max_pause"] = np.zeros(n_trials)
+    np.maximum.at(features["max_pause"], pause_trial, pauses)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        features["mean_pause"] = np.where(n_pauses > 0, features["total_pause"] / n_pauses, 0.0)
+
+    for name, flag in (("n_primitive_strokes", "stroke_has_primitive"), ("n_circle_strokes", "stroke_has_circle")):
+        if flag in batch:
+            features[name] = per_trial_sums(batch[flag].astype(np.float64), stroke_trial, n_trials)
+        else:
+            features[name] = np.full(n_trials, np.nan)
+    return features
+
+def feature_table(features):
+    """{feature: column} as a (n_trials, len(FEATURES)) array in FEATURES order."""
+    return np.stack([features[name] for name in FEATURES], axis=1)
+
+def trial_key(raw_stroke_string):
+    """Content hash of one trial's raw stroke data (and the feature definitions)."""
+    if not isinstance(raw_stroke_string, str):
+        raw_stroke_string = json.dumps(raw_stroke_string, sort_keys=True)
+    return hashlib.sha1(f"{FEATURES_VERSION}:{raw_stroke_string}".encode("utf-8")).hexdigest()
+
+class FeatureCache(object):
+    """Feature rows keyed by trial_key, kept in one .npz file."""
+    def __init__(self, path):
+        self.path = path
+        self.rows = {}
+        self.dirty = False
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as cached:
+                if list(cached["features"]) == FEATURES:
+                    self.rows = dict(zip(cached["keys"].tolist(), cached["table"]))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, key):
+        return self.rows.get(key)
+
+    def add(self, keys, table):
+        self.rows.update(zip(keys, table))
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        keys = list(self.rows)
+        table = np.stack([self.rows[key] for key in keys]) if keys else np.zeros((0, len(FEATURES)))
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, keys=np.array(keys, dtype=str), table=table, features=np.array(FEATURES))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+def extract_features(raw_stroke_strings, cache=None, n_processes=None):
+    """Feature table for a list of raw stroke strings, only computing the trials that are not in the cache."""
+    keys = [trial_key(raw_stroke_string) for raw_stroke_string in raw_stroke_strings]
+    missing = {}
+    for key, raw_stroke_string in zip(keys, raw_stroke_strings):
+        if (cache is None or cache.get(key) is None) and key not in missing:
+            missing[key] = raw_stroke_string
+    computed = {}
+    if missing:
+        batch = stroke_batch.parse_stroke_batch(list(missing.values()), n_processes=n_processes)
+        table = feature_table(trial_features(batch))
+        computed = dict(zip(missing, table))
+        if cache is not None:
+            cache.add(list(missing), table)
+    table = np.empty((len(keys), len(FEATURES)))
+    for row, key in enumerate(keys):
+        table[row] = computed[key] if key in computed else cache.get(key)
+    return table
@@ -0,0 +1,181 @@
+"""rasterize.py | drawgoodlib
+Headless rasterizer that draws stroke trajectories straight into a NumPy image, without creating matplotlib figures.
+
+Each stroke is either a list of (x, y[, t]) points (utils.process_stroke_data's trialstrokes) or a tuple of
+x, y[, t] arrays (StrokeDataset.trial_strokes), with y pointing up. Lines are anti-aliased: every segment is sampled at
+sub-pixel spacing and each sample covers the pixels within line_width / 2, with a one pixel linear falloff.
+
+Colours follow plotstimwrapper:
+    order  : by point order through the drawing (plotstimwrapper's default, "plasma" colour map).
+    time   : by the actual point times.
+    stroke : one colour per stroke (eachstroke_onecolor).
+    None   : solid colour.
+Only the plasma colour map is built in; any other name is looked up in matplotlib if it is installed.
+"""
+import numpy as np
+
+DEFAULT_SIZE = 256
+DEFAULT_LINE_WIDTH = 3.0
+DEFAULT_PADDING = 0.05
+ORDER, TIME, STROKE = "order", "time", "stroke"
+COLOR_BY = [ORDER, TIME, STROKE, None]
+SAMPLE_SPACING = 0.5 # Pixels between samples along a segment.
+
+# matplotlib's plasma colour map at 9 evenly spaced points.
+PLASMA_ANCHORS = np.array([
+    (13, 8, 135), (76, 2, 161), (126, 3, 168), (169, 35, 149), (204, 71, 120),
+    (230, 108, 92), (248, 149, 64), (253, 195, 40), (240, 249, 33)], dtype=np.float64)
+
+_colormaps = {}
+def colormap(name="plasma"):
+    """256 x 3 lookup table of uint8 colours."""
+    if name not in _colormaps:
+        if name == "plasma":
+            anchors = np.linspace(0, 1, len(PLASMA_ANCHORS))
+            positions = np.linspace(0, 1, 256)
+            lut = np.stack([np.interp(positions, anchors, PLASMA_ANCHORS[:, channel]) for channel in range(3)], axis=1)
+        else:
+            from matplotlib import cm
+            lut = cm.get_cmap(name, 256)(np.arange(256))[:, :3] * 255
+        _colormaps[name] = np.round(lut).astype(np.uint8)
+    return _colormaps[name]
+
+def strokes_bounds(strokes):
+    """(min_x, max_x, min_y, max_y) over every point, or None if there are no points."""
+    xs = [np.asarray(stroke[0]) for stroke in strokes if len(stroke[0])]
+    ys = [np.asarray(stroke[1]) for stroke in strokes if len(stroke[1])]
+    if not xs:
+        return None
+    xs, ys = np.concatenate(xs), np.concatenate(ys)
+    return xs.min(), xs.max(), ys.min(), ys.max()
+
+def as_xyt(stroke):
+    """A stroke as columns: a tuple (x, y[, t]) of arrays is used as is, a list of (x, y[, t]) points is transposed."""
+    if isinstance(stroke, tuple):
+        return stroke
+    points = np.asarray(stroke, dtype=np.float64)
+    if not len(points):
+        return (points, points)
+    return tuple(points[:, i] for i in range(points.shape[1]))
+
+def sample_segments(x, y, value):
+    """Points every SAMPLE_SPACING pixels along a polyline, with value linearly interpolated between vertices."""
+    if len(x) == 1:
+        return x, y, value
+    lengths = np.hypot(np.diff(x), np.diff(y))
+    counts = np.maximum(np.ceil(lengths / SAMPLE_SPACING).astype(np.int64), 1)
+    segment = np.repeat(np.arange(len(lengths)), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    fraction = (np.arange(counts.sum()) - starts) / counts[segment]
+    sx = x[segment] + (x[segment + 1] - x[segment]) * fraction
+    sy = y[segment] + (y[segment + 1] - y[segment]) * fraction
+    svalue = value[segment] + (value[segment + 1] - value[segment]) * fraction
+    # Close the polyline with its last vertex.
+    return np.append(sx, x[-1]), np.append(sy, y[-1]), np.append(svalue, value[-1])
+
+def stroke_color_values(strokes, color_by):
+    """The value that selects each point's colour, per stroke: point order, time or stroke index."""
+    stroke_values, n_points_before = [], 0
+    for stroke_idx, stroke in enumerate(strokes):
+        n_points = len(stroke[0])
+        if color_by == TIME and len(stroke) > 2:
+            stroke_values.append(np.asarray(stroke[2], dtype=np.float64))
+        elif color_by == STROKE:
+            stroke_values.append(np.full(n_points, stroke_idx, dtype=np.float64))
+        else:
+            stroke_values.append(np.arange(n_points_before, n_points_before + n_points, dtype=np.float64))
+        n_points_before += n_points
+    return stroke_values
+
+class StrokeCanvas(object):
+    """Image buffers that the strokes of one drawing are drawn onto a few points at a time.
+
+    The scale and the colour range are fixed up front from all the strokes, so a partial drawing looks exactly
+    like the same part of the finished one. Drawing only touches the pixels near the new points; image()
+    composites the current state.
+    """
+    def __init__(self, strokes, size=DEFAULT_SIZE, line_width=DEFAULT_LINE_WIDTH, color_by=ORDER, cmap="plasma",
+                 color=(0, 0, 0), background=(255, 255, 255), bounds=None, padding=DEFAULT_PADDING):
+        self.width, self.height = (size, size) if np.ndim(size) == 0 else size
+        self.strokes = [as_xyt(stroke) for stroke in strokes]
+        self.line_width = line_width
+        self.color_by = color_by
+        self.cmap = cmap
+        self.color = np.asarray(color, dtype=np.float64)
+        self.background = np.asarray(background, dtype=np.float64)
+        self.bounds = bounds if bounds is not None else strokes_bounds(self.strokes)
+        if self.bounds is not None:
+            min_x, max_x, min_y, max_y = self.bounds
+            span = max(max_x - min_x, max_y - min_y) or 1.0
+            self.scale = min(self.width, self.height) * (1 - 2 * padding) / span
+            self.centre_x, self.centre_y = (min_x + max_x) / 2, (min_y + max_y) / 2
+        self.stroke_values = stroke_color_values(self.strokes, color_by)
+        all_values = np.concatenate(self.stroke_values) if self.stroke_values else np.zeros(0)
+        self.low, self.high = (all_values.min(), all_values.max()) if len(all_values) else (0, 0)
+        self.alpha = np.zeros(self.width * self.height, dtype=np.float64)
+        # Later points have larger values, so the maximum value at a pixel is the colour drawn on top.
+        self.value = np.full(self.width * self.height, -np.inf)
+
+    def draw_stroke(self, stroke_idx, start=0, end=None):
+        """Draws points [start, end) of a stroke, joined to the point before start if there is one."""
+        stroke = self.strokes[stroke_idx]
+        n_points = len(stroke[0])
+        end = n_points if end is None else min(end, n_points)
+        start = max(start - 1, 0)
+        if self.bounds is None or end <= start:
+            return
+        x = np.asarray(stroke[0][start:end], dtype=np.float64)
+        y = np.asarray(stroke[1][start:end], dtype=np.float64)
+        self.draw_polyline(x, y, self.stroke_values[stroke_idx][start:end])
+
+    def draw_polyline(self, x, y, value):
+        # Image coordinates: rows grow downwards.
+        px = (x - self.centre_x) * self.scale + self.width / 2
+        py = self.height / 2 - (y - self.centre_y) * self.scale
+        sx, sy, svalue = sample_segments(px, py, value)
+
+        # Every pixel within reach of each sample.
+        radius = self.line_width / 2
+        reach = int(np.ceil(radius + 1))
+        offsets = np.arange(-reach, reach + 1)
+        offset_x, offset_y = np.meshgrid(offsets, offsets)
+        pixel_x = np.floor(sx)[:, None].astype(np.int64) + offset_x.ravel()[None, :]
+        pixel_y = np.floor(sy)[:, None].astype(np.int64) + offset_y.ravel()[None, :]
+        distance = np.hypot(pixel_x + 0.5 - sx[:, None], pixel_y + 0.5 - sy[:, None])
+        coverage = np.clip(radius + 0.5 - distance, 0, 1)
+        inside = (coverage > 0) & (pixel_x >= 0) & (pixel_x < self.width) & (pixel_y >= 0) & (pixel_y < self.height)
+        pixel_index = (pixel_y * self.width + pixel_x)[inside]
+        np.maximum.at(self.alpha, pixel_index, coverage[inside])
+        if self.color_by is not None:
+            np.maximum.at(self.value, pixel_index, np.broadcast_to(svalue[:, None], coverage.shape)[inside])
+
+    def image(self):
+        """The current drawing as a (height, width, 3) uint8 image."""
+        alpha = self.alpha.reshape(self.height, self.width, 1)
+        if self.color_by is None:
+            ink = self.color
+        else:
+            normalized = (self.value - self.low) / ((self.high - self.low) or 1.0)
+            lut_index = np.clip(np.nan_to_num(normalized, neginf=0) * 255, 0, 255).astype(np.int64)
+            ink = colormap(self.cmap)[lut_index].reshape(self.height, self.width, 3)
+        return np.round(self.background * (1 - alpha) + ink * alpha).astype(np.uint8)
+
+def rasterize_strokes(strokes, n_strokes=None, **kwargs):
+    """Renders strokes into a (height, width, 3) uint8 image. See StrokeCanvas for the options.
+
+    size is an int or (width, height). bounds (min_x, max_x, min_y, max_y) fixes the data area shown; by default
+    the drawing is fitted to the image with equal aspect. n_strokes, if given, only draws the first n strokes
+    (still using the bounds of all of them).
+    """
+    canvas = StrokeCanvas(strokes, **kwargs)
+    for stroke_idx in range(len(canvas.strokes) if n_strokes is None else min(n_strokes, len(canvas.strokes))):
+        canvas.draw_stroke(stroke_idx)
+    return canvas.image()
+
+def rasterize_trial(stroke_data, **kwargs):
+    """rasterize_strokes for the output of utils.process_stroke_data."""
+    return rasterize_strokes(stroke_data["trialstrokes"], **kwargs)
+
+def save_image(image, output_path):
+    import imageio
+    imageio.imwrite(output_path, image)
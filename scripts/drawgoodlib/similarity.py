@@ -0,0 +1,208 @@
+"""similarity.py | drawgoodlib
+Nearest-neighbour search over drawings and stimulus images.
+
+Every drawing or image is reduced to the same fixed-size descriptor: its ink rasterized into a small square
+(DESCRIPTOR_SIZE pixels a side, cropped to the ink's bounding box with equal aspect), lightly blurred so that
+small offsets still match, and L2-normalised so that a dot product is the cosine similarity.
+
+SimilarityIndex holds the descriptors as one float32 matrix and answers batch k-NN queries with chunked matrix
+products. For large sets it can also build a coarse quantiser (spherical k-means with n_lists centroids): a
+query is then only compared with the vectors of its n_probe closest lists. Indexes are saved as a directory of
+.npy files and loaded memory-mapped.
+
+Usage:
+    index = SimilarityIndex.build(drawing_descriptors(raw_stroke_strings), ids, n_lists=64)
+    index.save("similarity/drawings")
+    scores, neighbours = SimilarityIndex.load("similarity/drawings").search(queries, k=5)
+"""
+import os
+import json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from drawgoodlib.rasterize import StrokeCanvas
+from drawgoodlib.stroke_dataset import parse_raw_strokes
+
+DESCRIPTOR_SIZE = 32
+DESCRIPTOR_LINE_WIDTH = 1.5
+DESCRIPTOR_PADDING = 0.1
+INK_THRESHOLD = 0.1
+DEFAULT_K = 5
+DEFAULT_CHUNK_SIZE = 4096
+DEFAULT_N_PROBE = 4
+KMEANS_ITERATIONS = 10
+
+### Descriptors.
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+def blur(ink):
+    """3 x 3 box blur of a square ink image."""
+    padded = np.pad(ink, 1)
+    size = ink.shape[0]
+    return sum(padded[dy:dy + size, dx:dx + size] for dy in range(3) for dx in range(3)) / 9
+
+def ink_descriptor(ink):
+    return normalize_rows(blur(ink).ravel())
+
+def strokes_descriptor(strokes):
+    """Descriptor of a drawing given as strokes (see rasterize.StrokeCanvas for the accepted forms)."""
+    canvas = StrokeCanvas(strokes, size=DESCRIPTOR_SIZE, line_width=DESCRIPTOR_LINE_WIDTH, color_by=None,
+                          padding=DESCRIPTOR_PADDING)
+    for stroke_idx in range(len(canvas.strokes)):
+        canvas.draw_stroke(stroke_idx)
+    return ink_descriptor(canvas.alpha.reshape(DESCRIPTOR_SIZE, DESCRIPTOR_SIZE))
+
+def raw_strokes_descriptor(raw_stroke_string):
+    return strokes_descriptor(parse_raw_strokes(raw_stroke_string))
+
+def drawing_descriptors(raw_stroke_strings, n_processes=None):
+    """(n, DESCRIPTOR_SIZE ** 2) descriptors for raw sketchpad strings, across n_processes if given."""
+    raw_stroke_strings = list(raw_stroke_strings)
+    if n_processes and n_processes > 1:
+        with ProcessPoolExecutor(n_processes) as executor:
+            descriptors = list(executor.map(raw_strokes_descriptor, raw_stroke_strings, chunksize=64))
+    else:
+        descriptors = [raw_strokes_descriptor(raw_stroke_string) for raw_stroke_string in raw_stroke_strings]
+    return np.stack(descriptors) if descriptors else np.zeros((0, DESCRIPTOR_SIZE ** 2), dtype=np.float32)
+
+def image_descriptor(image_path):
+    """Descriptor of a stimulus image: dark pixels on a light (or transparent) background are ink."""
+    import imageio.v2 as imageio
+    from PIL import Image
+    image = np.asarray(imageio.imread(image_path), dtype=np.float64) / 255
+    if image.ndim == 3 and image.shape[2] == 4:
+        # Transparent pixels are background.
+        image = image[..., :3] * image[..., 3:] + (1 - image[..., 3:])
+    gray = image.mean(axis=2) if image.ndim == 3 else image
+    ink = 1 - gray
+    rows, columns = np.nonzero(ink > INK_THRESHOLD)
+    if not len(rows):
+        return np.zeros(DESCRIPTOR_SIZE ** 2, dtype=np.float32)
+    ink = ink[rows.min():rows.max() + 1, columns.min():columns.max() + 1]
+    # Centre the ink in a square with the same margin as the drawings.
+    side = int(np.ceil(max(ink.shape) / (1 - 2 * DESCRIPTOR_PADDING)))
+    square = np.zeros((side, side))
+    top, left = (side - ink.shape[0]) // 2, (side - ink.shape[1]) // 2
+    square[top:top + ink.shape[0], left:left + ink.shape[1]] = ink
+    resized = Image.fromarray(square.astype(np.float32), mode="F").resize((DESCRIPTOR_SIZE, DESCRIPTOR_SIZE), Image.BOX)
+    return ink_descriptor(np.clip(np.asarray(resized, dtype=np.float64), 0, 1))
+
+### Index.
+def top_k(scores, k):
+    """Indices of the k largest scores in each row, best first."""
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+def spherical_kmeans(vectors, n_lists, n_iterations=KMEANS_ITERATIONS, seed=0, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Centroids (unit length) and the list of each vector."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=n_lists, replace=False)].copy()
+    for _ in range(n_iterations):
+        assignments = np.concatenate([np.argmax(vectors[i:i + chunk_size] @ centroids.T, axis=1)
+                                      for i in range(0, len(vectors), chunk_size)])
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = ~sums.any(axis=1)
+        # Restart empty lists from random vectors.
+        sums[empty] = vectors[rng.choice(len(vectors), size=empty.sum())]
+        centroids = normalize_rows(sums)
+    assignments = np.concatenate([np.argmax(vectors[i:i + chunk_size] @ centroids.T, axis=1)
+                                  for i in range(0, len(vectors), chunk_size)])
+    return centroids, assignments
+
+def pad_results(scores, indices, k):
+    n_queries, n_found = scores.shape
+    if n_found < k:
+        scores = np.concatenate([scores, np.full((n_queries, k - n_found), -np.inf, dtype=np.float32)], axis=1)
+        indices = np.concatenate([indices, np.full((n_queries, k - n_found), -1, dtype=np.int64)], axis=1)
+    return scores, indices
+
+class SimilarityIndex(object):
+    def __init__(self, vectors, ids, centroids=None, list_offsets=None, list_members=None):
+        self.vectors = vectors
+        self.ids = list(ids)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_members = list_members
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @classmethod
+    def build(cls, descriptors, ids, n_lists=0, seed=0):
+        """Index over descriptors (normalised here). With n_lists > 0, also builds the coarse quantiser."""
+        vectors = normalize_rows(descriptors)
+        if not n_lists or n_lists >= len(vectors):
+            return cls(vectors, ids)
+        centroids, assignments = spherical_kmeans(vectors, n_lists, seed=seed)
+        list_members = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=list_offsets[1:])
+        return cls(vectors, ids, centroids, list_offsets, list_members)
+
+    def search(self, queries, k=DEFAULT_K, n_probe=DEFAULT_N_PROBE, chunk_size=DEFAULT_CHUNK_SIZE, exact=False):
+        """(scores, indices) of the k nearest vectors to each query, best first. Rows are padded with -inf / -1
+        when fewer than k vectors are searched. exact=True ignores the coarse quantiser."""
+        queries = normalize_rows(np.atleast_2d(queries))
+        if self.centroids is None or exact:
+            return self.search_exact(queries, k, chunk_size)
+        return self.search_lists(queries, k, n_probe)
+
+    def search_exact(self, queries, k, chunk_size):
+        n_queries = len(queries)
+        best_scores = np.zeros((n_queries, 0), dtype=np.float32)
+        best_indices = np.zeros((n_queries, 0), dtype=np.int64)
+        for start in range(0, len(self.vectors), chunk_size):
+            # Only one chunk of scores exists at a time; merge it into the running top k.
+            chunk = np.asarray(self.vectors[start:start + chunk_size])
+            scores = np.concatenate([best_scores, queries @ chunk.T], axis=1)
+            indices = np.concatenate([best_indices, np.broadcast_to(np.arange(start, start + len(chunk)), (n_queries, len(chunk)))], axis=1)
+            keep = top_k(scores, k)
+            best_scores, best_indices = np.take_along_axis(scores, keep, axis=1), np.take_along_axis(indices, keep, axis=1)
+        return pad_results(best_scores, best_indices, k)
+
+    def search_lists(self, queries, k, n_probe):
+        probes = top_k(queries @ self.centroids.T, n_probe)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, (query, query_probes) in enumerate(zip(queries, probes)):
+            candidates = np.sort(np.concatenate([self.list_members[self.list_offsets[p]:self.list_offsets[p + 1]] for p in query_probes]))
+            if not len(candidates):
+                continue
+            scores = np.asarray(self.vectors[candidates]) @ query
+            keep = top_k(scores[None, :], k)[0]
+            best_scores[row, :len(keep)], best_indices[row, :len(keep)] = scores[keep], candidates[keep]
+        return best_scores, best_indices
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "vectors.npy"), np.asarray(self.vectors, dtype=np.float32))
+        for name, array in (("centroids", self.centroids), ("list_offsets", self.list_offsets),
+                            ("list_members", self.list_members)):
+            array_path = os.path.join(path, f"{name}.npy")
+            if array is not None:
+                np.save(array_path, array)
+            elif os.path.exists(array_path):
+                # Left over from an earlier index with a coarse quantiser.
+                os.remove(array_path)
+        with open(os.path.join(path, "ids.json"), "w") as f:
+            json.dump({"ids": self.ids, "descriptor_size": DESCRIPTOR_SIZE}, f)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, "ids.json")) as f:
+            ids = json.load(f)["ids"]
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r" if mmap else None)
+        if os.path.exists(os.path.join(path, "centroids.npy")):
+            return cls(vectors, ids, *(np.load(os.path.join(path, f"{name}.npy")) for name in ("centroids", "list_offsets", "list_members")))
+        return cls(vectors, ids)
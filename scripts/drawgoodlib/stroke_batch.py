@@ -0,0 +1,223 @@
+"""stroke_batch.py | drawgoodlib
+Vectorized processing of many drawings at once.
+
+utils.process_stroke_data handles one trial at a time in Python loops. Here a batch of raw stroke strings is
+parsed once into the same columnar layout as stroke_dataset.py:
+    x, y, t        : every point, concatenated (y negated, t in ms from the start of the trial).
+    stroke_offsets : n_strokes + 1 offsets into the point arrays.
+    trial_offsets  : n_trials + 1 offsets into stroke_offsets.
+and every per-stroke quantity is computed with array operations over the whole batch. The same functions work
+directly on a memory-mapped StrokeDataset (see batch_from_dataset).
+
+Usage:
+    batch = process_stroke_batch(raw_stroke_strings, n_processes=8)
+    batch["stroke_lengths"], batch["stroke_durations"], batch["resampled_x"]
+"""
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from drawgoodlib.stroke_codec import load_raw_strokes
+
+DEFAULT_RESAMPLE_POINTS = 20 # Same as plotstimwrapper's addstrokelines_N.
+DEFAULT_CHUNK_SIZE = 256
+STROKE_FLAGS = ["stroke_has_primitive", "stroke_has_circle"]
+
+def parse_stroke_chunk(raw_stroke_strings):
+    """Parses raw sketchpad strings (or None for trials without a drawing) into flat arrays."""
+    x, y, t, stroke_counts, point_counts, primitives, circles = [], [], [], [], [], [], []
+    for raw_stroke_string in raw_stroke_strings:
+        raw_strokes = load_raw_strokes(raw_stroke_string)
+        start_time = None
+        for stroke in raw_strokes:
+            path, times = stroke["path_nostring"], stroke["times"]
+            n_points = min(len(path), len(times))
+            if start_time is None and n_points:
+                start_time = times[0]
+            x.extend(p[1] for p in path[:n_points])
+            y.extend(-p[2] for p in path[:n_points])
+            t.extend(tt - start_time for tt in times[:n_points])
+            point_counts.append(n_points)
+            primitives.append(bool(stroke.get("primitive")))
+            circles.append(bool(stroke.get("circle")))
+        stroke_counts.append(len(raw_strokes))
+    return {
+        "x": np.array(x, dtype=np.float64),
+        "y": np.array(y, dtype=np.float64),
+        "t": np.array(t, dtype=np.float64),
+        "stroke_offsets": counts_to_offsets(point_counts),
+        "trial_offsets": counts_to_offsets(stroke_counts),
+        # Whether the sketchpad snapped each stroke to a primitive / fitted a circle.
+        "stroke_has_primitive": np.array(primitives, dtype=bool),
+        "stroke_has_circle": np.array(circles, dtype=bool),
+    }
+
+def counts_to_offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+def concatenate_chunks(chunks):
+    """Joins parsed chunks, shifting each chunk's offsets past the previous ones."""
+    if not chunks:
+        return parse_stroke_chunk([])
+    stroke_offsets, trial_offsets = [np.zeros(1, dtype=np.int64)], [np.zeros(1, dtype=np.int64)]
+    n_points, n_strokes = 0, 0
+    for chunk in chunks:
+        stroke_offsets.append(chunk["stroke_offsets"][1:] + n_points)
+        trial_offsets.append(chunk["trial_offsets"][1:] + n_strokes)
+        n_points += len(chunk["x"])
+        n_strokes += len(chunk["stroke_offsets"]) - 1
+    batch = {
+        "x": np.concatenate([chunk["x"] for chunk in chunks]),
+        "y": np.concatenate([chunk["y"] for chunk in chunks]),
+        "t": np.concatenate([chunk["t"] for chunk in chunks]),
+        "stroke_offsets": np.concatenate(stroke_offsets),
+        "trial_offsets": np.concatenate(trial_offsets),
+    }
+    # Stroke flags are only known when parsing raw strokes (not for a StrokeDataset).
+    for name in STROKE_FLAGS:
+        if all(name in chunk for chunk in chunks):
+            batch[name] = np.concatenate([chunk[name] for chunk in chunks])
+    return batch
+
+def parse_stroke_batch(raw_stroke_strings, n_processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Parses a batch of trials, across n_processes worker processes if given."""
+    raw_stroke_strings = list(raw_stroke_strings)
+    chunks = [raw_stroke_strings[i:i + chunk_size] for i in range(0, len(raw_stroke_strings), chunk_size)]
+    if n_processes and n_processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(n_processes) as executor:
+            return concatenate_chunks(list(executor.map(parse_stroke_chunk, chunks)))
+    return concatenate_chunks([parse_stroke_chunk(chunk) for chunk in chunks])
+
+def batch_from_dataset(dataset, trial_indices=None):
+    """The arrays of a StrokeDataset as a batch. Without trial_indices this does not copy anything."""
+    if trial_indices is None:
+        return {"x": dataset.x, "y": dataset.y, "t": dataset.t,
+                "stroke_offsets": dataset.stroke_offsets, "trial_offsets": dataset.trial_offsets}
+    chunks = []
+    for trial_idx in trial_indices:
+        x, y, t, stroke_offsets = dataset.trial_points(trial_idx)
+        chunks.append({"x": x, "y": y, "t": t, "stroke_offsets": stroke_offsets,
+                       "trial_offsets": np.array([0, len(stroke_offsets) - 1], dtype=np.int64)})
+    return concatenate_chunks(chunks)
+
+### Per-point and per-stroke quantities.
+def segment_ids(offsets):
+    """For offsets into a flat array, the segment that each element belongs to."""
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+def stroke_point_counts(batch):
+    return np.diff(batch["stroke_offsets"])
+
+def stroke_durations(batch):
+    """Time from the first to the last point of each stroke, in ms."""
+    starts, ends = batch["stroke_offsets"][:-1], batch["stroke_offsets"][1:]
+    durations = np.zeros(len(starts), dtype=np.float64)
+    nonempty = ends > starts
+    durations[nonempty] = batch["t"][ends[nonempty] - 1] - batch["t"][starts[nonempty]]
+    return durations
+
+def stroke_lengths(batch):
+    """Path length of each stroke: the sum of distances between consecutive points."""
+    x, y = np.asarray(batch["x"], dtype=np.float64), np.asarray(batch["y"], dtype=np.float64)
+    starts, ends = batch["stroke_offsets"][:-1], batch["stroke_offsets"][1:]
+    # cumulative[i] is the distance travelled from the first point of the batch to point i.
+    cumulative = np.zeros(len(x), dtype=np.float64)
+    np.cumsum(np.hypot(np.diff(x), np.diff(y)), out=cumulative[1:])
+    lengths = np.zeros(len(starts), dtype=np.float64)
+    nonempty = ends > starts
+    lengths[nonempty] = cumulative[ends[nonempty] - 1] - cumulative[starts[nonempty]]
+    return lengths
+
+def trial_point_offsets(batch):
+    """Offsets of each trial into the point arrays."""
+    return batch["stroke_offsets"][batch["trial_offsets"]]
+
+def trial_bounds(batch):
+    """(min_x, max_x, min_y, max_y) arrays per trial; NaN for trials without any points."""
+    x, y = np.asarray(batch["x"], dtype=np.float64), np.asarray(batch["y"], dtype=np.float64)
+    point_trial = segment_ids(trial_point_offsets(batch))
+    n_trials = len(batch["trial_offsets"]) - 1
+    mins_x, maxs_x = np.full(n_trials, np.inf), np.full(n_trials, -np.inf)
+    mins_y, maxs_y = np.full(n_trials, np.inf), np.full(n_trials, -np.inf)
+    np.minimum.at(mins_x, point_trial, x)
+    np.maximum.at(maxs_x, point_trial, x)
+    np.minimum.at(mins_y, point_trial, y)
+    np.maximum.at(maxs_y, point_trial, y)
+    empty = ~np.isfinite(mins_x)
+    mins_x[empty], maxs_x[empty], mins_y[empty], maxs_y[empty] = np.nan, np.nan, np.nan, np.nan
+    return mins_x, maxs_x, mins_y, maxs_y
+
+def normalize_trials(batch):
+    """x, y translated so each trial's bounding box is centred on 0 and scaled so its longer side is 1."""
+    x, y = np.asarray(batch["x"], dtype=np.float64), np.asarray(batch["y"], dtype=np.float64)
+    point_trial = segment_ids(trial_point_offsets(batch))
+    # Trials without any points have NaN bounds; they are never indexed by point_trial anyway.
+    mins_x, maxs_x, mins_y, maxs_y = trial_bounds(batch)
+    centre_x, centre_y = (mins_x + maxs_x) / 2, (mins_y + maxs_y) / 2
+    scale = np.maximum(maxs_x - mins_x, maxs_y - mins_y)
+    scale[~(scale > 0)] = 1
+    return (x - centre_x[point_trial]) / scale[point_trial], (y - centre_y[point_trial]) / scale[point_trial]
+
+def resample_strokes(batch, n_points=DEFAULT_RESAMPLE_POINTS, x=None, y=None):
+    """Every stroke resampled to n_points, as (n_strokes, n_points) arrays of x and y.
+
+    Points are interpolated by index, as in plotstimwrapper with addstrokelines (np.interp over np.arange(N)),
+    but for every stroke at once. Empty strokes are all NaN.
+    """
+    x = np.asarray(batch["x"] if x is None else x, dtype=np.float64)
+    y = np.asarray(batch["y"] if y is None else y, dtype=np.float64)
+    starts = batch["stroke_offsets"][:-1]
+    counts = np.diff(batch["stroke_offsets"])
+    n_strokes = len(counts)
+    resampled_x, resampled_y = np.full((n_strokes, n_points), np.nan), np.full((n_strokes, n_points), np.nan)
+    nonempty = counts > 0
+    if not nonempty.any():
+        return resampled_x, resampled_y
+    starts, counts = starts[nonempty], counts[nonempty]
+    # Fractional index of each sample within its stroke: linspace(0, N - 1, n_points) per stroke.
+    positions = np.linspace(0, 1, n_points)[None, :] * (counts - 1)[:, None]
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.minimum(lower + 1, (counts - 1)[:, None])
+    weight = positions - lower
+    lower, upper = lower + starts[:, None], upper + starts[:, None]
+    resampled_x[nonempty] = x[lower] * (1 - weight) + x[upper] * weight
+    resampled_y[nonempty] = y[lower] * (1 - weight) + y[upper] * weight
+    return resampled_x, resampled_y
+
+def process_stroke_batch(raw_stroke_strings, n_resample=DEFAULT_RESAMPLE_POINTS, normalize=False, n_processes=None):
+    """Parses a batch of trials and adds per-stroke lengths, durations, point counts and resampled points.
+
+    With normalize, lengths and resampled points are computed on normalize_trials coordinates (also returned as
+    normalized_x, normalized_y)."""
+    batch = parse_stroke_batch(raw_stroke_strings, n_processes=n_processes)
+    return add_stroke_features(batch, n_resample=n_resample, normalize=normalize)
+
+def add_stroke_features(batch, n_resample=DEFAULT_RESAMPLE_POINTS, normalize=False):
+    x, y = batch["x"], batch["y"]
+    if normalize:
+        x, y = normalize_trials(batch)
+        batch["normalized_x"], batch["normalized_y"] = x, y
+    batch["stroke_point_counts"] = stroke_point_counts(batch)
+    batch["stroke_durations"] = stroke_durations(batch)
+    batch["stroke_lengths"] = stroke_lengths({"x": x, "y": y, "stroke_offsets": batch["stroke_offsets"]})
+    if n_resample:
+        batch["resampled_x"], batch["resampled_y"] = resample_strokes(batch, n_resample, x=x, y=y)
+    return batch
+
+def raw_strokes_from_export(experiment_data):
+    """Yields (experiment_id, user_id, trial_number, raw_stroke_string) for every trial in a raw_experiment_data.json."""
+    for experiment_id, experiment in experiment_data["experiment_ids"].items():
+        for user_id, user_strokes in experiment["strokes"].items():
+            for trial_number, raw_stroke_string in enumerate(user_strokes):
+                yield experiment_id, user_id, trial_number, raw_stroke_string
+
+def process_export(experiment_data, n_resample=DEFAULT_RESAMPLE_POINTS, normalize=False, n_processes=None):
+    """process_stroke_batch over every trial of an export, plus (experiment_id, user_id, trial_number) per trial."""
+    trials, raw_stroke_strings = [], []
+    for experiment_id, user_id, trial_number, raw_stroke_string in raw_strokes_from_export(experiment_data):
+        trials.append((experiment_id, user_id, trial_number))
+        raw_stroke_strings.append(raw_stroke_string)
+    batch = process_stroke_batch(raw_stroke_strings, n_resample=n_resample, normalize=normalize, n_processes=n_processes)
+    batch["trials"] = trials
+    return batch
@@ -0,0 +1,172 @@
+"""stroke_codec.py | drawgoodlib
+Compact encoding of the sketchpad's stroke data.
+
+sketchpad.json() stores every stroke with its points three times (path, pathorig, path_nostring), every time
+stamp in full and the same style attributes each time. The compact encoding (written by static/js/stroke_codec.js
+on the record path, or by encode_strokes) is a JSON object:
+    {"dgs": 1, "scale": 100, "t0": <time of the first point, ms>, "strokes": [stroke, ...]}
+with each stroke:
+    x, y : pathorig coordinates quantised to 1 / scale pixel, the first absolute and the rest as deltas.
+    t    : times in whole ms, the first relative to t0 and the rest as deltas.
+    p, c : primitive and circle, only when set.
+    a    : style attributes that differ from DEFAULT_ATTRIBUTES.
+    s    : {x, y} of path_nostring, only when it differs from pathorig (strokes snapped to a primitive).
+    n    : path_nostring as recorded, only when it is not a plain M/L polyline.
+With binary=True the x, y and t arrays are packed as base64 of zigzag varints instead of JSON lists.
+
+Decoding restores the sketchpad's format. load_raw_strokes accepts either format and is what
+utils.process_stroke_data and the stroke_dataset / stroke_batch parsers use, so encoded records are read
+transparently everywhere.
+"""
+import json
+import base64
+import numpy as np
+from itertools import accumulate
+
+FORMAT_KEY = "dgs"
+FORMAT_VERSION = 1
+DEFAULT_SCALE = 100
+DEFAULT_ATTRIBUTES = {
+    "fill": "none",
+    "stroke": "#000000",
+    "stroke-opacity": 1,
+    "stroke-width": 2,
+    "stroke-linecap": "round",
+    "stroke-linejoin": "round",
+    "transform": [],
+    "type": "path",
+}
+STROKE_FIELDS = {"path", "path_nostring", "pathorig", "times", "primitive", "circle"}
+
+### Integer arrays.
+def pack_varints(values):
+    """base64 of the zigzag varint bytes of a list of integers."""
+    packed = bytearray()
+    for value in values:
+        value = (value << 1) ^ (value >> 63)
+        while value >= 0x80:
+            packed.append((value & 0x7f) | 0x80)
+            value >>= 7
+        packed.append(value)
+    return base64.b64encode(bytes(packed)).decode("ascii")
+
+def unpack_varints(packed):
+    # Strokes are short, so a plain loop is faster than array operations here.
+    values, value, shift = [], 0, 0
+    for byte in base64.b64decode(packed):
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            values.append((value >> 1) ^ -(value & 1))
+            value, shift = 0, 0
+        else:
+            shift += 7
+    return values
+
+def encode_deltas(values, binary, start=0):
+    values = np.asarray(values, dtype=np.int64)
+    deltas = np.diff(values, prepend=np.int64(start)).tolist()
+    return pack_varints(deltas) if binary else deltas
+
+def decode_deltas(encoded, start=0):
+    deltas = unpack_varints(encoded) if isinstance(encoded, str) else encoded
+    return list(accumulate(deltas, initial=start))[1:]
+
+### Strokes.
+def is_encoded(raw_strokes):
+    if isinstance(raw_strokes, str):
+        return raw_strokes.lstrip().startswith('{')
+    return isinstance(raw_strokes, dict) and FORMAT_KEY in raw_strokes
+
+def polyline_points(path_nostring):
+    """[[x, y], ...] of an M/L path, or None for anything else."""
+    if any(len(segment) != 3 or segment[0] != ("M" if idx == 0 else "L") for idx, segment in enumerate(path_nostring)):
+        return None
+    return [segment[1:] for segment in path_nostring]
+
+def quantise(points, scale):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return np.round(points * scale).astype(np.int64)
+
+def encode_strokes(raw_strokes, scale=DEFAULT_SCALE, binary=False):
+    """Compact encoding (as a string) of sketchpad strokes, given as sketchpad.json()'s string or parsed list.
+    Already encoded strokes are returned as is, empty trials as None."""
+    if not raw_strokes:
+        return None
+    if is_encoded(raw_strokes):
+        return raw_strokes if isinstance(raw_strokes, str) else json.dumps(raw_strokes, separators=(",", ":"))
+    if isinstance(raw_strokes, str):
+        raw_strokes = json.loads(raw_strokes)
+    all_times = [stroke["times"][0] for stroke in raw_strokes if stroke.get("times")]
+    t0 = int(round(min(all_times))) if all_times else 0
+    strokes = []
+    for stroke in raw_strokes:
+        points = quantise(stroke.get("pathorig") or [], scale)
+        encoded = {
+            "x": encode_deltas(points[:, 0], binary),
+            "y": encode_deltas(points[:, 1], binary),
+            "t": encode_deltas(np.round(stroke.get("times") or []), binary, start=t0),
+        }
+        if stroke.get("primitive") is not None:
+            encoded["p"] = stroke["primitive"]
+        if stroke.get("circle"):
+            encoded["c"] = stroke["circle"]
+        attributes = {key: value for key, value in stroke.items()
+                      if key not in STROKE_FIELDS and (key not in DEFAULT_ATTRIBUTES or DEFAULT_ATTRIBUTES[key] != value)}
+        if attributes:
+            encoded["a"] = attributes
+        path_nostring = stroke.get("path_nostring") or []
+        path_points = polyline_points(path_nostring)
+        if path_points is None:
+            encoded["n"] = path_nostring
+        else:
+            path_points = quantise(path_points, scale)
+            if not np.array_equal(path_points, points):
+                encoded["s"] = {"x": encode_deltas(path_points[:, 0], binary), "y": encode_deltas(path_points[:, 1], binary)}
+        strokes.append(encoded)
+    return json.dumps({FORMAT_KEY: FORMAT_VERSION, "scale": scale, "t0": t0, "strokes": strokes}, separators=(",", ":"))
+
+def decode_points(encoded, scale):
+    return ([value / scale for value in decode_deltas(encoded["x"])],
+            [value / scale for value in decode_deltas(encoded["y"])])
+
+def svg_number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def svg_path_string(path_nostring):
+    return "".join(segment[0] + ",".join(svg_number(value) for value in segment[1:]) for segment in path_nostring)
+
+def decode_strokes(encoded_strokes, full=True):
+    """Sketchpad strokes (as parsed from sketchpad.json()) for a compact encoding. full=False leaves out the
+    SVG path string and the style attributes, which nothing in the analysis reads."""
+    data = json.loads(encoded_strokes) if isinstance(encoded_strokes, str) else encoded_strokes
+    if data.get(FORMAT_KEY) != FORMAT_VERSION:
+        raise ValueError(f"Unknown stroke encoding: {data.get(FORMAT_KEY)}")
+    scale, t0 = data["scale"], data["t0"]
+    strokes = []
+    for encoded in data["strokes"]:
+        x, y = decode_points(encoded, scale)
+        if "n" in encoded:
+            path_nostring = encoded["n"]
+        else:
+            path_x, path_y = decode_points(encoded["s"], scale) if "s" in encoded else (x, y)
+            path_nostring = [["M" if idx == 0 else "L", px, py] for idx, (px, py) in enumerate(zip(path_x, path_y))]
+        stroke = dict(DEFAULT_ATTRIBUTES, **encoded.get("a", {})) if full else {}
+        if full:
+            stroke["path"] = svg_path_string(path_nostring)
+        stroke.update({
+            "times": decode_deltas(encoded["t"], start=t0),
+            "pathorig": [[px, py] for px, py in zip(x, y)],
+            "primitive": encoded.get("p"),
+            "path_nostring": path_nostring,
+            "circle": encoded.get("c", []),
+        })
+        strokes.append(stroke)
+    return strokes
+
+def load_raw_strokes(raw_strokes):
+    """The list of stroke dicts for a trial in either format (string or parsed), [] for trials without strokes."""
+    if not raw_strokes:
+        return []
+    if is_encoded(raw_strokes):
+        return decode_strokes(raw_strokes, full=False)
+    return json.loads(raw_strokes) if isinstance(raw_strokes, str) else raw_strokes
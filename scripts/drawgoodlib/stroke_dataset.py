@@ -0,0 +1,175 @@
+"""stroke_dataset.py | drawgoodlib
+Columnar on-disk format for stroke data, so analyses over thousands of drawings do not re-parse JSON.
+
+A dataset is a directory of flat little-endian arrays plus an index.json manifest:
+    x.f32, y.f32, t.f32 : every point of every stroke, concatenated. y is negated as in utils.process_stroke_data,
+                          and t is in ms relative to the first point of the trial (absolute times do not fit in float32).
+    stroke_offsets.i64  : n_strokes + 1 offsets into the point arrays.
+    trial_offsets.i64   : n_trials + 1 offsets into stroke_offsets.
+    trial_experiment.i32, trial_user.i32, trial_image.i32, trial_phase.i32 : per trial, indices into the string
+                          tables in index.json (experiments, users, images, phases).
+    trial_number.i32    : position of the trial in the user's list of strokes in the export.
+
+StrokeDatasetWriter builds a dataset one trial at a time; StrokeDataset memory-maps one and hands out per-trial
+views into the arrays without copying.
+"""
+import os
+import json
+import shutil
+import numpy as np
+
+from drawgoodlib.stroke_codec import load_raw_strokes
+
+INDEX_FILE = "index.json"
+POINT_ARRAYS = {"x": np.float32, "y": np.float32, "t": np.float32}
+OFFSET_ARRAYS = {"stroke_offsets": np.int64, "trial_offsets": np.int64}
+TRIAL_ARRAYS = {"trial_experiment": np.int32, "trial_user": np.int32, "trial_image": np.int32,
+                "trial_phase": np.int32, "trial_number": np.int32}
+TABLES = {"trial_experiment": "experiments", "trial_user": "users", "trial_image": "images", "trial_phase": "phases"}
+ARRAY_DTYPES = {**POINT_ARRAYS, **OFFSET_ARRAYS, **TRIAL_ARRAYS}
+EXTENSIONS = {np.float32: "f32", np.int64: "i64", np.int32: "i32"}
+
+def array_path(path, name, dtype):
+    return os.path.join(path, f"{name}.{EXTENSIONS[dtype]}")
+
+def parse_raw_strokes(raw_stroke_string):
+    """Same parsing as utils.process_stroke_data, as (x, y, t) float arrays per stroke. Accepts a string or parsed list,
+    in either stroke_codec format."""
+    raw_strokes = load_raw_strokes(raw_stroke_string)
+    strokes = []
+    for stroke in raw_strokes:
+        path, times = stroke["path_nostring"], stroke["times"]
+        n_points = min(len(path), len(times))
+        x = np.array([p[1] for p in path[:n_points]], dtype=np.float64)
+        y = -np.array([p[2] for p in path[:n_points]], dtype=np.float64)
+        strokes.append((x, y, np.array(times[:n_points], dtype=np.float64)))
+    return strokes
+
+class StrokeDatasetWriter(object):
+    """Appends trials straight to the array files, so memory does not grow with the size of the export."""
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.files = {name: open(array_path(self.tmp_path, name, dtype), "wb")
+                      for name, dtype in ARRAY_DTYPES.items()}
+        self.tables = {table: {} for table in TABLES.values()}
+        self.n_points, self.n_strokes, self.n_trials = 0, 0, 0
+        self.write("stroke_offsets", [0])
+        self.write("trial_offsets", [0])
+        self.metadata = {}
+
+    def write(self, name, values):
+        dtype = np.dtype(ARRAY_DTYPES[name]).newbyteorder("<")
+        self.files[name].write(np.asarray(values, dtype=dtype).tobytes())
+
+    def table_index(self, table, value):
+        return self.tables[table].setdefault(value if value is not None else "", len(self.tables[table]))
+
+    def add_trial(self, experiment_id, user_id, image, phase, trial_number, raw_strokes):
+        strokes = parse_raw_strokes(raw_strokes)
+        start_time = strokes[0][2][0] if strokes and len(strokes[0][2]) else 0
+        stroke_ends = []
+        for x, y, t in strokes:
+            self.write("x", x)
+            self.write("y", y)
+            self.write("t", t - start_time)
+            self.n_points += len(x)
+            stroke_ends.append(self.n_points)
+        self.write("stroke_offsets", stroke_ends)
+        self.n_strokes += len(strokes)
+        self.write("trial_offsets", [self.n_strokes])
+        for name, table, value in (("trial_experiment", "experiments", experiment_id), ("trial_user", "users", user_id),
+                                   ("trial_image", "images", image), ("trial_phase", "phases", phase)):
+            self.write(name, [self.table_index(table, value)])
+        self.write("trial_number", [trial_number])
+        self.n_trials += 1
+
+    def add_user_record(self, user_record):
+        """Adds every trial of a flattened export record (see get_experiment_db_data.iter_user_records)."""
+        images = user_record["images"]
+        trial_phases = user_record.get("trial_phases") or []
+        for trial_number, raw_strokes in enumerate(user_record["strokes"]):
+            self.add_trial(user_record["experiment_id"], user_record["user_id"],
+                           images[trial_number] if trial_number < len(images) else None,
+                           trial_phases[trial_number] if trial_number < len(trial_phases) else None,
+                           trial_number, raw_strokes)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        index = {
+            "n_points": self.n_points,
+            "n_strokes": self.n_strokes,
+            "n_trials": self.n_trials,
+            "metadata": self.metadata,
+        }
+        for table, values in self.tables.items():
+            index[table] = list(values)
+        with open(os.path.join(self.tmp_path, INDEX_FILE), "w") as f:
+            json.dump(index, f)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(self.tmp_path, self.path)
+        return self.path
+
+def load_array(path, name, dtype, length):
+    if length == 0:
+        # Empty files cannot be memory-mapped.
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(array_path(path, name, dtype), dtype=np.dtype(dtype).newbyteorder("<"), mode="r", shape=(length,))
+
+class StrokeDataset(object):
+    """Read-only, memory-mapped view of a dataset written by StrokeDatasetWriter."""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        n_points, n_strokes, n_trials = self.index["n_points"], self.index["n_strokes"], self.index["n_trials"]
+        for name, dtype in POINT_ARRAYS.items():
+            setattr(self, name, load_array(path, name, dtype, n_points))
+        self.stroke_offsets = load_array(path, "stroke_offsets", np.int64, n_strokes + 1)
+        self.trial_offsets = load_array(path, "trial_offsets", np.int64, n_trials + 1)
+        for name, dtype in TRIAL_ARRAYS.items():
+            setattr(self, name, load_array(path, name, dtype, n_trials))
+        self.lookup = {table: {value: i for i, value in enumerate(self.index[table])} for table in TABLES.values()}
+
+    def __len__(self):
+        return self.index["n_trials"]
+
+    def trial_points(self, trial_idx):
+        """(x, y, t) views over every point of a trial, and the stroke boundaries as offsets into them."""
+        first_stroke, last_stroke = self.trial_offsets[trial_idx], self.trial_offsets[trial_idx + 1]
+        stroke_offsets = self.stroke_offsets[first_stroke:last_stroke + 1]
+        start, end = stroke_offsets[0], stroke_offsets[-1]
+        return self.x[start:end], self.y[start:end], self.t[start:end], stroke_offsets - start
+
+    def trial_strokes(self, trial_idx):
+        """List of (x, y, t) views, one per stroke."""
+        x, y, t, stroke_offsets = self.trial_points(trial_idx)
+        return [(x[a:b], y[a:b], t[a:b]) for a, b in zip(stroke_offsets[:-1], stroke_offsets[1:])]
+
+    def trial_info(self, trial_idx):
+        info = {table[:-1]: self.index[table][getattr(self, name)[trial_idx]] for name, table in TABLES.items()}
+        info["trial_number"] = int(self.trial_number[trial_idx])
+        return info
+
+    def find_trials(self, experiment=None, user=None, image=None, phase=None):
+        """Indices of the trials matching every given field."""
+        mask = np.ones(len(self), dtype=bool)
+        for name, table, value in (("trial_experiment", "experiments", experiment), ("trial_user", "users", user),
+                                   ("trial_image", "images", image), ("trial_phase", "phases", phase)):
+            if value is None:
+                continue
+            if value not in self.lookup[table]:
+                return np.zeros(0, dtype=np.int64)
+            mask &= getattr(self, name) == self.lookup[table][value]
+        return np.flatnonzero(mask)
+
+    def stroke_data(self, trial_idx):
+        """A trial in the utils.process_stroke_data format, for plotDrawing / saveDrawing / save_stroke_gif."""
+        return {
+            "trialstrokes": [list(zip(x.tolist(), y.tolist(), t.tolist())) for x, y, t in self.trial_strokes(trial_idx)],
+            "trialprimitives": [],
+            "trialcircleparams": [],
+        }
@@ -12,15 +12,17 @@ import math
 import matplotlib.image as mpimg
 from matplotlib.patches import Circle
 
+from drawgoodlib import animate, stroke_codec
+
 plot_orig_stim = True
 use_actual_time = False
 
 def process_stroke_data(raw_stroke_string):
     """Processes strokes data from the Raphael sketchpad.
-    Expects a raw string.
+    Expects a raw string, in either stroke_codec format.
     Author: Catherine Wong
     """
-    raw_strokes = json.loads(raw_stroke_string)
+    raw_strokes = stroke_codec.load_raw_strokes(raw_stroke_string)
     trial_stroke_trajs = []
     trial_strokes_orig = []
     trial_strokes_primitives = []
@@ -61,38 +63,16 @@ def plotDrawing(datflat_single, ax=[], addstrokelines=False, xlim=None, ylim=Non
                         [], False, False, False, addstrokelines=addstrokelines)
     return ax
 
-def save_stroke_gif(stroke_data, full_stroke_gif_path):
-    original_strokes = stroke_data["trialstrokes"]
-    ims = []
-    
-    for partial_idx in range(1, len(original_strokes)):
-        partial_strokes = original_strokes[:partial_idx]
-        partial_stroke_data = {
-            "trialstrokes" : partial_strokes,
-            "trialprimitives" : [],
-            "trialcircleparams" : []
-        }
-        ax = plotDrawing(partial_stroke_data)
-        xlim, ylim = ax.get_xlim(), ax.get_ylim()
-    
-    # Do it all again with the final limits
-    for partial_idx in range(1, len(original_strokes)):
-        partial_strokes = original_strokes[:partial_idx]
-        partial_stroke_data = {
-            "trialstrokes" : partial_strokes,
-            "trialprimitives" : [],
-            "trialcircleparams" : []
-        }
-        ax = plotDrawing(partial_stroke_data,xlim=xlim, ylim=ylim)    
-        ax.figure.canvas.draw()       # draw the canvas, cache the renderer
-        image = np.frombuffer(ax.figure.canvas .tostring_rgb(), dtype='uint8')
-        image  = image.reshape(ax.figure.canvas.get_width_height()[::-1] + (3,))
-        ims.append(image)
-    imageio.mimsave(full_stroke_gif_path, ims, fps=5)
+def save_stroke_gif(stroke_data, full_stroke_gif_path, fps=5, frames="stroke", **canvas_kwargs):
+    """Animates a drawing stroke by stroke, ending with the full drawing.
+    With frames="time", frames follow the recorded point times instead. See animate.py.
+    """
+    animate.save_stroke_animation(stroke_data["trialstrokes"], full_stroke_gif_path, frames=frames, fps=fps, **canvas_kwargs)
 
 def saveDrawing(datflat_single, output_path, ax=[], addstrokelines=False):
     D = datflat_single
-    if not ax:
+    created_figure = not ax
+    if created_figure:
         plt.figure()
         ax = plt.axes()
     ax.grid(False)
@@ -102,7 +82,10 @@ def saveDrawing(datflat_single, output_path, ax=[], addstrokelines=False):
     plotstimwrapper(ax, D["trialstrokes"], D["trialprimitives"], D["trialcircleparams"], 
                         [], False, False, False, addstrokelines=addstrokelines)
     plt.savefig(output_path)
-    
+    if created_figure:
+        # Otherwise every call leaks a figure when rendering many drawings.
+        plt.close(ax.figure)
+
 
 def plotstimwrapper(ax, strokes, primitives=[], circle_params=[], times=[], 
     singleStrokes=False, use_snapped_lines=False, use_actual_time=False, 
@@ -9,6 +9,14 @@ Assumes stimuli_set files (containing the full set of stimuli to draw on from th
 Generates JSON files in the following format: (see configs.py)
 
 Writes out config files to a {CONFIG_DIR}/{EXPERIMENT}_{STIMULI_SET}/{condition}/batch_{N}_shuffle_{N}.json file.
+By default every experiment draws from one random sequence seeded with --seed, in the order given, so a seed gives the
+same configs as it always has. With --per_experiment_seeds each experiment is instead seeded from --seed and its own
+id and shuffles its own copy of the stimuli set, so its configs do not depend on the other experiments; only then can
+experiments be generated in parallel (--n_processes). The two give different configs for the same --seed. A config file is only rewritten when its content (ignoring the
+generation timestamp) has changed. {CONFIG_DIR}/manifest.json lists every config under {CONFIG_DIR} and its content
+hash, and {CONFIG_DIR}/configs.bundle compiles all of them into one file, which the server (config_catalog.py)
+loads in preference to the individual files. Passing --experiments with no experiments only refreshes the manifest
+and the bundle.
 
 Usage: python gen_experiment_configs.py
         --experiment 0_baselines_priors_a_train-none-draw-describe-sample-interleave
@@ -20,16 +28,22 @@ Usage: python gen_experiment_configs.py
         --seed 0
         
 """
-import os, json, argparse, random, copy
+import os, sys, json, argparse, random, copy
+import hashlib
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from collections import defaultdict
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+import config_catalog
+
 DEFAULT_OUTPUT_DIR = "static/configs"
 INPUT_STIMULI_SET_DIR = 'static/stimuli_sets'
 DEFAULT_STIMULI_SET = "train_images_test_common_s12_s13_neurips_2020"
 INPUT_LANGUAGE_SET_DIR = "static/language_sets"
 DEFAULT_LANGUAGE_SET = "toy_train_common_test_common_s12_s13_neurips_2020"
+MANIFEST_FILE = config_catalog.MANIFEST_FILE
 
 METADATA = "metadata"
 CONDITIONS = "conditions"
@@ -47,6 +61,7 @@ TEST = "test"
 SAMPLE = 'sample'
 SAMPLING = "sampling"
 ALL = "all"
+CONFIGS = "configs"
 
 DRAW = "draw"
 DESCRIBE = "describe"
@@ -115,6 +130,13 @@ parser.add_argument("--shuffles_per_stimuli_set",
 parser.add_argument("--seed",
                     default=0,
                     help='Random seed.')
+parser.add_argument("--per_experiment_seeds",
+                    action='store_true',
+                    help="Seed each experiment from --seed and its id. Gives different configs than the default single sequence.")
+parser.add_argument("--n_processes",
+                    default=1,
+                    type=int,
+                    help="How many experiments to generate concurrently. Requires --per_experiment_seeds.")
 
 EXPERIMENT_CONFIG_GENERATOR_REGISTRY = {}
 def register(name):
@@ -167,8 +189,8 @@ def generate_0_baselines_priors(args, experiment_id, stimuli_set):
     config_path = os.path.join(get_config_dir(experiment_id, args), condition)
     for shuffle in range(args.shuffles_per_stimuli_set):
         random.shuffle(all_test_stimuli)
-        n_batches = int(all_test_stimuli / args.test_batch_size) + 1 if args.test_batch_size is not ALL else 1
-        test_batch_size = args.test_batch_size if args.test_batch_size is not ALL else len(all_test_stimuli)
+        n_batches = int(all_test_stimuli / args.test_batch_size) + 1 if args.test_batch_size != ALL else 1
+        test_batch_size = args.test_batch_size if args.test_batch_size != ALL else len(all_test_stimuli)
         for batch in range(n_batches):
             config_name = get_config_name(batch, shuffle)
             full_config_path = os.path.join(config_path, config_name)
@@ -243,9 +265,9 @@ def get_n_batches_for_condition(args, condition, stimuli_set):
     n_stimuli_per_test_phase = len(stimuli_set[TEST].get(condition, [])) + len(stimuli_set[TEST].get(ALL, []))
     
     max_stimuli_per_train_phase = max(n_stimuli_per_train_phase)
-    n_train_batches = int(max_stimuli_per_train_phase / args.train_batch_size_per_phase) + 1 if args.train_batch_size_per_phase is not ALL else 1
+    n_train_batches = int(max_stimuli_per_train_phase / args.train_batch_size_per_phase) + 1 if args.train_batch_size_per_phase != ALL else 1
     
-    n_test_batches = int(n_stimuli_per_test_phase / args.test_batch_size) + 1 if args.test_batch_size is not ALL else 1
+    n_test_batches = int(n_stimuli_per_test_phase / args.test_batch_size) + 1 if args.test_batch_size != ALL else 1
     return max(n_train_batches, n_test_batches)
 
 def generate_batched_train_test_configs(args, description, experiment_id, stimuli_set):
@@ -278,7 +300,7 @@ def generate_batched_train_test_configs(args, description, experiment_id, stimul
             for train_phase_idx, train_phase_stimuli in enumerate(stimuli_set[TRAIN][condition]):
                 phase_name = get_phase_name(train_phase_idx + 1)
                 random.shuffle(train_phase_stimuli)
-                batch_size = args.train_batch_size_per_phase if args.train_batch_size_per_phase is not ALL else len(train_phase_stimuli)
+                batch_size = args.train_batch_size_per_phase if args.train_batch_size_per_phase != ALL else len(train_phase_stimuli)
                 for batch in range(total_n_batches):
                     config_name = get_config_name(batch, shuffle)
                     full_config_path = os.path.join(config_path, config_name)
@@ -295,7 +317,7 @@ def generate_batched_train_test_configs(args, description, experiment_id, stimul
             for test_phase_idx, test_phase_stimuli in enumerate(test_stimuli_phases):
                 phase_name = get_phase_name(test_phase_idx + total_n_train_phases + 1)
                 random.shuffle(test_phase_stimuli)
-                batch_size = args.test_batch_size if args.test_batch_size is not ALL else len(test_phase_stimuli)
+                batch_size = args.test_batch_size if args.test_batch_size != ALL else len(test_phase_stimuli)
                 for batch in range(total_n_batches):
                     config_name = get_config_name(batch, shuffle)
                     full_config_path = os.path.join(config_path, config_name)
@@ -306,7 +328,7 @@ def generate_batched_train_test_configs(args, description, experiment_id, stimul
                     if batch_start > len(test_phase_stimuli):
                         # TODO (cathywong): this won't actually wrap around.
                         assert False
-                    config_data[phase_name] = get_test_phase_config(experiment_id, test_phase_stimuli, batch_start, batch_end, sampling=False)
+                    config_data[phase_name] = get_test_phase_config(args, experiment_id, test_phase_stimuli, batch_start, batch_end, sampling=False)
             # Finally, the test phase
             for sample_phase_idx in range(n_sample_phases):
                 for batch in range(total_n_batches):
@@ -314,13 +336,20 @@ def generate_batched_train_test_configs(args, description, experiment_id, stimul
                     full_config_path = os.path.join(config_path, config_name)
                     config_data = all_configs[full_config_path]
                     phase_name = get_phase_name(total_n_train_phases + total_n_test_phases)
-                    config_data[phase_name] = get_test_phase_config(experiment_id, None, None, None, sampling=True)
+                    config_data[phase_name] = get_test_phase_config(args, experiment_id, None, None, None, sampling=True)
     return all_configs.items()
 
-def get_description_for_images(args, condition, image_batch):
+LANGUAGE_SETS = {}
+def load_language_set(args):
+    """Loads a language set once per process."""
     full_language_set = os.path.join(args.input_language_set_dir, args.language_set + ".json")
-    with open(full_language_set, 'r') as f:
-        language_data = json.load(f)
+    if full_language_set not in LANGUAGE_SETS:
+        with open(full_language_set, 'r') as f:
+            LANGUAGE_SETS[full_language_set] = json.load(f)
+    return LANGUAGE_SETS[full_language_set]
+
+def get_description_for_images(args, condition, image_batch):
+    language_data = load_language_set(args)
     return [language_data[LANGUAGE][condition][image][0] for image in image_batch]
 
 def get_train_phase_config(args, experiment_id, condition, train_phase_stimuli, batch_start, batch_end):
@@ -339,7 +368,7 @@ def get_train_components_from_experiment_id(experiment_id):
     ui_components = [comp for comp in train_components.split("-") if len(comp) > 0]
     return ui_components
     
-def get_test_phase_config(experiment_id, test_phase_stimuli, batch_start, batch_end, sampling=False):
+def get_test_phase_config(args, experiment_id, test_phase_stimuli, batch_start, batch_end, sampling=False):
     phase_config = dict()
     image_batch = test_phase_stimuli[batch_start:batch_end] if not sampling else [None] * args.sampling_batch_size    
     phase_config[SAMPLING] = sampling
@@ -354,9 +383,6 @@ def get_test_components_from_experiment_id(experiment_id):
     ui_components = [comp for comp in test_components.split("-") if len(comp) > 0 and comp in (DRAW, DESCRIBE)]
     return ui_components
     
-def set_random_seed(args):
-    random.seed(args.seed)
-    
 def load_stimuli_set(args):
     stimuli_path = os.path.join(args.input_stimuli_set_dir, args.stimuli_set + ".json")
     with open(stimuli_path, 'r') as f:
@@ -388,28 +414,114 @@ def maybe_abbreviate_config(args, config_path, config):
     return config_path, config
         
     
+def content_hash(config):
+    """Hash of a config's content, ignoring the generation timestamp."""
+    content = dict(config)
+    content[METADATA] = {key: value for key, value in config[METADATA].items() if key != TIMESTAMP}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+def generate_experiment_configs(args, experiment, stimuli_set):
+    """Returns [(config_path, config, content_hash)] for one experiment. Runs in a worker process with --n_processes."""
+    if args.per_experiment_seeds:
+        # Each experiment gets its own seed, and its own copy of the stimuli set to shuffle.
+        random.seed(f"{args.seed}_{experiment}")
+        stimuli_set = copy.deepcopy(stimuli_set)
+    experiment_config_generator_fn = EXPERIMENT_CONFIG_GENERATOR_REGISTRY[experiment]
+    configs = []
+    for config_path, config in experiment_config_generator_fn(args, experiment, stimuli_set):
+        config_path, config = maybe_abbreviate_config(args, config_path, config)
+        configs.append((config_path, config, content_hash(config)))
+    return configs
+
+def write_json(path, data):
+    """Writes through a temporary file, so the server never reads a partly written file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def load_manifest(args):
+    manifest_path = os.path.join(args.output_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)[CONFIGS]
+
+def write_manifest(args, manifest):
+    """Writes the manifest of every config under the output directory, and compiles them into the bundle, if they changed."""
+    configs = {}
+    for root, dirs, files in os.walk(args.output_dir):
+        for name in files:
+            full_config_path = os.path.join(root, name)
+            config_path = os.path.relpath(full_config_path, args.output_dir).replace(os.sep, "/")
+            if not name.endswith(".json") or config_path == MANIFEST_FILE:
+                continue
+            if config_path not in manifest:
+                # Written before there was a manifest.
+                with open(full_config_path, 'r') as f:
+                    manifest[config_path] = content_hash(json.load(f))
+            configs[config_path] = manifest[config_path]
+    configs = dict(sorted(configs.items()))
+    manifest_changed = configs != load_manifest(args)
+    if manifest_changed:
+        pathlib.Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+        write_json(os.path.join(args.output_dir, MANIFEST_FILE), {CONFIGS: configs})
+    if manifest_changed or not os.path.exists(os.path.join(args.output_dir, config_catalog.BUNDLE_FILE)):
+        print(f"Writing out config bundle to: {config_catalog.write_bundle(args.output_dir, configs)}")
+    return configs
+
+def write_config_if_changed(args, config_path, config, config_hash, manifest):
+    """Writes a config unless the manifest already has it with the same content. Returns whether it was written."""
+    full_config_path = os.path.join(args.output_dir, config_path)
+    if manifest.get(config_path) == config_hash and os.path.exists(full_config_path):
+        return False
+    pathlib.Path(os.path.dirname(full_config_path)).mkdir(parents=True, exist_ok=True)
+    print(f"Writing out config to: {full_config_path}")
+    write_json(full_config_path, config)
+    manifest[config_path] = config_hash
+    return True
+
 def iteratively_generate_experiment_configs(args, stimuli_set):
     for experiment in args.experiments:
         if experiment not in EXPERIMENT_CONFIG_GENERATOR_REGISTRY:
             print(f"Experiment config not found: {experiment}")
             assert False
-        experiment_config_generator_fn = EXPERIMENT_CONFIG_GENERATOR_REGISTRY[experiment]
-        config_data = experiment_config_generator_fn(args, experiment, stimuli_set)
-        
-        for config_path, config in config_data:
-            config_path, config = maybe_abbreviate_config(args, config_path, config)
-            output_dir = os.path.join(args.output_dir, os.path.dirname(config_path))
-            pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
-            full_config_path = os.path.join(args.output_dir, config_path)
-            print(f"Writing out config to: {full_config_path}")
-            with open(full_config_path, 'w') as f:
-                json.dump(config, f) 
+    if args.n_processes > 1 and not args.per_experiment_seeds:
+        # With one shared random sequence, each experiment's configs depend on the ones generated before it.
+        print("--n_processes requires --per_experiment_seeds.")
+        assert False
+    if args.language_set:
+        # Loaded here so that forked workers share it.
+        load_language_set(args)
+    manifest = load_manifest(args)
+    n_written, n_unchanged = 0, 0
+    def write_configs(configs):
+        nonlocal n_written, n_unchanged
+        for config_path, config, config_hash in configs:
+            if write_config_if_changed(args, config_path, config, config_hash, manifest):
+                n_written += 1
+            else:
+                n_unchanged += 1
+    if args.n_processes > 1 and len(args.experiments) > 1:
+        with ProcessPoolExecutor(min(args.n_processes, len(args.experiments))) as executor:
+            futures = [executor.submit(generate_experiment_configs, args, experiment, stimuli_set) for experiment in args.experiments]
+            for future in futures:
+                write_configs(future.result())
+    else:
+        for experiment in args.experiments:
+            write_configs(generate_experiment_configs(args, experiment, stimuli_set))
+    configs = write_manifest(args, manifest)
+    print(f"Wrote {n_written} configs ({n_unchanged} unchanged); {len(configs)} configs listed in: {os.path.join(args.output_dir, MANIFEST_FILE)}")
                 
+def set_random_seed(args):
+    random.seed(args.seed)
+
 def main(args):
-    set_random_seed(args)
+    if not args.per_experiment_seeds:
+        set_random_seed(args)
     stimuli_set = load_stimuli_set(args)
     iteratively_generate_experiment_configs(args, stimuli_set)
 
 if __name__ == '__main__':
   args = parser.parse_args()
-  main(args)
\ No newline at end of file
+  main(args)
@@ -0,0 +1,287 @@
+"""
+load_test_server.py | Replays simulated participant sessions against server.py and reports latency per route.
+
+Each simulated participant goes through the same requests as a browser running static/js/task.js:
+    /consent with Prolific query args (PROLIFIC_PID, STUDY_ID, SESSION_ID, experiment_id, condition)
+    /instructions?index=N for every instruction page, until the experiment page is served
+    /experiment_config
+    one POST per trial, with synthetic strokes of realistic size: the first creates the record through
+        /record_data, the others are appended through /record_trial, the last one marks the record completed
+    /feedback (GET, then POST the questionnaire)
+Sessions start as a Poisson process at --arrival_rate per second, at most --concurrency at a time, until
+--n_sessions have started. --think_time adds a pause between requests.
+
+Without --base_url, a local server.py is started on --port with local stand-ins for everything it stores:
+STORAGE_BACKEND=sqlite and the session and assignment databases in a temporary directory (unless already
+set in the environment). server.py still needs the deployment's certs.py on the Python path.
+
+The report (--report, JSON) has, per route and overall: requests, errors (failed requests, HTTP errors and
+records the server did not store), throughput and p50 / p95 / p99 / mean / max latency in ms, plus the
+settings, session counts and the git commit, so reports can be compared across commits.
+
+Usage:
+    load_test_server.py --n_sessions 200 --concurrency 50 --arrival_rate 10 --report load_test_report.json
+"""
+DEFAULT_EXPERIMENT_ID = "0_baselines_priors__train-none__test-default__neurips_2020"
+DEFAULT_CONDITION = "all"
+DEFAULT_PORT = 5055
+DEFAULT_REPORT = "load_test_report.json"
+SERVER_START_TIMEOUT_SECONDS = 30
+MAX_INSTRUCTION_PAGES = 50
+EXPERIMENT_PAGE_MARKER = b'id="next-image"'
+PERCENTILES = [50, 95, 99]
+
+import os, sys, json, time, random, argparse, threading, subprocess, tempfile
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+sys.path.append(os.path.join(REPO_ROOT, "scripts"))
+from benchmarks import synthetic_data
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--base_url',
+                    default=None,
+                    help="Server to test. Without it, a local server.py is started.")
+parser.add_argument('--port',
+                    default=DEFAULT_PORT,
+                    type=int,
+                    help="Port for the local server.")
+parser.add_argument('--n_sessions',
+                    default=100,
+                    type=int,
+                    help="How many participant sessions to run.")
+parser.add_argument('--concurrency',
+                    default=20,
+                    type=int,
+                    help="Maximum number of sessions in flight.")
+parser.add_argument('--arrival_rate',
+                    default=5.0,
+                    type=float,
+                    help="Mean new sessions per second. 0 starts them all at once.")
+parser.add_argument('--think_time',
+                    default=0.0,
+                    type=float,
+                    help="Seconds between the requests of a session.")
+parser.add_argument('--experiment_id',
+                    default=DEFAULT_EXPERIMENT_ID,
+                    help="experiment_id passed to /consent.")
+parser.add_argument('--condition',
+                    default=DEFAULT_CONDITION,
+                    help="condition passed to /consent.")
+parser.add_argument('--stroke_format',
+                    default=synthetic_data.COMPACT_FORMAT,
+                    choices=synthetic_data.STROKE_FORMATS,
+                    help="Send strokes as static/js/stroke_codec.js does, or as the older sketchpad.json().")
+parser.add_argument('--timeout',
+                    default=30.0,
+                    type=float,
+                    help="Request timeout in seconds.")
+parser.add_argument('--seed',
+                    default=0,
+                    type=int)
+parser.add_argument('--report',
+                    default=DEFAULT_REPORT,
+                    help="Where to write the JSON report.")
+
+### Requests.
+class RouteStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, route, latency, error):
+        with self.lock:
+            self.latencies[route].append(latency)
+            if error:
+                self.errors[route] += 1
+
+class Participant(object):
+    """One simulated browser: its own cookies, so its own server-side session."""
+    def __init__(self, args, base_url, stats, participant_idx):
+        self.args = args
+        self.base_url = base_url.rstrip("/")
+        self.stats = stats
+        self.rng = random.Random(f"{args.seed}_{participant_idx}")
+        self.user_id = f"load_test_{args.seed}_{participant_idx}"
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, route, query=None, json_data=None, form_data=None):
+        """Returns (status, body). Failed requests are recorded as errors and return status 0."""
+        url = self.base_url + route + ("?" + urllib.parse.urlencode(query) if query else "")
+        data, headers = None, {}
+        if json_data is not None:
+            data, headers = json.dumps(json_data).encode("utf-8"), {"Content-Type": "application/json; charset=utf-8"}
+        elif form_data is not None:
+            data = urllib.parse.urlencode(form_data).encode("utf-8")
+        start = time.perf_counter()
+        try:
+            with self.opener.open(urllib.request.Request(url, data=data, headers=headers), timeout=self.args.timeout) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        except Exception:
+            status, body = 0, b""
+        latency = time.perf_counter() - start
+        error = status == 0 or status >= 400
+        if not error and json_data is not None:
+            # The record routes answer 200 with success False when nothing was stored.
+            try:
+                error = json.loads(body).get("success") is False
+            except ValueError:
+                error = True
+        self.stats.add(route, latency, error)
+        if self.args.think_time:
+            time.sleep(self.args.think_time)
+        return status, body
+
+    def run(self):
+        """Runs the whole session. Returns whether it got to the end."""
+        status, _ = self.request("/consent", {"PROLIFIC_PID": self.user_id, "STUDY_ID": "load_test",
+                                              "SESSION_ID": self.user_id, "experiment_id": self.args.experiment_id,
+                                              "condition": self.args.condition})
+        if status != 200:
+            return False
+        for index in range(MAX_INSTRUCTION_PAGES):
+            status, body = self.request("/instructions", {"index": index})
+            if status != 200 or EXPERIMENT_PAGE_MARKER in body:
+                break
+        status, body = self.request("/experiment_config")
+        if status != 200:
+            return False
+        config = json.loads(body)
+        if not self.record_trials(config):
+            return False
+        self.request("/feedback")
+        status, _ = self.request("/feedback", form_data={"feedback": "load test", "difficulty": "3"})
+        return status == 200
+
+    def record_trials(self, config):
+        data = dict(config)
+        data["metadata"] = dict(config["metadata"], user_id=self.user_id)
+        trials = [(phase, trial_index) for phase in config["phases"] for trial_index in range(len(config[phase]["images"]))]
+        for trial_number, (phase, trial_index) in enumerate(trials):
+            strokes, description = synthetic_data.synthetic_strokes(self.rng, self.args.stroke_format), "a shape"
+            data[phase] = dict(data[phase], strokes=data[phase].get("strokes", []) + [strokes],
+                               user_descriptions=data[phase].get("user_descriptions", []) + [description])
+            completed = trial_number == len(trials) - 1
+            if trial_number == 0:
+                # As in task.js: the first trial creates the record with the whole config.
+                data["metadata"]["completed"] = completed
+                status, _ = self.request("/record_data", json_data=data)
+            else:
+                status, _ = self.request("/record_trial", json_data={
+                    "metadata": {"user_id": self.user_id, "experiment_id": data["metadata"]["experiment_id"]},
+                    "phase": phase, "trial_index": trial_index, "strokes": strokes,
+                    "user_description": description, "completed": completed})
+            if status != 200:
+                return False
+        return True
+
+### Local server.
+def start_local_server(args, tmp_dir):
+    env = dict(os.environ)
+    env.setdefault("STORAGE_BACKEND", "sqlite")
+    env.setdefault("STORAGE_SQLITE_PATH", os.path.join(tmp_dir, "laps.db"))
+    env.setdefault("SESSION_SQLITE_PATH", os.path.join(tmp_dir, "sessions.db"))
+    env.setdefault("ASSIGNMENT_DB_PATH", os.path.join(tmp_dir, "assignments.db"))
+    launcher = ("import sys; from werkzeug.serving import run_simple; import server; "
+                f"run_simple('127.0.0.1', {args.port}, server.app, threaded=True)")
+    process = subprocess.Popen([sys.executable, "-c", launcher], cwd=REPO_ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    base_url = f"http://127.0.0.1:{args.port}"
+    deadline = time.time() + SERVER_START_TIMEOUT_SECONDS
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server.py exited: {process.stderr.read().decode('utf-8', 'replace')[-2000:]}")
+        try:
+            urllib.request.urlopen(base_url + "/experiment_types", timeout=1).read()
+            return process, base_url
+        except Exception:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("server.py did not start")
+
+### Report.
+def latency_summary(latencies, errors, duration):
+    latencies_ms = np.array(latencies) * 1000
+    summary = {"requests": len(latencies), "errors": errors,
+               "error_rate": errors / len(latencies) if len(latencies) else 0,
+               "throughput_rps": len(latencies) / duration if duration else 0}
+    if len(latencies):
+        summary.update({f"p{p}_ms": float(np.percentile(latencies_ms, p)) for p in PERCENTILES})
+        summary.update(mean_ms=float(latencies_ms.mean()), max_ms=float(latencies_ms.max()))
+    return summary
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def build_report(args, stats, duration, n_completed, n_failed):
+    routes = {route: latency_summary(latencies, stats.errors[route], duration)
+              for route, latencies in sorted(stats.latencies.items())}
+    all_latencies = [latency for latencies in stats.latencies.values() for latency in latencies]
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {key: value for key, value in vars(args).items() if key != "report"},
+        "duration_s": duration,
+        "sessions": {"started": n_completed + n_failed, "completed": n_completed, "failed": n_failed,
+                     "sessions_per_s": (n_completed + n_failed) / duration if duration else 0},
+        "overall": latency_summary(all_latencies, sum(stats.errors.values()), duration),
+        "routes": routes,
+    }
+
+def print_report(report):
+    print(f"{report['sessions']['completed']} / {report['sessions']['started']} sessions completed in {report['duration_s']:.1f}s")
+    print(f"{'route':<22}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for route, summary in list(report["routes"].items()) + [("overall", report["overall"])]:
+        print(f"{route:<22}{summary['requests']:>10}{summary['errors']:>8}{summary['throughput_rps']:>9.1f}"
+              f"{summary.get('p50_ms', 0):>9.1f}{summary.get('p95_ms', 0):>9.1f}{summary.get('p99_ms', 0):>9.1f}")
+
+def run_load_test(args, base_url):
+    stats = RouteStats()
+    rng = random.Random(args.seed)
+    futures = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        next_arrival = start
+        for participant_idx in range(args.n_sessions):
+            if args.arrival_rate > 0:
+                next_arrival += rng.expovariate(args.arrival_rate)
+                time.sleep(max(0, next_arrival - time.perf_counter()))
+            futures.append(executor.submit(Participant(args, base_url, stats, participant_idx).run))
+        wait(futures)
+    duration = time.perf_counter() - start
+    n_completed = sum(1 for future in futures if not future.exception() and future.result())
+    return build_report(args, stats, duration, n_completed, len(futures) - n_completed)
+
+def main(args):
+    server_process = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base_url = args.base_url
+        if base_url is None:
+            server_process, base_url = start_local_server(args, tmp_dir)
+        try:
+            report = run_load_test(args, base_url)
+        finally:
+            if server_process is not None:
+                server_process.terminate()
+                server_process.wait()
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
+    print(f"Wrote report to: {args.report}")
+
+if __name__ == '__main__':
+  args = parser.parse_args()
+  main(args)
@@ -1,43 +1,95 @@
 import os
+import hmac
 import json
+import logging
+import functools
 import certs
-import db_utils
-import numpy as np
+import config_catalog
+import session_store
+import assignment
+import write_behind
+import response_cache
+import metrics
+import storage
+import structured_logging
 from flask import Flask
 from flask import request
 from flask import session
 from flask import Response
 from flask import jsonify
-from flask import render_template, redirect, url_for
+from flask import render_template, redirect, url_for, abort
 from bson import json_util
 
-import logging
-logging.basicConfig(filename='info.log', level=logging.DEBUG)
-
 app = Flask(__name__)
 app.secret_key = certs.secret_app_key
+# JSON log records with the request's id, route and participant, written to info.log by a background thread.
+structured_logging.configure(app)
+# The session cookie only carries a session id; session data is kept server-side.
+app.session_interface = session_store.session_interface_from_env()
+# ETags, conditional GETs and compression for text and JSON responses.
+response_cache.install(app)
+# Per-route latency and size histograms and database timings, served by /metrics.
+metrics.install(app)
+
+# Load every experiment config once at startup; SIGHUP or a changed file triggers a reload.
+config_catalog.reload()
+config_catalog.install_reload_signal()
+# Hands out the least-filled config slot to each new participant.
+scheduler = assignment.scheduler_from_env()
+
+# STORAGE_BACKEND picks MongoDB or a local SQLite file. With WRITE_BEHIND=1 participant data is
+# spooled locally and flushed to the storage backend in the background.
+storage_backend = storage.get_backend()
+recorder = write_behind if write_behind.ENABLED else storage_backend
+if write_behind.ENABLED:
+    write_behind.start()
+
+def participant_id():
+    return session.get('user_id') or session.sid
+
+def is_admin_request():
+    """Whether the request carries certs.admin_token, as an X-Admin-Token header or ?token=. Without a token in
+    certs.py no request is."""
+    expected = getattr(certs, 'admin_token', None)
+    given = request.headers.get('X-Admin-Token') or request.args.get('token', '', type=str)
+    return bool(expected) and hmac.compare_digest(given.encode(), expected.encode())
 
 @app.route('/experiment_types', methods=['GET'])
 def exps():
-    exps = []
-    for root, dirs, files in os.walk("static/configs", topdown=False):
-        for name in files:
-            fname = os.path.join(root, name)
-            config = json.load(open(fname, 'r'))
-            meta = config['metadata']
-            exps.append(meta)
-
-    return Response(json.dumps(exps),  mimetype='application/json')
+    return Response(config_catalog.experiment_types_json(),  mimetype='application/json')
 
 @app.route('/record_data', methods=['POST'])
 def log_data():
     data = request.get_json()
     user_id = data['metadata'].get('user_id')
     if not user_id:
-        return json.dumps({'success':False, 'message': 'No prolific_pid found! Data not logged.'}), 200, {'ContentType':'application/json'}
+        return jsonify({'success':False, 'message': 'No prolific_pid found! Data not logged.'})
+    else:
+        structured_logging.bind(user_id=user_id, experiment_id=data['metadata'].get('experiment_id'))
+        status = recorder.record(data)
+        app.logger.log(logging.INFO if status['success'] else logging.WARNING, 'Recorded data: ' + status['message'],
+                       extra={'event': 'record', 'completed': bool(data['metadata'].get('completed'))})
+        if status['success'] and data['metadata'].get('completed'):
+            scheduler.complete(participant_id())
+        return jsonify(status)
+
+@app.route('/record_trial', methods=['POST'])
+def log_trial():
+    data = request.get_json()
+    user_id = data['metadata'].get('user_id')
+    if not user_id:
+        return jsonify({'success':False, 'message': 'No prolific_pid found! Data not logged.'})
     else:
-        status = db_utils.record(data)
-        return json.dumps(status), 200, {'ContentType':'application/json'}
+        structured_logging.bind(user_id=user_id, experiment_id=data['metadata']['experiment_id'])
+        status = recorder.record_trial(user_id, data['metadata']['experiment_id'], data['phase'], data['trial_index'],
+                                      data.get('strokes'), data.get('user_description', ''), completed=data.get('completed', False))
+        # One of these per trial, so successful ones are sampled (LOG_SAMPLE_RATES).
+        app.logger.log(logging.INFO if status['success'] else logging.WARNING, 'Recorded trial: ' + status['message'],
+                       extra={'event': 'record_trial', 'phase': data['phase'], 'trial_index': data['trial_index'],
+                              'completed': bool(data.get('completed'))})
+        if status['success'] and data.get('completed'):
+            scheduler.complete(participant_id())
+        return jsonify(status)
 
 def get_instruction_pages(config):
     instruction_pages = ['instructions/overview-1.html',
@@ -56,7 +108,6 @@ def get_instruction_pages(config):
         if config[phase].get('sampling'):
             elements.add('sample')
 
-    print(elements)
     if 'images' in elements:
         tasks.append('Look at images')
 
@@ -85,6 +136,18 @@ def get_instruction_pages(config):
     instruction_pages.append('instructions/quiz.html')
     return tasks, instruction_pages
 
+def instruction_plan(config_key):
+    """(tasks, instruction_pages, n_phases) for a config, computed once per config."""
+    def plan(config):
+        tasks, instruction_pages = get_instruction_pages(config)
+        return tuple(tasks), tuple(instruction_pages), len(config['phases'])
+    return config_catalog.get_derived(config_key, 'instruction_plan', plan)
+
+@functools.lru_cache(maxsize=1024)
+def render_instruction_page(page, index, tasks, n_phases):
+    # Instruction pages only depend on these arguments, so each combination is rendered once.
+    return render_template(page, index=index, tasks=tasks, n_phases=n_phases)
+
 @app.route('/instructions', methods=['GET'])
 def instructions():
     """
@@ -105,53 +168,34 @@ def instructions():
         session['experiment_id'] = experiment_id
         session['condition'] = condition
     """ 
-    if not session.get('config'):
+    config_key = session.get('config_key')
+    if not config_key or not config_catalog.has_config(tuple(config_key)):
         get_config()
-
-    print(session['config']['metadata']['experiment_id'])
     index = max(0, request.args.get('index', 0, type=int))
-    tasks, instruction_pages = get_instruction_pages(session['config'])
-    n_phases = len(session['config']['phases'])
+    tasks, instruction_pages, n_phases = instruction_plan(tuple(session['config_key']))
 
     if index >= len(instruction_pages):
-        return render_template("experiment.html")
+        return response_cache.render_static("experiment.html")
     else:
-        return render_template(instruction_pages[index], index=index, tasks=tasks, n_phases=n_phases)
+        return render_instruction_page(instruction_pages[index], index, tasks, n_phases)
 
 @app.route('/experiment_config', methods=['GET'])
 def get_config():
     experiment_id = session.get('experiment_id')
     condition = session.get('condition')
 
-    if experiment_id and condition:
-        config_path = os.path.join('static/configs', experiment_id, condition, 'batch_0_shuffle_0.json')
-        config = json.load(open(config_path, 'r'))
-    else:
-        exp_path = os.path.join('static/configs')
-        experiment_configs = []
-        for root, dirs, files in os.walk(exp_path, topdown=False):
-            if experiment_id:
-                dirs = [d for d in dirs if d == experiment_id]
-            elif condition:
-                dirs = [d for d in dirs if d == condition]  # TODO: @Yoni this is probably super buggy
-
-            for name in files:
-                fname = os.path.join(root, name)
-                if experiment_id and experiment_id not in fname:
-                    continue
-                if condition and condition not in fname:
-                    continue
-                print(fname)
-                experiment_configs.append(fname)
-
-        config_path = np.random.choice(experiment_configs)
-        config = json.load(open(config_path, 'r'))
+    scheduler.sync_slots(config_catalog.get_catalog()['keys'])
+    config_key = scheduler.assign(participant_id(), experiment_id, condition)
+    if config_key is None:
+        abort(404)
+    config = config_catalog.get_config(config_key)
 
     config['metadata']['user_id'] = session.get('user_id')
     config['metadata']['study_id'] = session.get('study_id')
     config['metadata']['session_id'] = session.get('session_id')
 
-    session['config'] = config
+    # Only a reference to the catalog entry is kept in the session, not the config itself.
+    session['config_key'] = list(config_key)
     return jsonify(config)
 
 @app.route('/experiment', methods=['GET'])
@@ -174,7 +218,7 @@ def experiment():
             session['experiment_id'] = experiment_id
             session['condition'] = condition
         """
-        return render_template("experiment.html")
+        return response_cache.render_static("experiment.html")
 
 @app.route('/consent', methods=['GET'])
 def consent():
@@ -185,11 +229,13 @@ def consent():
             experiment_id = request.args.get('experiment_id', '', type=str)
             condition = request.args.get('condition', '', type=str)
             
-            if user_id and db_utils.repeat_user(user_id):
-                return render_template("duplicate.html")
+            structured_logging.bind(user_id=user_id, experiment_id=experiment_id)
+            # The admin user's test runs are overwritten (see db_utils.record), so admin is never a repeat.
+            if user_id and user_id != 'admin' and storage_backend.repeat_user(user_id):
+                app.logger.info('Repeat user', extra={'event': 'repeat_user'})
+                return response_cache.render_static("duplicate.html")
 
-            app.logger.info("experiment id " + str(experiment_id))
-            app.logger.info("condition: " + str(condition))
+            app.logger.info('Consent', extra={'event': 'consent', 'condition': condition, 'study_id': study_id})
 
             session['user_id'] = user_id
             session['study_id'] = study_id
@@ -197,16 +243,16 @@ def consent():
             session['experiment_id'] = experiment_id
             session['condition'] = condition
             
-    return render_template("consent.html")
+    return response_cache.render_static("consent.html")
 
 @app.errorhandler(404)
 def not_found(error):
-    return render_template('error.html'), 404
+    return response_cache.render_static('error.html'), 404
 
 @app.route('/feedback', methods=['GET', 'POST'])
 def feedback():
     if request.method == 'GET': 
-        return render_template("questionnaire.html")
+        return response_cache.render_static("questionnaire.html")
     
     if request.method == 'POST':
         data = {}
@@ -216,24 +262,45 @@ def feedback():
         user_id = session['user_id']
         experiment_id = session['experiment_id']
 
-        result = db_utils.update_record(user_id, experiment_id, {'feedback': data})
+        result = recorder.update_record(user_id, experiment_id, {'feedback': data})
+        app.logger.info('Recorded feedback', extra={'event': 'feedback'})
         
-        return render_template("thank-you.html")
+        return response_cache.render_static("thank-you.html")
 
 
 @app.route('/viewing', methods=['GET'])
 def view_data():
     user_id = request.args.get('user_id', '', type=str) 
     experiment_id = request.args.get('experiment_id', '', type=str)
-    app.logger.info('Viewing data for: ')
-    app.logger.info('user_id: ' + str(user_id)) 
-    app.logger.info('experiment_id: ' + str(experiment_id)) 
+    structured_logging.bind(user_id=user_id, experiment_id=experiment_id)
+    app.logger.info('Viewing data', extra={'event': 'viewing'})
     session['user_id'] = user_id
     session['experiment_id'] = experiment_id
 
-    return render_template('viewing.html')
+    return response_cache.render_static('viewing.html')
+
+@app.route('/health', methods=['GET'])
+def health():
+    status = {
+        'database': storage_backend.health_check(),
+        'connections': storage_backend.connection_stats(),
+        'write_behind': write_behind.stats(),
+        'responses': response_cache.stats()
+    }
+    return jsonify(status), 200 if status['database'] else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics_text():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/quotas', methods=['GET'])
+def quotas():
+    # Assignment counts are for the experimenters only.
+    if not is_admin_request():
+        abort(404)
+    return jsonify(scheduler.quota_table())
 
 @app.route('/user_results', methods=['GET'])
 def get_results():
-    res = db_utils.get_record(user_id=session['user_id'], experiment_id=session['experiment_id'])
+    res = storage_backend.get_record(user_id=session['user_id'], experiment_id=session['experiment_id'])
     return jsonify(json.loads(json_util.dumps(res)))
@@ -0,0 +1,147 @@
+"""
+session_store.py | Server-side Flask sessions.
+
+Flask's default session serialises everything into a signed cookie. Here the cookie only carries a
+signed session id and the session data lives on the server, in one of:
+    memory : in-process LRU with a TTL. Only suitable for a single server process.
+    sqlite : a SQLite file shared by every process on the machine (eg. the FastCGI workers
+             started from index.fcgi).
+
+Configured from the environment:
+    SESSION_BACKEND (sqlite), SESSION_SQLITE_PATH (sessions.db), SESSION_TTL_SECONDS (86400),
+    SESSION_MAX_ENTRIES (10000, memory backend only)
+"""
+import os
+import json
+import time
+import secrets
+import threading
+from collections import OrderedDict
+
+import local_sqlite
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+
+DEFAULT_BACKEND = 'sqlite'
+DEFAULT_SQLITE_PATH = 'sessions.db'
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 10000
+PURGE_EVERY_N_SAVES = 500
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+class MemoryStore(object):
+    """LRU of session id -> (expiry, data) for a single process."""
+    def __init__(self, ttl=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, sid):
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires < time.time():
+                del self.entries[sid]
+                return None
+            self.entries.move_to_end(sid)
+            return json.loads(data)
+
+    def set(self, sid, data):
+        with self.lock:
+            self.entries[sid] = (time.time() + self.ttl, json.dumps(data))
+            self.entries.move_to_end(sid)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+class SQLiteStore(object):
+    """Sessions in a SQLite file, so that several server processes see the same sessions."""
+    def __init__(self, path=DEFAULT_SQLITE_PATH, ttl=DEFAULT_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self.connection = local_sqlite.ThreadLocalConnection(path).get
+        self.n_saves = 0
+        conn = self.connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)')
+
+    def get(self, sid):
+        row = self.connection().execute('SELECT data FROM sessions WHERE sid = ? AND expires >= ?',
+                                        (sid, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, sid, data):
+        conn = self.connection()
+        conn.execute('INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)',
+                     (sid, json.dumps(data), time.time() + self.ttl))
+        self.n_saves += 1
+        if self.n_saves % PURGE_EVERY_N_SAVES == 0:
+            conn.execute('DELETE FROM sessions WHERE expires < ?', (time.time(),))
+
+    def delete(self, sid):
+        self.connection().execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def signer(self, app):
+        return Signer(app.secret_key, salt='server-side-session')
+
+    def open_session(self, app, request):
+        signed_sid = request.cookies.get(self.get_cookie_name(app))
+        if signed_sid:
+            try:
+                sid = self.signer(app).unsign(signed_sid).decode('utf-8')
+            except BadSignature:
+                sid = None
+            data = self.store.get(sid) if sid else None
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified and not session.new:
+            return
+        self.store.set(session.sid, dict(session))
+        response.set_cookie(name, self.signer(app).sign(session.sid).decode('utf-8'),
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+def session_interface_from_env():
+    backend = os.environ.get('SESSION_BACKEND', DEFAULT_BACKEND)
+    ttl = float(os.environ.get('SESSION_TTL_SECONDS', DEFAULT_TTL_SECONDS))
+    if backend == 'memory':
+        store = MemoryStore(ttl, int(os.environ.get('SESSION_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)))
+    elif backend == 'sqlite':
+        store = SQLiteStore(os.environ.get('SESSION_SQLITE_PATH', DEFAULT_SQLITE_PATH), ttl)
+    else:
+        raise ValueError(f"Unknown session backend: {backend}")
+    return ServerSideSessionInterface(store)
@@ -0,0 +1,143 @@
+"""
+sqlite_storage.py | Embedded SQLite implementation of the db_utils storage API.
+
+Each record is one row keyed by (experiment_id, user_id) with the full document in a JSON column, so the
+server, the data downloader and load tests can run without the MongoDB cluster. Rules match db_utils:
+admin records go to the 'test' experiment, completed records are never overwritten, and record_trial only
+appends the next trial of a phase.
+
+Set STORAGE_BACKEND=sqlite (see storage.py) and STORAGE_SQLITE_PATH (default laps.db) to use it. Reads and
+writes are timed (metrics.py) under the names of the Mongo operations they stand in for.
+"""
+import os
+import json
+import time
+from datetime import datetime, timezone
+
+import local_sqlite
+import storage
+import metrics
+from local_sqlite import transaction
+
+DEFAULT_SQLITE_PATH = 'laps.db'
+
+def sqlite_path():
+    # Read on every connect, so that setting STORAGE_SQLITE_PATH (eg. per benchmark) switches databases.
+    return os.environ.get('STORAGE_SQLITE_PATH', DEFAULT_SQLITE_PATH)
+
+_connection = None
+
+def open_connection():
+    global _connection
+    path = sqlite_path()
+    if _connection is None or _connection.path != path:
+        _connection = local_sqlite.ThreadLocalConnection(path)
+        _connection.get().executescript('''
+            CREATE TABLE IF NOT EXISTS records (
+                experiment_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                completed INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (experiment_id, user_id));
+            CREATE INDEX IF NOT EXISTS records_user_id ON records (user_id);
+            CREATE INDEX IF NOT EXISTS records_updated_at ON records (experiment_id, updated_at);
+        ''')
+    return _connection.get()
+
+def health_check():
+    try:
+        open_connection().execute('SELECT 1')
+        return True
+    except Exception:
+        return False
+
+def connection_stats():
+    return {'backend': 'sqlite', 'path': sqlite_path(), 'pid': os.getpid()}
+
+def load_record(conn, experiment_id, user_id):
+    with metrics.timed('find_one'):
+        row = conn.execute('SELECT data FROM records WHERE experiment_id = ? AND user_id = ?', (experiment_id, user_id)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def save_record(conn, experiment_id, user_id, data):
+    with metrics.timed('replace_one'):
+        conn.execute('INSERT OR REPLACE INTO records (experiment_id, user_id, completed, updated_at, data) VALUES (?, ?, ?, ?, ?)',
+                     (experiment_id, user_id, int(bool(data['metadata'].get('completed'))), time.time(), json.dumps(data)))
+
+def all_experiment_records(experiment_id, projection=None, updated_since=None):
+    # Records are stored whole, so the projection is ignored. updated_at is returned as a UTC datetime, as in Mongo.
+    since = (updated_since - datetime(1970, 1, 1)).total_seconds() if updated_since else 0
+    rows = open_connection().execute('SELECT data, updated_at FROM records WHERE experiment_id = ? AND updated_at > ? ORDER BY rowid',
+                                     (experiment_id, since))
+    for data, updated_at in rows:
+        record = json.loads(data)
+        record['updated_at'] = datetime.fromtimestamp(updated_at, timezone.utc).replace(tzinfo=None)
+        yield record
+
+def repeat_user(user_id):
+    with metrics.timed('find_one'):
+        return open_connection().execute('SELECT 1 FROM records WHERE user_id = ? LIMIT 1', (user_id,)).fetchone() is not None
+
+def record(data):
+    experiment_id = data['metadata']['experiment_id']
+    user_id = data['metadata']['user_id']
+    if user_id == 'admin':
+        experiment_id = 'test'
+
+    with transaction(open_connection()) as conn:
+        with metrics.timed('find_one'):
+            row = conn.execute('SELECT completed FROM records WHERE experiment_id = ? AND user_id = ?', (experiment_id, user_id)).fetchone()
+        if row and row[0] and user_id != 'admin':
+            return {'success': False, 'message': 'User already completed experiment'}
+        save_record(conn, experiment_id, user_id, data)
+    return {'success': True, 'message': 'Successfully updated record'}
+
+def record_trial(user_id, experiment_id, phase, trial_index, strokes, user_description, completed=False):
+    if user_id == 'admin':
+        experiment_id = 'test'
+    if not storage.valid_trial(phase, trial_index):
+        return {'success': False, 'message': 'Invalid trial'}
+
+    with transaction(open_connection()) as conn:
+        data = load_record(conn, experiment_id, user_id)
+        if data is None:
+            return {'success': False, 'resend_record': True, 'message': 'No record for user'}
+        phase_data = data.setdefault(phase, {})
+        phase_strokes = phase_data.setdefault('strokes', [])
+        if len(phase_strokes) > trial_index:
+            if completed and not data['metadata'].get('completed'):
+                data['metadata']['completed'] = True
+                save_record(conn, experiment_id, user_id, data)
+            return {'success': True, 'message': 'Trial already recorded'}
+        if data['metadata'].get('completed') and user_id != 'admin':
+            return {'success': False, 'message': 'User already completed experiment'}
+        if len(phase_strokes) < trial_index:
+            return {'success': False, 'resend_record': True, 'message': 'Record is missing earlier trials'}
+        phase_strokes.append(strokes)
+        phase_data.setdefault('user_descriptions', []).append(user_description)
+        if completed:
+            data['metadata']['completed'] = True
+        save_record(conn, experiment_id, user_id, data)
+    return {'success': True, 'message': 'Successfully recorded trial'}
+
+def update_record(user_id, experiment_id, data):
+    """Same as a Mongo $set: keys may be dotted paths into the record, including list indices."""
+    with transaction(open_connection()) as conn:
+        record = load_record(conn, experiment_id, user_id)
+        if record is None:
+            return {'success': True, 'message': 'Successfully updated record'}
+        for key, value in data.items():
+            parent = record
+            *path, field = key.split('.')
+            for part in path:
+                parent = parent[int(part)] if isinstance(parent, list) else parent.setdefault(part, {})
+            if isinstance(parent, list):
+                parent[int(field)] = value
+            else:
+                parent[field] = value
+        save_record(conn, experiment_id, user_id, record)
+    return {'success': True, 'message': 'Successfully updated record'}
+
+def get_record(user_id, experiment_id):
+    return load_record(open_connection(), experiment_id, user_id)
@@ -0,0 +1,162 @@
+// Compact encoding of the sketchpad's strokes.
+// Same format as scripts/drawgoodlib/stroke_codec.py: pathorig coordinates quantised to 1 / scale pixel and
+// times in whole ms, both delta encoded, with the path string and default style attributes left out.
+var STROKE_FORMAT_KEY = "dgs";
+var STROKE_FORMAT_VERSION = 1;
+var STROKE_SCALE = 100;
+var STROKE_DEFAULT_ATTRIBUTES = {
+	"fill": "none",
+	"stroke": "#000000",
+	"stroke-opacity": 1,
+	"stroke-width": 2,
+	"stroke-linecap": "round",
+	"stroke-linejoin": "round",
+	"transform": [],
+	"type": "path"
+};
+var STROKE_FIELDS = ["path", "path_nostring", "pathorig", "times", "primitive", "circle"];
+
+function encodeDeltas(values, start) {
+	var deltas = [];
+	var previous = start;
+	for (var i = 0; i < values.length; i++) {
+		deltas.push(values[i] - previous);
+		previous = values[i];
+	}
+	return deltas;
+}
+
+function decodeDeltas(encoded, start) {
+	var deltas = (typeof encoded == "string") ? unpackVarints(encoded) : encoded;
+	var values = [];
+	var value = start;
+	for (var i = 0; i < deltas.length; i++) {
+		value += deltas[i];
+		values.push(value);
+	}
+	return values;
+}
+
+function unpackVarints(packed) {
+	// base64 of zigzag varints, as written by stroke_codec.py with binary=True.
+	var bytes = atob(packed);
+	var values = [];
+	var value = 0, shift = 0;
+	for (var i = 0; i < bytes.length; i++) {
+		var b = bytes.charCodeAt(i);
+		value += (b & 0x7f) * Math.pow(2, shift);
+		shift += 7;
+		if (b < 0x80) {
+			values.push((value % 2) ? -(value + 1) / 2 : value / 2);
+			value = 0;
+			shift = 0;
+		}
+	}
+	return values;
+}
+
+function quantise(values, scale) {
+	return values.map(function(value) { return Math.round(Number(value) * scale); });
+}
+
+function isPolyline(pathNoString) {
+	for (var i = 0; i < pathNoString.length; i++) {
+		if (pathNoString[i].length != 3 || pathNoString[i][0] != (i == 0 ? "M" : "L")) {
+			return false;
+		}
+	}
+	return true;
+}
+
+function encodeStroke(stroke, t0, scale) {
+	var points = stroke.pathorig || [];
+	var x = quantise(points.map(function(p) { return p[0]; }), scale);
+	var y = quantise(points.map(function(p) { return p[1]; }), scale);
+	var encoded = {
+		x: encodeDeltas(x, 0),
+		y: encodeDeltas(y, 0),
+		t: encodeDeltas((stroke.times || []).map(Math.round), t0)
+	};
+	if (stroke.primitive != null) {
+		encoded.p = stroke.primitive;
+	}
+	if (stroke.circle && stroke.circle.length) {
+		encoded.c = stroke.circle;
+	}
+	var attributes = {};
+	var hasAttributes = false;
+	for (var key in stroke) {
+		if (STROKE_FIELDS.indexOf(key) > -1 || stroke[key] === undefined) {
+			continue;
+		}
+		if (!(key in STROKE_DEFAULT_ATTRIBUTES) || JSON.stringify(stroke[key]) != JSON.stringify(STROKE_DEFAULT_ATTRIBUTES[key])) {
+			attributes[key] = stroke[key];
+			hasAttributes = true;
+		}
+	}
+	if (hasAttributes) {
+		encoded.a = attributes;
+	}
+	var pathNoString = stroke.path_nostring || [];
+	if (!isPolyline(pathNoString)) {
+		encoded.n = pathNoString;
+	} else {
+		var pathX = quantise(pathNoString.map(function(p) { return p[1]; }), scale);
+		var pathY = quantise(pathNoString.map(function(p) { return p[2]; }), scale);
+		if (JSON.stringify(pathX) != JSON.stringify(x) || JSON.stringify(pathY) != JSON.stringify(y)) {
+			// Snapped to a primitive.
+			encoded.s = {x: encodeDeltas(pathX, 0), y: encodeDeltas(pathY, 0)};
+		}
+	}
+	return encoded;
+}
+
+function encodeStrokes(strokes) {
+	// Returns the compact encoding of sketchpad.strokes() as a string.
+	var t0 = null;
+	for (var i = 0; i < strokes.length; i++) {
+		if (strokes[i].times && strokes[i].times.length && (t0 === null || strokes[i].times[0] < t0)) {
+			t0 = strokes[i].times[0];
+		}
+	}
+	t0 = Math.round(t0 || 0);
+	var encoded = {dgs: STROKE_FORMAT_VERSION, scale: STROKE_SCALE, t0: t0, strokes: []};
+	for (var i = 0; i < strokes.length; i++) {
+		encoded.strokes.push(encodeStroke(strokes[i], t0, STROKE_SCALE));
+	}
+	return JSON.stringify(encoded);
+}
+
+function decodeStrokes(value) {
+	// Returns sketchpad strokes for a stored trial in either format, for sketchpad.strokes().
+	if (!value) {
+		return [];
+	}
+	var data = (typeof value == "string") ? JSON.parse(value) : value;
+	if (jQuery.isArray(data)) {
+		return data;
+	}
+	if (data[STROKE_FORMAT_KEY] != STROKE_FORMAT_VERSION) {
+		throw new Error("Unknown stroke encoding: " + data[STROKE_FORMAT_KEY]);
+	}
+	var scale = data.scale;
+	var toPixels = function(value) { return value / scale; };
+	return data.strokes.map(function(encoded) {
+		var x = decodeDeltas(encoded.x, 0).map(toPixels);
+		var y = decodeDeltas(encoded.y, 0).map(toPixels);
+		var pathNoString = encoded.n;
+		if (!pathNoString) {
+			var pathX = encoded.s ? decodeDeltas(encoded.s.x, 0).map(toPixels) : x;
+			var pathY = encoded.s ? decodeDeltas(encoded.s.y, 0).map(toPixels) : y;
+			pathNoString = pathX.map(function(px, i) { return [i == 0 ? "M" : "L", px, pathY[i]]; });
+		}
+		var stroke = jQuery.extend(true, {}, STROKE_DEFAULT_ATTRIBUTES, encoded.a || {});
+		stroke.path = pathNoString.map(function(segment) { return segment.join(",").replace(",", ""); }).join("");
+		stroke.times = decodeDeltas(encoded.t, data.t0);
+		stroke.pathorig = x.map(function(px, i) { return [px, y[i]]; });
+		stroke.primitive = (encoded.p === undefined) ? null : encoded.p;
+		stroke.path_nostring = pathNoString;
+		stroke.circle = encoded.c || [];
+		return stroke;
+	});
+}
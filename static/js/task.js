@@ -1,6 +1,12 @@
 var DEBUG = false;
 var sketchpad = null;
 var nextButtonTimer = false;
+var recordCreated = false;
+// Uploads go out one at a time, in order, so that a trial never reaches the server before the record it extends.
+var uploads = [];
+var uploading = false;
+var MAX_UPLOAD_RETRIES = 5;
+var UPLOAD_RETRY_MS = 1000;
 
 function closeModal() {
 	$(".modal").modal("hide");
@@ -133,23 +139,91 @@ function getPhaseDescription(phaseConfig, phaseIndex) {
 	return message;
 }
 
-function logData(data, callback) {
+function postJSON(url, payload, onDone, attempt) {
+	// Retries failed requests with backoff: the server ignores a trial it already has, so resending is safe.
+	attempt = attempt || 0;
 	$.ajax({
 		type: "POST",
-		url: "record_data", 
+		url: url, 
 		contentType: "application/json; charset=utf-8",
-		data: JSON.stringify(data)
+		dataType: "json",
+		data: JSON.stringify(payload)
 	})
-	.done(function(response) {
+	.done(onDone)
+	.fail(function(xhr, status) {
+		if (attempt < MAX_UPLOAD_RETRIES) {
+			setTimeout(function() {
+				postJSON(url, payload, onDone, attempt + 1);
+			}, UPLOAD_RETRY_MS * Math.pow(2, attempt));
+		} else {
+			console.log("Giving up on " + url + ": " + status);
+			onDone({success: false, message: status});
+		}
+	})
+}
+
+function enqueueUpload(upload) {
+	uploads.push(upload);
+	if (!uploading) {
+		nextUpload();
+	}
+}
+
+function nextUpload() {
+	if (uploads.length === 0) {
+		uploading = false;
+		return;
+	}
+	uploading = true;
+	uploads.shift()(nextUpload);
+}
+
+function logData(data, callback, done) {
+	postJSON("record_data", data, function(response) {
 		message = response['message']
 		console.log(response);
+		if (response['success']) {
+			recordCreated = true;
+		}
+		if (callback) {
+			callback();
+		}
+		if (done) {
+			done();
+		}
+	})
+}
+
+function logTrial(data, phase, trialIndex, completed, callback, done) {
+	// Send only the new trial; the server appends it to the record created by logData.
+	var trial = {
+		metadata: {
+			user_id: data["metadata"]["user_id"],
+			experiment_id: data["metadata"]["experiment_id"]
+		},
+		phase: phase,
+		trial_index: trialIndex,
+		strokes: data[phase]["strokes"][trialIndex],
+		user_description: data[phase]["user_descriptions"][trialIndex],
+		completed: completed
+	};
+	postJSON("record_trial", trial, function(response) {
+		console.log(response);
+		if (response['resend_record']) {
+			// The server copy is missing or behind: upload the whole session instead.
+			logData(data, callback, done);
+			return;
+		}
 		if (callback) {
 			callback();
 		}
+		if (done) {
+			done();
+		}
 	})
 }
 
-function recordTrial(data, phase) {
+function recordTrial(data, phase, callback) {
 	// Make sure data has keys 
 	if (!("strokes" in data[phase])) {
 		data[phase]["strokes"] = [];	
@@ -157,11 +231,21 @@ function recordTrial(data, phase) {
 	}
 	
 	// Get strokes and user descriptions
-	var strokes = sketchpad ? sketchpad.json() : []
+	var strokes = sketchpad ? encodeStrokes(sketchpad.strokes()) : []
 	data[phase]["strokes"].push(strokes);
 	var userDescription = $("#describe").val();
 	data[phase]["user_descriptions"].push(userDescription);	
-	logData(data);
+
+	var trialIndex = data[phase]["strokes"].length - 1;
+	var completed = data["metadata"]["completed"] === true;
+	enqueueUpload(function(done) {
+		if (recordCreated) {
+			logTrial(data, phase, trialIndex, completed, callback, done);
+		} else {
+			// The first trial (or the first after a failed upload) creates the record with the full config.
+			logData(data, callback, done);
+		}
+	});
 
 	return data;
 }
@@ -209,8 +293,16 @@ $(document).ready(function() {
 					}
 				}
 				
-				// Log data
-				data = recordTrial(data, currentPhase);
+				// Log data, marking the last trial as completing the experiment
+				var exp_completed = null;
+				if (stimIndex + 1 >= stims.length && phaseIndex + 1 >= phases.length) {
+					data["metadata"]["completed"] = true
+					exp_completed = function() {
+						toggleModal("Experiment Completed!");
+						window.location.href = "feedback";
+					}
+				}
+				data = recordTrial(data, currentPhase, exp_completed);
 
 				// Get next image
 				stimIndex += 1;
@@ -221,15 +313,8 @@ $(document).ready(function() {
 				// Check if we've hit the end of a phase
 				if (stimIndex >= stims.length) {
 					phaseIndex += 1;
-					if (phaseIndex >= phases.length) {
-						data["metadata"]["completed"] = true
-						var exp_completed = function() {
-							toggleModal("Experiment Completed!");
-							window.location.href = "feedback";
-						}
-						logData(data, exp_completed); 	// log that the user completed this experiment
-
-					} else {
+					// After the final phase, recordTrial redirects to the feedback page once the last trial is logged
+					if (phaseIndex < phases.length) {
 						currentPhase = phases[phaseIndex];
 						phaseConfig = data[currentPhase];
 						var phase = currentPhase.split("_")[1];
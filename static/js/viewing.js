@@ -94,7 +94,7 @@ function displayStim(phaseConfig, stimIndex) {
 	var path = "static/images/stim/" + phaseConfig['images'][stimIndex];
 	$("#stim").prop("src", path);
 	if (sketchpad) {
-		sketchpad.json(phaseConfig['strokes'][stimIndex]);
+		sketchpad.strokes(decodeStrokes(phaseConfig['strokes'][stimIndex]));
 		sketchpad.animate();
 	}
 
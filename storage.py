@@ -0,0 +1,36 @@
+"""
+storage.py | Chooses where participant data is stored.
+
+Every backend is a module exposing the same functions as db_utils (STORAGE_FUNCTIONS below).
+Set STORAGE_BACKEND to one of:
+    mongo  : db_utils, the MongoDB cluster (default).
+    sqlite : sqlite_storage, an embedded SQLite file (STORAGE_SQLITE_PATH) for running the server,
+             the data downloader and load tests locally.
+"""
+import os
+import importlib
+
+DEFAULT_BACKEND = 'mongo'
+BACKENDS = {
+    'mongo': 'db_utils',
+    'sqlite': 'sqlite_storage',
+}
+STORAGE_FUNCTIONS = ('record', 'record_trial', 'update_record', 'get_record', 'repeat_user',
+                     'all_experiment_records', 'health_check', 'connection_stats')
+
+def backend_name():
+    return os.environ.get('STORAGE_BACKEND', DEFAULT_BACKEND)
+
+def get_backend(name=None):
+    """Imports and returns the backend module. Backends are only imported when selected."""
+    name = name or backend_name()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown storage backend: {name}")
+    backend = importlib.import_module(BACKENDS[name])
+    missing = [fn for fn in STORAGE_FUNCTIONS if not hasattr(backend, fn)]
+    assert not missing, f"Storage backend {name} is missing: {missing}"
+    return backend
+
+def valid_trial(phase, trial_index):
+    """Phase names become field paths in the stored record, so they must not contain '.' or start with '$'."""
+    return isinstance(trial_index, int) and trial_index >= 0 and bool(phase) and '.' not in phase and not phase.startswith('$')
@@ -0,0 +1,175 @@
+"""
+structured_logging.py | JSON logs for the server, written off the request thread.
+
+configure(app) sets up the root logger so that:
+    - log calls only put the record on a queue (a QueueHandler). A listener thread formats the records and
+      writes them to LOG_FILE, so requests never wait on file I/O.
+    - each record is one JSON object per line. Records logged while handling a request also carry its
+      request_id, route, method, user_id and experiment_id. The request_id is the X-Request-ID header, or a
+      new one if there is none, and it is echoed back in the response. Handlers can add or override fields for
+      the rest of the request with bind(), or for one record with extra={...}.
+    - the file is rotated when it reaches LOG_MAX_BYTES. With LOG_ROTATE_WHEN (eg. 'midnight', see
+      logging.handlers.TimedRotatingFileHandler) it is rotated on that schedule instead. LOG_BACKUP_COUNT old
+      files are kept.
+    - high-frequency events are sampled. A record logged with extra={'event': name} is only kept with the
+      probability LOG_SAMPLE_RATES sets for that event, and then carries that sample_rate, so counts can be
+      scaled back up. Warnings and errors are always kept.
+The listener is restarted in forked children and flushed at exit. Rotation assumes one process writes each
+LOG_FILE.
+
+Configured from the environment:
+    LOG_FILE (info.log), LOG_LEVEL (INFO), LOG_MAX_BYTES (10 MB), LOG_BACKUP_COUNT (5), LOG_ROTATE_WHEN (unset),
+    LOG_SAMPLE_RATES (record_trial=0.1, as comma separated event=rate pairs)
+"""
+import os
+import copy
+import json
+import uuid
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+from flask import g, request, session, has_request_context
+
+LOG_FILE = os.environ.get('LOG_FILE', 'info.log')
+LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+ROTATE_WHEN = os.environ.get('LOG_ROTATE_WHEN') or None
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+MAX_REQUEST_ID_LENGTH = 64
+# Also kept in the WSGI environ, for code that runs after Flask has finished with the request (metrics.py).
+REQUEST_ID_KEY = 'drawgood.request_id'
+# Every attribute of a plain LogRecord. Anything else on a record came from extra= and becomes a field.
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+def parse_sample_rates(value):
+    rates = {}
+    for pair in value.split(','):
+        if pair.strip():
+            event, rate = pair.split('=')
+            rates[event.strip()] = float(rate)
+    return rates
+
+SAMPLE_RATES = parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', 'record_trial=0.1'))
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class RequestContextFilter(logging.Filter):
+    """Adds the fields bound to the current request. Runs on the thread that logged the record."""
+    def filter(self, record):
+        if has_request_context():
+            for key, value in g.get('log_context', {}).items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        rate = self.sample_rates.get(getattr(record, 'event', None))
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        if random.random() >= rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Unlike QueueHandler.prepare, leaves formatting to the listener's JsonFormatter. Only the message
+        # arguments and the traceback are resolved here, while the objects they refer to are still current.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def file_handler():
+    if ROTATE_WHEN:
+        handler = logging.handlers.TimedRotatingFileHandler(LOG_FILE, when=ROTATE_WHEN, backupCount=BACKUP_COUNT)
+    else:
+        handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+_queue_handler = None
+_listener = None
+
+def start_listener():
+    global _listener
+    _queue_handler.queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, file_handler(), respect_handler_level=True)
+    _listener.start()
+
+def stop():
+    """Writes out everything still queued."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def bind(**fields):
+    """Adds fields to every record logged for the rest of the current request."""
+    if has_request_context():
+        g.log_context.update(fields)
+
+def start_request():
+    request_id = (request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex)[:MAX_REQUEST_ID_LENGTH]
+    request.environ[REQUEST_ID_KEY] = request_id
+    g.log_context = {
+        'request_id': request_id,
+        'route': request.url_rule.rule if request.url_rule else None,
+        'method': request.method,
+        'user_id': session.get('user_id'),
+        'experiment_id': session.get('experiment_id'),
+    }
+
+def finish_request(response):
+    request_id = request.environ.get(REQUEST_ID_KEY)
+    if request_id:
+        response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
+def configure(app):
+    global _queue_handler
+    if _queue_handler is None:
+        _queue_handler = StructuredQueueHandler(queue.SimpleQueue())
+        _queue_handler.addFilter(RequestContextFilter())
+        _queue_handler.addFilter(SamplingFilter(SAMPLE_RATES))
+        root = logging.getLogger()
+        root.setLevel(LEVEL)
+        root.addHandler(_queue_handler)
+        start_listener()
+        atexit.register(stop)
+        # The listener thread does not survive a fork, so each child starts its own.
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=start_listener)
+    app.before_request(start_request)
+    app.after_request(finish_request)
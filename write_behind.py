@@ -0,0 +1,410 @@
+"""
+write_behind.py | Write-behind queue for participant data.
+
+With WRITE_BEHIND=1 the server's record handlers append the payload to a local append-only spool and
+return straight away. A background thread coalesces the queued writes per user and flushes them to
+MongoDB with one ordered bulk_write per collection, so a slow or briefly unavailable cluster no longer
+stalls the participant's browser.
+
+Each server process writes its own spool file under WRITE_BEHIND_SPOOL_DIR and holds an flock on it.
+Spool lines are fsynced in batches (every WRITE_BEHIND_FSYNC_SECONDS) and a checkpoint file records the
+last flushed sequence number. On startup, spool files that no live process holds are queued again in this
+process's spool.
+
+The client has already been told its write succeeded, so a queued write is never just dropped:
+    - a trial that does not land (eg. it was flushed by one process before another flushed the user's
+      record) is queued again until its record arrives.
+    - if a batch fails for any reason other than a lost connection, its operations are written one at a time,
+      so that one bad operation does not hold up the rest.
+An operation still not written after WRITE_BEHIND_MAX_ATTEMPTS tries is moved to the dead-letter file
+(dead-letter.jsonl in the spool directory), one JSON line per operation with the reason.
+
+record(), record_trial() and update_record() mirror the db_utils functions of the same name. With a
+non-Mongo storage backend the queued writes are applied one at a time through that backend instead.
+"""
+import os
+import glob
+import json
+import time
+import fcntl
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+import pymongo
+import storage
+import metrics
+
+ENABLED = os.environ.get('WRITE_BEHIND', '0') == '1'
+SPOOL_DIR = os.environ.get('WRITE_BEHIND_SPOOL_DIR', 'spool')
+FSYNC_SECONDS = float(os.environ.get('WRITE_BEHIND_FSYNC_SECONDS', 0.05))
+FLUSH_SECONDS = float(os.environ.get('WRITE_BEHIND_FLUSH_SECONDS', 0.5))
+MAX_BATCH = int(os.environ.get('WRITE_BEHIND_MAX_BATCH', 500))
+MAX_ATTEMPTS = int(os.environ.get('WRITE_BEHIND_MAX_ATTEMPTS', 20))
+MAX_RETRY_SECONDS = 30
+DEAD_LETTER_PATH = os.path.join(SPOOL_DIR, 'dead-letter.jsonl')
+# Errors that say nothing about the operations themselves: everything stays queued until the database is back.
+TRANSIENT_ERRORS = (pymongo.errors.ConnectionFailure,)
+
+RECORD = 'record'
+TRIAL = 'trial'
+UPDATE = 'update'
+
+QUEUED = {'success': True, 'queued': True, 'message': 'Record queued'}
+INVALID = {'success': False, 'message': 'Invalid record'}
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Condition()
+_queue = deque()
+_spool = None
+_pid = None
+_stats = {
+    'queued': 0,
+    'flushed': 0,
+    'coalesced': 0,
+    'flush_failures': 0,
+    'replayed': 0,
+    'requeued': 0,
+    'dead_lettered': 0,
+    'last_flush_seconds': None,
+    'max_flush_seconds': None,
+}
+
+class Spool(object):
+    """Append-only JSON lines file plus a checkpoint of the last flushed sequence number."""
+    def __init__(self, path):
+        self.path = path
+        self.checkpoint_path = path + '.checkpoint'
+        self.file = open(path, 'a+')
+        fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.seq = read_checkpoint(self.checkpoint_path)
+        self.flushed_seq = self.seq
+        self.dirty = False
+
+    def pending(self):
+        ops = read_spool(self.path, self.flushed_seq)
+        if ops:
+            self.seq = ops[-1]['seq']
+        return ops
+
+    def append(self, op):
+        self.seq += 1
+        op['seq'] = self.seq
+        self.file.write(json.dumps(op) + '\n')
+        self.file.flush()
+        self.dirty = True
+        return op
+
+    def fsync(self):
+        if self.dirty:
+            self.dirty = False
+            os.fsync(self.file.fileno())
+
+    def checkpoint(self, seq):
+        self.flushed_seq = seq
+        write_checkpoint(self.checkpoint_path, seq)
+        if seq == self.seq:
+            # Everything written so far is in the database: start the spool again from empty.
+            self.file.truncate(0)
+
+def read_checkpoint(checkpoint_path):
+    try:
+        with open(checkpoint_path) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+def write_checkpoint(checkpoint_path, seq):
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(str(seq))
+    os.replace(tmp_path, checkpoint_path)
+
+def read_spool(path, after_seq):
+    ops = []
+    with open(path) as f:
+        for line in f:
+            try:
+                op = json.loads(line)
+            except ValueError:
+                # A torn final line from a crash mid-write.
+                continue
+            if op['seq'] > after_seq:
+                ops.append(op)
+    return ops
+
+def replay_orphaned_spools():
+    """Queues the writes left behind in the spool files of processes that are no longer running."""
+    n_replayed = 0
+    for path in glob.glob(os.path.join(SPOOL_DIR, 'spool-*.jsonl')):
+        if _spool is not None and path == _spool.path:
+            continue
+        with open(path, 'a+') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # Still owned by a live process.
+            checkpoint_path = path + '.checkpoint'
+            ops = read_spool(path, read_checkpoint(checkpoint_path))
+            with _lock:
+                # Into our own spool first, so they are flushed (or dead-lettered) like any other write.
+                for op in ops:
+                    _queue.append(_spool.append(op))
+                _spool.fsync()
+            os.remove(path)
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+            n_replayed += len(ops)
+    _stats['replayed'] += n_replayed
+    return n_replayed
+
+def start():
+    """Opens this process's spool and starts the background threads (again after a fork)."""
+    global _spool, _pid
+    if _pid == os.getpid():
+        return
+    with _lock:
+        if _pid == os.getpid():
+            return
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        _spool = Spool(os.path.join(SPOOL_DIR, f'spool-{os.getpid()}.jsonl'))
+        _queue.clear()
+        # A spool left under our own pid (eg. after a restart that reused it) still has to be flushed.
+        _queue.extend(_spool.pending())
+        _pid = os.getpid()
+    threading.Thread(target=_fsync_loop, daemon=True).start()
+    threading.Thread(target=_flush_loop, daemon=True).start()
+
+def enqueue(op):
+    if not valid(op):
+        return INVALID
+    start()
+    with _lock:
+        _queue.append(_spool.append(op))
+        _stats['queued'] += 1
+        if len(_queue) >= MAX_BATCH:
+            _lock.notify()
+    return QUEUED
+
+def record(data):
+    return enqueue({'op': RECORD, 'data': data})
+
+def record_trial(user_id, experiment_id, phase, trial_index, strokes, user_description, completed=False):
+    if not storage.valid_trial(phase, trial_index):
+        return {'success': False, 'message': 'Invalid trial'}
+    return enqueue({'op': TRIAL, 'user_id': user_id, 'experiment_id': experiment_id, 'phase': phase, 'trial_index': trial_index,
+                    'strokes': strokes, 'user_description': user_description, 'completed': completed})
+
+def update_record(user_id, experiment_id, data):
+    return enqueue({'op': UPDATE, 'user_id': user_id, 'experiment_id': experiment_id, 'data': data})
+
+def op_target(op):
+    """(collection name, user_id) that an operation writes to."""
+    if op['op'] == RECORD:
+        experiment_id, user_id = op['data']['metadata']['experiment_id'], op['data']['metadata']['user_id']
+    else:
+        experiment_id, user_id = op['experiment_id'], op['user_id']
+    if user_id == 'admin' and op['op'] != UPDATE:
+        experiment_id = 'test'
+    return experiment_id, user_id
+
+def valid(op):
+    """Whether an operation names the experiment and user it writes to. Checked before queueing, as the
+    client cannot be told about a write that later turns out to be unusable."""
+    try:
+        target = op_target(op)
+    except (KeyError, TypeError):
+        return False
+    return all(isinstance(value, str) and value for value in target)
+
+def coalesce(ops):
+    """Drops full-record writes that are immediately superseded by a later full record for the same user."""
+    coalesced = []
+    last_op_for_target = {}
+    for op in ops:
+        target = op_target(op)
+        previous = last_op_for_target.get(target)
+        if op['op'] == RECORD and previous is not None and coalesced[previous]['op'] == RECORD:
+            coalesced[previous] = op
+            continue
+        last_op_for_target[target] = len(coalesced)
+        coalesced.append(op)
+    _stats['coalesced'] += len(ops) - len(coalesced)
+    return coalesced
+
+def apply_ops(ops):
+    """Writes a batch of operations, with one ordered bulk_write per collection. Returns the trials that did
+    not land and should be tried again later."""
+    if storage.backend_name() != 'mongo':
+        return apply_ops_individually(storage.get_backend(), ops)
+    db_utils = storage.get_backend('mongo')
+    db = db_utils.open_connection()
+    by_collection = {}
+    for op in coalesce(ops):
+        by_collection.setdefault(op_target(op)[0], []).append(op)
+
+    retry_ops = []
+    for experiment_id, collection_ops in by_collection.items():
+        collection = db_utils.experiment_collection(db, experiment_id)
+        # Same rule as db_utils.record: never overwrite a completed record.
+        replaced_users = [op_target(op)[1] for op in collection_ops if op['op'] == RECORD]
+        with metrics.timed('distinct'):
+            completed_users = set(collection.distinct('metadata.user_id', {'metadata.user_id': {'$in': replaced_users}, 'metadata.completed': True}))
+        requests = []
+        for op in collection_ops:
+            user_id = op_target(op)[1]
+            if op['op'] == RECORD:
+                if user_id in completed_users and user_id != 'admin':
+                    continue
+                requests.append(pymongo.ReplaceOne({'metadata.user_id': user_id}, db_utils.touched(op['data']), upsert=True))
+            elif op['op'] == TRIAL:
+                query, update = db_utils.trial_update(user_id, op['phase'], op['trial_index'], op['strokes'], op['user_description'], op['completed'])
+                requests.append(pymongo.UpdateOne(query, update))
+            elif op['op'] == UPDATE:
+                requests.append(pymongo.UpdateOne({'metadata.user_id': user_id}, {'$set': db_utils.touched(op['data'])}))
+        if requests:
+            with metrics.timed('bulk_write'):
+                result = collection.bulk_write(requests, ordered=True)
+            if result.matched_count + result.upserted_count < len(requests):
+                # Some write matched nothing. Only a trial can be lost that way, so find out which ones.
+                retry_ops.extend(missing_trials(db_utils, collection, [op for op in collection_ops if op['op'] == TRIAL]))
+        for op in collection_ops:
+            if op['op'] == RECORD:
+                db_utils.register_participant(db, op_target(op)[1], experiment_id)
+    return retry_ops
+
+def missing_trials(db_utils, collection, trial_ops):
+    """The trials that are not in the database, leaving out those of users who have already completed.
+    Same checks as db_utils.record_trial makes when its update matches nothing."""
+    missing = []
+    for op in trial_ops:
+        user_id = op_target(op)[1]
+        with metrics.timed('find_one'):
+            existing = collection.find_one({'metadata.user_id': user_id}, {'metadata.completed': 1})
+        if existing is None:
+            missing.append(op)
+            continue
+        with metrics.timed('find_one'):
+            already_recorded = collection.find_one({'_id': existing['_id'], f"{op['phase']}.strokes.{op['trial_index']}": {'$exists': True}}, {'_id': 1})
+        if already_recorded:
+            if op['completed'] and not existing['metadata'].get('completed'):
+                with metrics.timed('update_one'):
+                    collection.update_one({'_id': existing['_id']}, {'$set': db_utils.touched({'metadata.completed': True})})
+        elif not existing['metadata'].get('completed') or user_id == 'admin':
+            missing.append(op)
+    return missing
+
+def apply_ops_individually(backend, ops):
+    retry_ops = []
+    for op in coalesce(ops):
+        if op['op'] == RECORD:
+            backend.record(op['data'])
+        elif op['op'] == TRIAL:
+            result = backend.record_trial(op['user_id'], op['experiment_id'], op['phase'], op['trial_index'],
+                                          op['strokes'], op['user_description'], op['completed'])
+            # The client would have been asked to resend its record: wait for it to arrive instead.
+            if result.get('resend_record'):
+                retry_ops.append(op)
+        elif op['op'] == UPDATE:
+            backend.update_record(op['user_id'], op['experiment_id'], op['data'])
+    return retry_ops
+
+def apply_ops_one_at_a_time(ops):
+    """Writes a batch that failed as a whole, one operation at a time. Returns the operations to try again,
+    each with the reason it was not written."""
+    retry_ops = []
+    for op in ops:
+        try:
+            retry_ops.extend((retry_op, 'trial has no record to be added to') for retry_op in apply_ops([op]))
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            retry_ops.append((op, repr(e)))
+    return retry_ops
+
+def requeue(op, reason):
+    """Queues an operation again, or moves it to the dead-letter file once it has had MAX_ATTEMPTS tries.
+    Called with _lock held."""
+    op['attempts'] = op.get('attempts', 0) + 1
+    if op['attempts'] < MAX_ATTEMPTS:
+        _queue.append(_spool.append(op))
+        _stats['requeued'] += 1
+        return
+    with open(DEAD_LETTER_PATH, 'a') as f:
+        f.write(json.dumps({'time': datetime.now(timezone.utc).isoformat(), 'reason': reason, 'op': op}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    _stats['dead_lettered'] += 1
+    logger.error('Queued write moved to the dead-letter file', extra={
+        'event': 'dead_letter', 'op': op['op'], 'seq': op['seq'], 'attempts': op['attempts'], 'reason': reason})
+
+def flush():
+    """Flushes everything currently queued. Returns the number of operations written."""
+    with _lock:
+        ops = list(_queue)[:MAX_BATCH]
+    if not ops:
+        return 0
+    start_time = time.time()
+    try:
+        retry_ops = [(op, 'trial has no record to be added to') for op in apply_ops(ops)]
+    except TRANSIENT_ERRORS:
+        raise
+    except Exception:
+        logger.exception('Write-behind batch failed, writing it one operation at a time')
+        _stats['flush_failures'] += 1
+        retry_ops = apply_ops_one_at_a_time(ops)
+    elapsed = time.time() - start_time
+    with _lock:
+        for _ in ops:
+            _queue.popleft()
+        # Requeued before the checkpoint, so that they are in the spool once it no longer covers the originals.
+        for op, reason in retry_ops:
+            requeue(op, reason)
+        _spool.checkpoint(ops[-1]['seq'])
+        _stats['flushed'] += len(ops)
+        _stats['last_flush_seconds'] = elapsed
+        _stats['max_flush_seconds'] = max(elapsed, _stats['max_flush_seconds'] or 0)
+    return len(ops)
+
+def _flush_loop():
+    pid = os.getpid()
+    try:
+        replay_orphaned_spools()
+    except Exception:
+        logger.exception('Could not replay orphaned write-behind spools')
+    retry_seconds = FLUSH_SECONDS
+    while _pid == pid:
+        with _lock:
+            if len(_queue) < MAX_BATCH:
+                _lock.wait(retry_seconds)
+        try:
+            while flush() == MAX_BATCH:
+                pass
+            retry_seconds = FLUSH_SECONDS
+        except Exception:
+            # Keep everything queued and back off; the spool still holds the data.
+            logger.exception('Write-behind flush failed')
+            _stats['flush_failures'] += 1
+            retry_seconds = min(retry_seconds * 2, MAX_RETRY_SECONDS)
+
+def _fsync_loop():
+    pid = os.getpid()
+    while _pid == pid:
+        time.sleep(FSYNC_SECONDS)
+        # Outside _lock, so that appends never wait on the disk. Spool.fsync clears dirty before syncing, so an
+        # append made meanwhile is synced on the next pass.
+        _spool.fsync()
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Condition()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def stats():
+    with _lock:
+        queue_depth = len(_queue)
+    return dict(_stats, enabled=ENABLED, queue_depth=queue_depth)